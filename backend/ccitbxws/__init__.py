@@ -1,11 +1,27 @@
 from . import cache
+from . import tile_stores
+from . import shared_cache
+from . import tile_stats
+from . import pyramid_sidecar
 from . import image
+from . import chunk_cache
+from . import prefetch
+from . import render_pool
+from . import data_tiles
 from . import cmaps
 from . import data_sources
 
 __all__ = [
     'cache',
+    'tile_stores',
+    'shared_cache',
+    'tile_stats',
+    'pyramid_sidecar',
     'image',
-    'cmaps'
+    'chunk_cache',
+    'prefetch',
+    'render_pool',
+    'data_tiles',
+    'cmaps',
     'data_sources',
 ]
@@ -1,6 +1,12 @@
+import heapq
+import json
+import os
+import random
+import tempfile
 import time
 from abc import ABCMeta, abstractmethod
-from threading import RLock
+from collections import OrderedDict
+from threading import Lock, RLock
 
 
 class CacheStore(metaclass=ABCMeta):
@@ -37,6 +43,14 @@ class CacheStore(metaclass=ABCMeta):
         """
         pass
 
+    def get_stored_items(self):
+        """
+        Return the values this store already holds, e.g. because they have been persisted by a previous process.
+        The default implementation returns an empty sequence.
+        :return: an iterable of (key, stored_value, stored_size) tuples, least recently used values first
+        """
+        return ()
+
 
 class MemoryCacheStore(CacheStore):
     """
@@ -70,19 +84,696 @@ class MemoryCacheStore(CacheStore):
         pass
 
 
+class CacheIndex(metaclass=ABCMeta):
+    """
+    Keeps track of the items of a cache and decides which item is to be discarded next.
+    All methods are called by the owning cache while it holds its lock.
+    """
+
+    @abstractmethod
+    def add(self, item):
+        """
+        Add a new item.
+        :param item: the item, see Cache.Item
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, item):
+        """
+        Remove an item previously added.
+        :param item: the item, see Cache.Item
+        """
+        pass
+
+    @abstractmethod
+    def access(self, item):
+        """
+        Notify that an item has been accessed, i.e. its access time and count have been updated.
+        :param item: the item, see Cache.Item
+        """
+        pass
+
+    @abstractmethod
+    def next_victim(self):
+        """
+        :return: the item to be discarded next, or None if the index is empty
+        """
+        pass
+
+    def discard(self, item):
+        """
+        Remove an item because it is discarded by the cache's replacement policy.
+        The default implementation calls remove(item).
+        :param item: the item, see Cache.Item
+        """
+        self.remove(item)
+
+
+class SortedCacheIndex(CacheIndex):
+    """
+    Index for arbitrary policy key functions: the next victim is the item with the smallest key.
+    Finding the victim costs O(n), use one of the predefined POLICY_xxx values where possible.
+    """
+
+    def __init__(self, key):
+        self._key = key
+        self._item_dict = OrderedDict()
+
+    def add(self, item):
+        self._item_dict[item.key] = item
+
+    def remove(self, item):
+        del self._item_dict[item.key]
+
+    def access(self, item):
+        pass
+
+    def next_victim(self):
+        if not self._item_dict:
+            return None
+        return min(self._item_dict.values(), key=self._key)
+
+
+class LruCacheIndex(CacheIndex):
+    """
+    Index for the LRU policy: items are kept in access order, the least recently used item comes first.
+    """
+
+    def __init__(self):
+        self._item_dict = OrderedDict()
+
+    def add(self, item):
+        self._item_dict[item.key] = item
+
+    def remove(self, item):
+        del self._item_dict[item.key]
+
+    def access(self, item):
+        self._item_dict.move_to_end(item.key)
+
+    def next_victim(self):
+        for item in self._item_dict.values():
+            return item
+        return None
+
+
+class MruCacheIndex(LruCacheIndex):
+    """
+    Index for the MRU policy: like LRU, but the most recently used item is the next victim.
+    """
+
+    def next_victim(self):
+        for key in reversed(self._item_dict):
+            return self._item_dict[key]
+        return None
+
+
+class LfuCacheIndex(CacheIndex):
+    """
+    Index for the LFU policy.
+    Items are kept in frequency buckets which form a doubly linked list ordered by access count,
+    so that adding, accessing, and finding the victim are all O(1) operations.
+    See http://dhruvbird.com/lfu.pdf
+    """
+
+    class Bucket:
+        __slots__ = ('access_count', 'item_dict', 'prev', 'next')
+
+        def __init__(self, access_count, prev, next):
+            self.access_count = access_count
+            self.item_dict = OrderedDict()
+            self.prev = prev
+            self.next = next
+
+    def __init__(self):
+        self._head = None
+
+    def add(self, item):
+        # New items have an access count of one, so the loop usually terminates immediately
+        prev, bucket = None, self._head
+        while bucket is not None and bucket.access_count < item.access_count:
+            prev, bucket = bucket, bucket.next
+        if bucket is None or bucket.access_count != item.access_count:
+            bucket = self._insert_bucket(item.access_count, prev, bucket)
+        bucket.item_dict[item.key] = item
+        item.index_data = bucket
+
+    def remove(self, item):
+        bucket = item.index_data
+        del bucket.item_dict[item.key]
+        item.index_data = None
+        if not bucket.item_dict:
+            self._remove_bucket(bucket)
+
+    def access(self, item):
+        bucket = item.index_data
+        next_bucket = bucket.next
+        if next_bucket is None or next_bucket.access_count != item.access_count:
+            next_bucket = self._insert_bucket(item.access_count, bucket, next_bucket)
+        del bucket.item_dict[item.key]
+        next_bucket.item_dict[item.key] = item
+        item.index_data = next_bucket
+        if not bucket.item_dict:
+            self._remove_bucket(bucket)
+
+    def next_victim(self):
+        if self._head is None:
+            return None
+        for item in self._head.item_dict.values():
+            return item
+
+    def _insert_bucket(self, access_count, prev, next):
+        bucket = LfuCacheIndex.Bucket(access_count, prev, next)
+        if prev is None:
+            self._head = bucket
+        else:
+            prev.next = bucket
+        if next is not None:
+            next.prev = bucket
+        return bucket
+
+    def _remove_bucket(self, bucket):
+        if bucket.prev is None:
+            self._head = bucket.next
+        else:
+            bucket.prev.next = bucket.next
+        if bucket.next is not None:
+            bucket.next.prev = bucket.prev
+
+
+class RrCacheIndex(CacheIndex):
+    """
+    Index for the RR policy: the next victim is drawn uniformly at random.
+    Items are kept in a list, each item remembers its list position so it can be removed in O(1).
+    """
+
+    def __init__(self):
+        self._item_list = []
+
+    def add(self, item):
+        item.index_data = len(self._item_list)
+        self._item_list.append(item)
+
+    def remove(self, item):
+        item_list = self._item_list
+        index = item.index_data
+        last_item = item_list.pop()
+        if last_item is not item:
+            item_list[index] = last_item
+            last_item.index_data = index
+        item.index_data = None
+
+    def access(self, item):
+        pass
+
+    def next_victim(self):
+        if not self._item_list:
+            return None
+        return random.choice(self._item_list)
+
+
+class GreedyDualSizeCacheIndex(CacheIndex):
+    """
+    Index for the GDS (GreedyDual-Size) policy, which weighs recency, size, and the cost of recomputing an item.
+    Each item gets the priority H = L + cost / size when it is added or accessed, where L is the priority of the
+    most recently discarded item. The item with the lowest priority is the next victim, so that cheap and large
+    items are discarded before expensive and small ones, and items that are not accessed age out over time.
+    Items without a cost are given a cost of one.
+    See Cao, P. and Irani, S.: Cost-Aware WWW Proxy Caching Algorithms, 1997.
+
+    Items are kept in a binary heap, so adding, accessing, and finding the victim cost O(log n).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._num_items = 0
+        self._counter = 0
+        self._inflation = 0.0
+
+    @property
+    def heap_size(self):
+        """
+        :return: the number of heap entries, including those of removed and re-prioritized items
+        """
+        return len(self._heap)
+
+    def add(self, item):
+        self._push(item)
+        self._num_items += 1
+        self._compact_if_stale()
+
+    def remove(self, item):
+        # Lazy deletion, the heap entry is dropped when it comes to the top of the heap
+        item.index_data[2] = None
+        item.index_data = None
+        self._num_items -= 1
+        self._compact_if_stale()
+
+    def access(self, item):
+        item.index_data[2] = None
+        self._push(item)
+        self._compact_if_stale()
+
+    def next_victim(self):
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return heap[0][2]
+
+    def discard(self, item):
+        self._inflation = item.index_data[0]
+        self.remove(item)
+
+    def _push(self, item):
+        cost = item.cost if item.cost is not None else 1.0
+        priority = self._inflation + (cost / item.stored_size if item.stored_size > 0 else cost)
+        self._counter += 1
+        entry = [priority, self._counter, item]
+        item.index_data = entry
+        heapq.heappush(self._heap, entry)
+
+    def _compact_if_stale(self):
+        # Stale entries of removed items below the top of the heap are never popped by next_victim(),
+        # so drop them once they make up more than half of the heap
+        if len(self._heap) > 2 * self._num_items + 64:
+            self._compact()
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if entry[2] is not None]
+        heapq.heapify(self._heap)
+
+
+class CachePolicy:
+    """
+    A cache replacement policy.
+    Calling a policy with a cache item returns the item's sort key, items with smaller keys are discarded first.
+    """
+
+    def __init__(self, name, index_class, key):
+        self._name = name
+        self._index_class = index_class
+        self._key = key
+
+    @property
+    def name(self):
+        return self._name
+
+    def new_index(self):
+        """
+        :return: a new CacheIndex instance that implements this policy in constant time
+        """
+        return self._index_class()
+
+    def __call__(self, item):
+        return self._key(item)
+
+    def __repr__(self):
+        return 'POLICY_%s' % self._name
+
+
 # Discard Least Recently Used items first
-POLICY_LRU = lambda item: item.access_time
+POLICY_LRU = CachePolicy('LRU', LruCacheIndex, lambda item: item.access_time)
 
 # Discard Most Recently Used first
-POLICY_MRU = lambda item: -item.access_time
+POLICY_MRU = CachePolicy('MRU', MruCacheIndex, lambda item: -item.access_time)
 
 # Discard Least Frequently Used first
-POLICY_LFU = lambda item: item.access_count
+POLICY_LFU = CachePolicy('LFU', LfuCacheIndex, lambda item: item.access_count)
 
 # Discard items by Random Replacement
-POLICY_RR = lambda item: item.access_count % 2
+POLICY_RR = CachePolicy('RR', RrCacheIndex, lambda item: random.random())
+
+# Discard items by GreedyDual-Size, i.e. large, cheap to recompute, and not recently used items first
+POLICY_GDS = CachePolicy('GDS', GreedyDualSizeCacheIndex,
+                         lambda item: (item.cost if item.cost is not None else 1.0) / max(item.stored_size, 1))
 
-_T0 = time.clock()
+_T0 = time.perf_counter()
+
+_HALVE_TABLE = bytes(i >> 1 for i in range(256))
+
+_MASK_64 = 0xffffffffffffffff
+
+
+class TinyLfuAdmission:
+    """
+    An admission filter which lets a cache admit a new item only if the item's key is estimated to be accessed
+    more frequently than the key of the item it would replace. This protects frequently used items from being
+    flushed out by scans over many items that are used once only.
+
+    Access frequencies are estimated by a count-min sketch. To let the estimates follow changing access patterns,
+    all counters are halved after a given number of recorded accesses (aging).
+    See Einziger, G. et al.: TinyLFU: A Highly Efficient Cache Admission Policy, 2015.
+
+    An instance is guarded by a single lock. Caches accessed by many threads concurrently, e.g. the shards of a
+    ShardedCache, should therefore use filters of their own, see split().
+    """
+
+    def __init__(self, num_counters=64 * 1024, depth=4, sample_size=None, max_count=15):
+        """
+        Constructor.
+
+        :param num_counters: number of counters per sketch row, should be a multiple of the expected number of items,
+               will be rounded up to a power of two
+        :param depth: number of sketch rows, i.e. independent hash functions
+        :param sample_size: number of recorded accesses after which all counters are halved,
+               defaults to ten times num_counters
+        :param max_count: the maximum value of a counter, at most 255
+        """
+        if not 0 < max_count <= 255:
+            raise ValueError('max_count must be in the range 1 to 255')
+        num_counters = 1 << max(int(num_counters) - 1, 1).bit_length()
+        self._width = num_counters
+        self._depth = depth
+        self._sample_size = sample_size if sample_size else 10 * num_counters
+        self._max_count = max_count
+        self._counters = bytearray(num_counters * depth)
+        self._num_recorded = 0
+        self._lock = Lock()
+
+    @property
+    def num_counters(self):
+        return self._width
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def sample_size(self):
+        return self._sample_size
+
+    def split(self, num_parts):
+        """
+        Create independent filters, each with an equal share of this filter's counters and sample size,
+        for caches which each see a disjoint part of the keys, e.g. the shards of a ShardedCache.
+        The recorded accesses of this filter are not copied.
+        :param num_parts: the number of filters
+        :return: a list of num_parts new TinyLfuAdmission instances
+        """
+        if num_parts < 1:
+            raise ValueError('num_parts must be a positive integer')
+        return [TinyLfuAdmission(num_counters=max(self._width // num_parts, 1),
+                                 depth=self._depth,
+                                 sample_size=max(self._sample_size // num_parts, 1),
+                                 max_count=self._max_count) for _ in range(num_parts)]
+
+    def record(self, key):
+        """
+        Record an access to the given key.
+        :param key: the key
+        """
+        with self._lock:
+            indexes = self._get_indexes(key)
+            counters = self._counters
+            count = min(counters[i] for i in indexes)
+            if count < self._max_count:
+                # Conservative update: increment the minimal counters only
+                for i in indexes:
+                    if counters[i] == count:
+                        counters[i] = count + 1
+            self._num_recorded += 1
+            if self._num_recorded >= self._sample_size:
+                self._counters = bytearray(counters.translate(_HALVE_TABLE))
+                self._num_recorded //= 2
+
+    def estimate(self, key):
+        """
+        :param key: the key
+        :return: the estimated access frequency of the given key
+        """
+        with self._lock:
+            counters = self._counters
+            return min(counters[i] for i in self._get_indexes(key))
+
+    def admit(self, key, victim_key):
+        """
+        :param key: the key of a new item
+        :param victim_key: the key of the item that would be discarded for the new one
+        :return: True, if the new item should be admitted
+        """
+        return self.estimate(key) > self.estimate(victim_key)
+
+    def _get_indexes(self, key):
+        # Derive one index per row from the key's hash by different multiplicative mixing steps
+        width = self._width
+        h = hash(key) & _MASK_64
+        indexes = []
+        for row in range(self._depth):
+            x = ((h + 0x9e3779b97f4a7c15 * (row + 1)) & _MASK_64) * 0xbf58476d1ce4e5b9 & _MASK_64
+            x = (x ^ (x >> 31)) * 0x94d049bb133111eb & _MASK_64
+            indexes.append(row * width + ((x ^ (x >> 29)) & (width - 1)))
+        return indexes
+
+
+def new_cache_index(policy):
+    """
+    Create a new cache index for the given policy.
+    :param policy: one of the POLICY_xxx values or any function that computes a sort key for a given Cache.Item
+    :return: a new CacheIndex instance
+    """
+    if isinstance(policy, CachePolicy):
+        return policy.new_index()
+    return SortedCacheIndex(policy)
+
+
+class CacheSnapshot:
+    """
+    A snapshot of the hot part of a cache, written to a file so that a restarted process can warm up its cache.
+    Only values of type bytes (e.g. encoded tiles) are included.
+
+    A snapshot file starts with a JSON index that is read when the snapshot is opened, while the values are read
+    lazily when they are requested by the cache. Each value may be associated with a source file. When the
+    snapshot is opened, values are dropped if their source file's modification time or size has changed
+    since the snapshot was written.
+    """
+
+    MAGIC = b'CCITBXS1'
+
+    def __init__(self, file_path):
+        """
+        Open a snapshot file and read its index.
+        :param file_path: the snapshot file
+        """
+        self._file_path = file_path
+        self._lock = Lock()
+        self._fp = open(file_path, 'rb')
+        try:
+            if self._fp.read(len(CacheSnapshot.MAGIC)) != CacheSnapshot.MAGIC:
+                raise ValueError('%s is not a cache snapshot file' % file_path)
+            index_size = int.from_bytes(self._fp.read(8), 'big')
+            index = json.loads(self._fp.read(index_size).decode('utf-8'))
+        except:
+            self._fp.close()
+            raise
+        self._data_offset = len(CacheSnapshot.MAGIC) + 8 + index_size
+        valid_sources = {path for path, stat in index['sources'].items()
+                         if stat is not None and _get_source_stat(path) == stat}
+        self._entries = OrderedDict()
+        self._num_invalid = 0
+        for key, offset, size, access_count, cost, source in index['entries']:
+            if source is None or source in valid_sources:
+                self._entries[key] = (offset, size, access_count, cost)
+            else:
+                self._num_invalid += 1
+
+    @property
+    def file_path(self):
+        return self._file_path
+
+    @property
+    def num_entries(self):
+        return len(self._entries)
+
+    @property
+    def num_invalid(self):
+        """
+        :return: the number of values dropped because their source file has changed
+        """
+        return self._num_invalid
+
+    def contains(self, key):
+        """
+        :param key: the key
+        :return: True, if this snapshot has a valid value for the key
+        """
+        with self._lock:
+            return self._fp is not None and key in self._entries
+
+    def pop_value(self, key):
+        """
+        Read and remove a value from this snapshot.
+        :param key: the key
+        :return: a tuple (value, access_count, cost), or None if the snapshot has no valid value for the key
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or self._fp is None:
+                return None
+            offset, size, access_count, cost = entry
+            self._fp.seek(self._data_offset + offset)
+            return self._fp.read(size), access_count, cost
+
+    def pop_all(self):
+        """
+        Read and remove all remaining values from this snapshot.
+        :return: a list of (key, value, access_count, cost) tuples
+        """
+        values = []
+        for key in list(self._entries.keys()):
+            value = self.pop_value(key)
+            if value is not None:
+                values.append((key,) + value)
+        return values
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+            self._entries.clear()
+
+    @staticmethod
+    def write(file_path, values, get_source_path=None):
+        """
+        Write a snapshot file. The file is written to a temporary file first and then renamed.
+
+        :param file_path: the snapshot file
+        :param values: an iterable of (key, value, access_count, cost) tuples with values of type bytes
+        :param get_source_path: an optional function that returns the path of the source file a key depends on
+        :return: the number of values written
+        """
+        values = list(values)
+        entries = []
+        sources = {}
+        offset = 0
+        for key, value, access_count, cost in values:
+            source = get_source_path(key) if get_source_path else None
+            if source is not None and source not in sources:
+                sources[source] = _get_source_stat(source)
+            entries.append((key, offset, len(value), access_count, cost, source))
+            offset += len(value)
+        index = json.dumps(dict(sources=sources, entries=entries)).encode('utf-8')
+
+        dir_path = os.path.dirname(os.path.abspath(file_path))
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=dir_path)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(CacheSnapshot.MAGIC)
+                fp.write(len(index).to_bytes(8, 'big'))
+                fp.write(index)
+                for _, value, _, _ in values:
+                    fp.write(value)
+            os.replace(temp_path, file_path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return len(entries)
+
+
+def _get_source_stat(path):
+    try:
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+    except OSError:
+        return None
+
+
+class CacheStats:
+    """
+    Thread-safe counters of a cache's activity.
+
+    If a group function is given, counters are additionally broken down by groups of keys.
+    The function receives a key and returns an iterable of (category, group) pairs, e.g.
+    (('level', '3'), ('image', 'my-image')) for a tile ID, see ccitbxws.image.get_tile_id_groups().
+    """
+
+    COUNTERS = ('hits', 'misses', 'parent_hits', 'snapshot_hits', 'puts', 'rejections', 'evictions', 'evicted_size')
+
+    def __init__(self, group_func=None):
+        self._group_func = group_func
+        self._lock = Lock()
+        self._counters = dict.fromkeys(CacheStats.COUNTERS, 0)
+        self._group_counters = {}
+
+    @property
+    def group_func(self):
+        return self._group_func
+
+    def record(self, counter, key, amount=1):
+        """
+        Increment a counter.
+        :param counter: one of CacheStats.COUNTERS
+        :param key: the key the counted event refers to
+        :param amount: the increment
+        """
+        groups = self._group_func(key) if self._group_func is not None else ()
+        with self._lock:
+            self._counters[counter] += amount
+            for category, group in groups:
+                group_counters = self._group_counters.setdefault(category, {})
+                counters = group_counters.get(group)
+                if counters is None:
+                    counters = group_counters[group] = dict.fromkeys(CacheStats.COUNTERS, 0)
+                counters[counter] += amount
+
+    def get_counter(self, counter):
+        """
+        :param counter: one of CacheStats.COUNTERS
+        :return: the counter's current value
+        """
+        with self._lock:
+            return self._counters[counter]
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict.fromkeys(CacheStats.COUNTERS, 0)
+            self._group_counters = {}
+
+    def to_dict(self):
+        """
+        :return: a JSON-serializable dictionary of all counters; counters broken down by groups are
+                 found in its 'groups' entry as {category: {group: counters}}
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['groups'] = {category: {group: dict(counters) for group, counters in group_counters.items()}
+                               for category, group_counters in self._group_counters.items()}
+        return stats
+
+    @staticmethod
+    def merge(stats_list):
+        """
+        Sum up dictionaries returned by CacheStats.to_dict().
+        """
+        merged = dict.fromkeys(CacheStats.COUNTERS, 0)
+        merged_groups = {}
+        for stats in stats_list:
+            for counter in CacheStats.COUNTERS:
+                merged[counter] += stats[counter]
+            for category, group_counters in stats['groups'].items():
+                merged_group_counters = merged_groups.setdefault(category, {})
+                for group, counters in group_counters.items():
+                    merged_counters = merged_group_counters.setdefault(group, dict.fromkeys(CacheStats.COUNTERS, 0))
+                    for counter in CacheStats.COUNTERS:
+                        merged_counters[counter] += counters[counter]
+        merged['groups'] = merged_groups
+        return merged
+
+
+def _get_cache_stats(cache, stats):
+    stats['size'] = cache.size
+    stats['num_items'] = cache.num_items
+    stats['capacity'] = cache.capacity
+    stats['max_size'] = cache.max_size
+    num_requests = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / num_requests if num_requests else None
+    if cache.parent_cache is not None:
+        stats['parent'] = cache.parent_cache.get_stats()
+    return stats
 
 
 class Cache:
@@ -96,6 +787,9 @@ class Cache:
         Cache-private class representing an item in the cache.
         """
 
+        __slots__ = ('key', 'stored_value', 'stored_size', 'creation_time', 'access_time', 'access_count',
+                     'cost', 'index_data')
+
         def __init__(self):
             self.key = None
             self.stored_value = None
@@ -103,19 +797,34 @@ class Cache:
             self.creation_time = 0
             self.access_time = 0
             self.access_count = 0
+            # the cost of computing the value, e.g. in seconds, or None if unknown
+            self.cost = None
+            # private to the cache's CacheIndex
+            self.index_data = None
 
         def access(self):
-            self.access_time = time.clock() - _T0
+            self.access_time = time.perf_counter() - _T0
             self.access_count += 1
 
-        def store(self, store, key, value):
+        def store(self, store, key, value, cost=None, access_count=1):
             self.key = key
-            self.access_count = 0
+            self.cost = cost
+            self.access_count = access_count - 1
             self.access()
+            self.creation_time = self.access_time
             stored_value, stored_size = store.store_value(key, value)
             self.stored_value = stored_value
             self.stored_size = stored_size
 
+        def init_stored(self, key, stored_value, stored_size, cost=None):
+            self.key = key
+            self.cost = cost
+            self.access_count = 0
+            self.access()
+            self.creation_time = self.access_time
+            self.stored_value = stored_value
+            self.stored_size = stored_size
+
         def restore(self, store, key):
             self.access()
             return store.restore_value(key, self.stored_value)
@@ -124,24 +833,33 @@ class Cache:
             store.discard_value(key, self.stored_value)
             self.__init__()
 
-    def __init__(self, store=MemoryCacheStore(), capacity=1000, threshold=0.75, policy=POLICY_LRU, parent_cache=None):
+    def __init__(self, store=MemoryCacheStore(), capacity=1000, threshold=0.75, policy=POLICY_LRU, parent_cache=None,
+                 admission=None, stats_group_func=None):
         """
         Constructor.
     
-        :param policy: cache replacement policy: LRU, MRU, LFU, or RR
+        :param policy: cache replacement policy: one of POLICY_LRU, POLICY_MRU, POLICY_LFU, POLICY_RR, POLICY_GDS,
+               or any function that computes a sort key for a given Cache.Item
         :param store: the cache store, see CacheStore interface
         :param capacity: the size capacity in units used by the store's store() method
         :param threshold: a number greater than zero and less than one
+        :param parent_cache: an optional parent cache which receives discarded values
+        :param admission: an optional admission filter, e.g. a TinyLfuAdmission instance
+        :param stats_group_func: an optional function that breaks down the cache statistics by groups of keys,
+               see CacheStats
         """
         self._store = store
         self._capacity = capacity
         self._threshold = threshold
         self._policy = policy
         self._parent_cache = parent_cache
+        self._admission = admission
+        self._snapshot = None
         self._size = 0
         self._max_size = self._capacity * self._threshold
         self._item_dict = {}
-        self._item_list = []
+        self._index = new_cache_index(policy)
+        self._stats = CacheStats(stats_group_func)
         self._lock = RLock()
 
     @property
@@ -152,6 +870,22 @@ class Cache:
     def store(self):
         return self._store
 
+    @property
+    def parent_cache(self):
+        return self._parent_cache
+
+    @property
+    def admission(self):
+        return self._admission
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @snapshot.setter
+    def snapshot(self, snapshot):
+        self._snapshot = snapshot
+
     @property
     def capacity(self):
         return self._capacity
@@ -168,90 +902,389 @@ class Cache:
     def max_size(self):
         return self._max_size
 
-    def get_value(self, key):
-        self._lock.acquire()
-        item = self._item_dict.get(key)
-        value = None
-        if item:
-            value = item.restore(self._store, key)
-        elif self._parent_cache:
-            item = self._parent_cache.get_value(key)
+    @property
+    def num_items(self):
+        return len(self._item_dict)
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def evicted_size(self):
+        """The total size of all items evicted so far, see CacheStats."""
+        return self._stats.get_counter('evicted_size')
+
+    def get_stats(self):
+        """
+        :return: a JSON-serializable dictionary of this cache's counters (see CacheStats), its current
+                 size, number of items, capacity, maximum size, hit ratio, and the statistics of the parent cache
+        """
+        return _get_cache_stats(self, self._stats.to_dict())
+
+    def get_value(self, key, record=True):
+        """
+        Get a value from this cache, the snapshot, or the parent cache.
+        :param key: the key
+        :param record: whether to record the access in the statistics and the admission filter
+        :return: the value or None
+        """
+        if record and self._admission is not None:
+            self._admission.record(key)
+        with self._lock:
+            item = self._item_dict.get(key)
             if item:
-                value = item.restore(self._parent_cache.store, key)
-        self._lock.release()
-        return value
-
-    def put_value(self, key, value):
-        self._lock.acquire()
-        if self._parent_cache:
-            # remove value from parent cache, because this cache will now take over
-            self._parent_cache.remove_value(key)
-        item = self._item_dict.get(key)
-        if item:
-            self._remove_item(item)
-            self._size -= item.stored_size
-            item.discard(self._store, key)
-        else:
-            item = Cache.Item()
-        item.store(self._store, key, value)
-        if self._size + item.stored_size > self._max_size:
-            self.trim(item.stored_size)
-        self._size += item.stored_size
-        self._add_item(item)
-        self._lock.release()
+                value = item.restore(self._store, key)
+                self._index.access(item)
+                if record:
+                    self._stats.record('hits', key)
+                return value
+        if record:
+            self._stats.record('misses', key)
+        if self._snapshot is not None:
+            snapshot_value = self._snapshot.pop_value(key)
+            if snapshot_value is not None:
+                value, access_count, cost = snapshot_value
+                self.put_value(key, value, cost=cost, access_count=access_count)
+                if record:
+                    self._stats.record('snapshot_hits', key)
+                return value
+        if self._parent_cache is not None:
+            value = self._parent_cache.get_value(key, record=record)
+            if record and value is not None:
+                self._stats.record('parent_hits', key)
+            return value
+        return None
+
+    def contains(self, key):
+        """
+        Test whether a value for the key is in this cache, the snapshot, or the parent cache, without accessing it,
+        i.e. without changing statistics, replacement order, snapshot or parent cache.
+        :param key: the key
+        :return: True, if get_value() would return a value for the key
+        """
+        with self._lock:
+            if key in self._item_dict:
+                return True
+        if self._snapshot is not None and self._snapshot.contains(key):
+            return True
+        return self._parent_cache is not None and self._parent_cache.contains(key)
+
+    def put_value(self, key, value, cost=None, access_count=1):
+        """
+        Put a value into this cache.
+        :param key: the key
+        :param value: the value
+        :param cost: optional cost of computing the value, e.g. in seconds, used by POLICY_GDS
+        :param access_count: the initial access count, e.g. when restoring a value from a snapshot
+        """
+        with self._lock:
+            if self._parent_cache is not None:
+                # remove value from parent cache, because this cache will now take over
+                self._parent_cache.remove_value(key)
+            item = self._item_dict.get(key)
+            is_new = item is None
+            if item:
+                self._remove_item(item)
+                self._size -= item.stored_size
+                item.discard(self._store, key)
+            else:
+                item = Cache.Item()
+            item.store(self._store, key, value, cost=cost, access_count=access_count)
+            self._stats.record('puts', key)
+            if self._size + item.stored_size > self._max_size:
+                if is_new and not self._admit(item):
+                    self._stats.record('rejections', key)
+                    item.discard(self._store, key)
+                    if self._parent_cache is not None:
+                        self._parent_cache.put_value(key, value, cost=cost)
+                    return
+                self.trim(item.stored_size)
+            self._size += item.stored_size
+            self._add_item(item)
 
     def remove_value(self, key):
-        self._lock.acquire()
-        if self._parent_cache:
-            self._parent_cache.remove_value(key)
-        item = self._item_dict.get(key)
-        if item:
-            self._remove_item(item)
-            self._size -= item.stored_size
-            item.discard(self._store, key)
-        self._lock.release()
+        with self._lock:
+            if self._parent_cache is not None:
+                self._parent_cache.remove_value(key)
+            item = self._item_dict.get(key)
+            if item:
+                self._remove_item(item)
+                self._size -= item.stored_size
+                item.discard(self._store, key)
+
+    def _admit(self, item):
+        if self._admission is None:
+            return True
+        victim = self._index.next_victim()
+        return victim is None or self._admission.admit(item.key, victim.key)
 
     def _add_item(self, item):
         self._item_dict[item.key] = item
-        self._item_list.append(item)
+        self._index.add(item)
 
     def _remove_item(self, item):
         self._item_dict.pop(item.key)
-        self._item_list.remove(item)
+        self._index.remove(item)
 
     def trim(self, extra_size=0):
-        self._lock.acquire()
-        self._item_list.sort(key=self._policy)
-        keys = []
-        size = self._size
-        max_size = self._max_size
-        for item in self._item_list:
-            if size + extra_size > max_size:
-                keys.append(item.key)
-                size -= item.stored_size
-        self._lock.release()
-        # release lock to give another thread a chance then require lock again
-        self._lock.acquire()
-        for key in keys:
-            if self._parent_cache:
-                # Before discarding item fully, put its value into the parent cache
-                value = self.get_value(key)
-                self.remove_value(key)
-                if value:
-                    self._parent_cache.put_value(key, value)
-            else:
-                self.remove_value(key)
-        self._lock.release()
+        with self._lock:
+            while self._size + extra_size > self._max_size:
+                item = self._index.next_victim()
+                if item is None:
+                    break
+                key = item.key
+                cost = item.cost
+                value = None
+                if self._parent_cache is not None:
+                    # Before discarding item fully, put its value into the parent cache
+                    value = self._store.restore_value(key, item.stored_value)
+                self._item_dict.pop(key)
+                self._index.discard(item)
+                self._size -= item.stored_size
+                self._stats.record('evictions', key)
+                self._stats.record('evicted_size', key, item.stored_size)
+                item.discard(self._store, key)
+                if value is not None:
+                    self._parent_cache.put_value(key, value, cost=cost)
+
+    def save_snapshot(self, file_path, max_size=None, get_source_path=None):
+        """
+        Write the most recently used values of type bytes into a snapshot file, see CacheSnapshot.
+        Values of a previously loaded snapshot that have not been requested yet are included as well.
+        The snapshot just written becomes this cache's snapshot.
+
+        :param file_path: the snapshot file
+        :param max_size: optional maximum total size in bytes of the values written
+        :param get_source_path: an optional function that returns the path of the source file a key depends on
+        :return: the number of values written
+        """
+        return _save_snapshot(self, [self], file_path, max_size, get_source_path)
+
+    def load_snapshot(self, file_path):
+        """
+        Open a snapshot file written by save_snapshot(). Values are read lazily, when they are requested
+        from this cache for the first time.
+        :param file_path: the snapshot file
+        :return: the snapshot, see CacheSnapshot
+        """
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = CacheSnapshot(file_path)
+        return self._snapshot
+
+    def get_hot_values(self):
+        """
+        :return: a list of (access_time, key, value, access_count, cost) tuples of all values of type bytes
+                 which the store keeps as they are
+        """
+        hot_values = []
+        with self._lock:
+            for key, item in self._item_dict.items():
+                if isinstance(item.stored_value, bytes):
+                    value = self._store.restore_value(key, item.stored_value)
+                    hot_values.append((item.access_time, key, value, item.access_count, item.cost))
+        return hot_values
+
+    def restore_stored_items(self, stored_items=None):
+        """
+        Add the values the store already holds to this cache, see CacheStore.get_stored_items().
+        Values exceeding this cache's maximum size are discarded.
+        :param stored_items: optional (key, stored_value, stored_size) tuples, defaults to the store's stored items
+        :return: the number of values added
+        """
+        if stored_items is None:
+            stored_items = self._store.get_stored_items()
+        count = 0
+        with self._lock:
+            for key, stored_value, stored_size in stored_items:
+                if key in self._item_dict:
+                    continue
+                item = Cache.Item()
+                item.init_stored(key, stored_value, stored_size)
+                self._size += item.stored_size
+                self._add_item(item)
+                count += 1
+            if self._size > self._max_size:
+                self.trim()
+        return count
 
     def clear(self, clear_parent=True):
-        self._lock.acquire()
-        if self._parent_cache and clear_parent:
-            self._parent_cache.clear(clear_parent)
-        keys = list(self._item_dict.keys())
-        self._lock.release()
+        with self._lock:
+            if self._parent_cache is not None and clear_parent:
+                self._parent_cache.clear(clear_parent)
+            keys = list(self._item_dict.keys())
         for key in keys:
-            if self._parent_cache and not clear_parent:
-                value = self.get_value(key)
-                if value:
-                    self._parent_cache.put_value(key, value)
+            value = None
+            if self._parent_cache is not None and not clear_parent:
+                value = self.get_value(key, record=False)
             self.remove_value(key)
+            if value is not None:
+                self._parent_cache.put_value(key, value)
+
+
+class ShardedCache:
+    """
+    A cache that distributes its keys over a number of independent Cache shards.
+    Each shard has its own lock and an equal slice of the total capacity, so that concurrent threads
+    accessing different keys rarely contend for the same lock.
+    Sizes are accounted per shard, therefore capacity limits and replacement policy hold approximately only.
+    """
+
+    def __init__(self, store=MemoryCacheStore(), capacity=1000, threshold=0.75, policy=POLICY_LRU, parent_cache=None,
+                 admission=None, stats_group_func=None, num_shards=16):
+        """
+        Constructor.
+
+        :param store: the cache store shared by all shards, see CacheStore interface
+        :param capacity: the total size capacity in units used by the store's store() method
+        :param threshold: a number greater than zero and less than one
+        :param policy: cache replacement policy applied within each shard, see Cache
+        :param parent_cache: an optional parent cache shared by all shards
+        :param admission: an optional TinyLfuAdmission filter, which is split into one filter per shard,
+               so that shards do not contend for a single filter lock, see TinyLfuAdmission.split()
+        :param stats_group_func: an optional function that breaks down the cache statistics by groups of keys,
+               see CacheStats
+        :param num_shards: the number of shards
+        """
+        if num_shards < 1:
+            raise ValueError('num_shards must be a positive integer')
+        self._store = store
+        self._capacity = capacity
+        self._threshold = threshold
+        self._policy = policy
+        self._parent_cache = parent_cache
+        self._admission = admission
+        shard_admissions = admission.split(num_shards) if admission is not None else [None] * num_shards
+        self._shards = [Cache(store=store,
+                              capacity=capacity / num_shards,
+                              threshold=threshold,
+                              policy=policy,
+                              parent_cache=parent_cache,
+                              admission=shard_admission,
+                              stats_group_func=stats_group_func) for shard_admission in shard_admissions]
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def parent_cache(self):
+        return self._parent_cache
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    @property
+    def size(self):
+        return sum(shard.size for shard in self._shards)
+
+    @property
+    def max_size(self):
+        return self._capacity * self._threshold
+
+    @property
+    def num_items(self):
+        return sum(shard.num_items for shard in self._shards)
+
+    @property
+    def evicted_size(self):
+        return sum(shard.evicted_size for shard in self._shards)
+
+    @property
+    def admission(self):
+        return self._admission
+
+    @property
+    def shards(self):
+        return list(self._shards)
+
+    def get_shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def get_stats(self):
+        """
+        :return: the statistics of all shards summed up, see Cache.get_stats()
+        """
+        return _get_cache_stats(self, CacheStats.merge([shard.stats.to_dict() for shard in self._shards]))
+
+    def get_value(self, key, record=True):
+        return self.get_shard(key).get_value(key, record=record)
+
+    def contains(self, key):
+        return self.get_shard(key).contains(key)
+
+    def put_value(self, key, value, cost=None, access_count=1):
+        self.get_shard(key).put_value(key, value, cost=cost, access_count=access_count)
+
+    def remove_value(self, key):
+        self.get_shard(key).remove_value(key)
+
+    def trim(self, extra_size=0):
+        extra_size_per_shard = extra_size / len(self._shards)
+        for shard in self._shards:
+            shard.trim(extra_size_per_shard)
+
+    @property
+    def snapshot(self):
+        return self._shards[0].snapshot
+
+    def save_snapshot(self, file_path, max_size=None, get_source_path=None):
+        return _save_snapshot(self, self._shards, file_path, max_size, get_source_path)
+
+    def load_snapshot(self, file_path):
+        snapshot = self.snapshot
+        if snapshot is not None:
+            snapshot.close()
+        snapshot = CacheSnapshot(file_path)
+        for shard in self._shards:
+            shard.snapshot = snapshot
+        return snapshot
+
+    def restore_stored_items(self, stored_items=None):
+        if stored_items is None:
+            stored_items = self._store.get_stored_items()
+        shard_items = [[] for _ in self._shards]
+        for stored_item in stored_items:
+            shard_items[hash(stored_item[0]) % len(self._shards)].append(stored_item)
+        return sum(shard.restore_stored_items(items) for shard, items in zip(self._shards, shard_items))
+
+    def clear(self, clear_parent=True):
+        for shard in self._shards:
+            shard.clear(clear_parent=clear_parent)
+
+
+def _save_snapshot(cache, caches, file_path, max_size, get_source_path):
+    hot_values = []
+    for c in caches:
+        hot_values.extend(c.get_hot_values())
+    hot_values.sort(key=lambda hot_value: hot_value[0], reverse=True)
+    values = [hot_value[1:] for hot_value in hot_values]
+
+    snapshot = cache.snapshot
+    if snapshot is not None:
+        # Values not requested since the snapshot was loaded are still hot enough
+        keys = {value[0] for value in values}
+        values.extend(value for value in snapshot.pop_all() if value[0] not in keys)
+        snapshot.close()
+
+    if max_size is not None:
+        size = 0
+        for i in range(len(values)):
+            size += len(values[i][1])
+            if size > max_size:
+                values = values[:i]
+                break
+
+    num_values = CacheSnapshot.write(file_path, values, get_source_path=get_source_path)
+    cache.load_snapshot(file_path)
+    return num_values
@@ -0,0 +1,268 @@
+"""
+A read layer for chunked HDF-5 datasets that keeps decoded chunks in a cache sized in bytes,
+independent of the HDF-5 library's own chunk cache.
+
+Tile reads of ChunkCachedArray are planned in terms of the chunks they touch, and tiles are assembled from the
+cached chunks, so that tiles whose boundaries don't line up with the chunk boundaries, or tiles of several
+pyramid levels, don't decompress the same chunks again and again.
+"""
+
+import itertools
+import os
+from threading import Lock
+
+import numpy as np
+
+from .cache import Cache, POLICY_LRU
+from .image import TileComputations
+from .tile_stores import MemoryTileCacheStore
+
+DEFAULT_CHUNK_CACHE_CAPACITY = 256 * 1024 * 1024
+
+_DEFAULT_CHUNK_CACHE = None
+
+# Coalesces concurrent decodes of the same chunk
+_CHUNK_DECODES = TileComputations()
+
+
+def set_default_chunk_cache(cache=None, no_cache=False, capacity=DEFAULT_CHUNK_CACHE_CAPACITY, threshold=0.75):
+    """
+    Set the chunk cache used by all ChunkCachedArray instances that have not been given an explicit one.
+
+    :param cache: the cache to be used; if None, a new in-memory LRU chunk cache is created
+    :param no_cache: if True, chunks will not be cached by default
+    :param capacity: capacity in bytes of a newly created cache
+    :param threshold: threshold of a newly created cache, see Cache
+    """
+    global _DEFAULT_CHUNK_CACHE
+    if no_cache:
+        _DEFAULT_CHUNK_CACHE = None
+    elif cache is None:
+        _DEFAULT_CHUNK_CACHE = Cache(MemoryTileCacheStore(), capacity=capacity, threshold=threshold,
+                                     policy=POLICY_LRU, stats_group_func=get_chunk_key_groups)
+    else:
+        _DEFAULT_CHUNK_CACHE = cache
+
+
+def get_default_chunk_cache():
+    global _DEFAULT_CHUNK_CACHE
+    return _DEFAULT_CHUNK_CACHE
+
+
+def get_chunk_key_groups(chunk_key):
+    """
+    Break down a chunk key into the groups used for cache statistics, see CacheStats.
+    :param chunk_key: a chunk key (array ID, chunk index)
+    :return: a tuple of ('array', array ID) pairs
+    """
+    return ('array', chunk_key[0]),
+
+
+class ChunkReadStats:
+    """
+    Counts the reads of all ChunkCachedArray instances and the chunks they took from the cache or decoded.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self._num_reads = 0
+        self._num_direct_reads = 0
+        self._num_chunk_hits = 0
+        self._num_chunk_decodes = 0
+        self._max_chunk_decodes_per_read = 0
+
+    def record_direct_read(self):
+        with self._lock:
+            self._num_direct_reads += 1
+
+    def record_read(self, num_chunk_hits, num_chunk_decodes):
+        with self._lock:
+            self._num_reads += 1
+            self._num_chunk_hits += num_chunk_hits
+            self._num_chunk_decodes += num_chunk_decodes
+            self._max_chunk_decodes_per_read = max(self._max_chunk_decodes_per_read, num_chunk_decodes)
+
+    def get_stats(self):
+        """
+        :return: a dictionary with the number of reads assembled from chunks and of reads passed to the array,
+                 the number of chunks taken from the cache and decoded, and the mean and maximum number of
+                 chunks decoded per read, i.e. typically per tile
+        """
+        with self._lock:
+            return dict(num_reads=self._num_reads,
+                        num_direct_reads=self._num_direct_reads,
+                        num_chunk_hits=self._num_chunk_hits,
+                        num_chunk_decodes=self._num_chunk_decodes,
+                        chunk_decodes_per_read=self._num_chunk_decodes / self._num_reads if self._num_reads else 0.0,
+                        max_chunk_decodes_per_read=self._max_chunk_decodes_per_read)
+
+
+_CHUNK_READ_STATS = ChunkReadStats()
+
+
+def get_chunk_read_stats():
+    """
+    :return: statistics about the reads of all ChunkCachedArray instances, see ChunkReadStats.get_stats()
+    """
+    return _CHUNK_READ_STATS.get_stats()
+
+
+class ChunkCachedArray:
+    """
+    A numpy-like, read-only wrapper of a chunked array, e.g. a H5Py dataset object, whose 2D subscripts
+    array[..., y0:y1:step_y, x0:x1:step_x], also with indexes of the leading dimensions, e.g.
+    array[t, y0:y1:step_y, x0:x1:step_x], are assembled from whole chunks kept in a chunk cache.
+    Other subscripts, and subscripts whose chunks would take more than a quarter of the cache's capacity,
+    are passed to the wrapped array. Other attributes, such as fillvalue, file or name, are the wrapped array's.
+    """
+
+    def __init__(self, array, chunk_cache=None, array_id=None):
+        """
+        Constructor.
+        :param array: a chunked numpy-like array, e.g. a H5Py dataset object
+        :param chunk_cache: an optional chunk cache of type Cache, default is the default chunk cache
+        :param array_id: an optional ID used for the chunk keys, default is derived from the H5Py dataset's file,
+               its modification time, and the dataset name
+        """
+        if not array.chunks:
+            raise ValueError('array is not chunked')
+        self._array = array
+        self._chunk_cache = chunk_cache if chunk_cache is not None else get_default_chunk_cache()
+        if array_id is None:
+            file_path = array.file.filename
+            array_id = '%s|%s|%s' % (file_path, array.name, os.path.getmtime(file_path))
+        self._array_id = array_id
+        self._chunk_nbytes = int(np.prod(array.chunks)) * array.dtype.itemsize
+
+    @property
+    def array(self):
+        return self._array
+
+    @property
+    def chunk_cache(self):
+        return self._chunk_cache
+
+    @property
+    def shape(self):
+        return self._array.shape
+
+    @property
+    def dtype(self):
+        return self._array.dtype
+
+    @property
+    def chunks(self):
+        return self._array.chunks
+
+    def __len__(self):
+        return len(self._array)
+
+    def __getattr__(self, name):
+        return getattr(self._array, name)
+
+    def __getitem__(self, key):
+        ranges, result_shape = self._get_ranges(key)
+        if ranges is None or self._chunk_cache is None:
+            return self._array[key]
+        axis_plans = [_plan_axis_chunks(start, stop, step, chunk_length)
+                      for (start, stop, step), chunk_length in zip(ranges, self._array.chunks)]
+        num_chunks = 1
+        for axis_plan in axis_plans:
+            num_chunks *= len(axis_plan)
+        if num_chunks == 0 or num_chunks * self._chunk_nbytes > self._chunk_cache.capacity // 4:
+            # Don't flush the cache for a single read
+            _CHUNK_READ_STATS.record_direct_read()
+            return self._array[key]
+
+        shape = tuple(len(range(start, stop, step)) for start, stop, step in ranges)
+        result = np.empty(shape, dtype=self._array.dtype)
+        num_chunk_hits = 0
+        num_chunk_decodes = 0
+        for chunk_plan in itertools.product(*axis_plans):
+            chunk_index = tuple(chunk_coord for chunk_coord, _, _ in chunk_plan)
+            chunk, decoded = self._get_chunk(chunk_index)
+            if decoded:
+                num_chunk_decodes += 1
+            else:
+                num_chunk_hits += 1
+            result[tuple(result_slice for _, result_slice, _ in chunk_plan)] = \
+                chunk[tuple(chunk_slice for _, _, chunk_slice in chunk_plan)]
+        _CHUNK_READ_STATS.record_read(num_chunk_hits, num_chunk_decodes)
+        return result.reshape(result_shape)
+
+    def _get_ranges(self, key):
+        # The (start, stop, step) ranges of all axes and the result's shape, without the axes of indexes,
+        # for subscripts of the form [..., y-slice, x-slice] and [i, ..., :, y-slice, x-slice], or (None, None)
+        shape = self._array.shape
+        if not isinstance(key, tuple) or len(shape) < 2:
+            return None, None
+        if len(key) == 3 and key[0] is Ellipsis:
+            key = (slice(None),) * (len(shape) - 2) + key[1:]
+        if len(key) != len(shape) or not all(isinstance(k, slice) for k in key[-2:]):
+            return None, None
+        ranges = []
+        result_shape = []
+        for k, size in zip(key, shape):
+            if isinstance(k, slice):
+                k_range = k.indices(size)
+                result_shape.append(len(range(*k_range)))
+            elif isinstance(k, (int, np.integer)) and -size <= k < size:
+                k = int(k) % size
+                k_range = k, k + 1, 1
+            else:
+                return None, None
+            ranges.append(k_range)
+        if any(step < 1 for _, _, step in ranges):
+            return None, None
+        return ranges, tuple(result_shape)
+
+    def _get_chunk(self, chunk_index):
+        """
+        :return: a tuple (chunk, decoded), where decoded is True if this call has decoded the chunk
+        """
+        chunk_key = (self._array_id, chunk_index)
+        chunk = self._chunk_cache.get_value(chunk_key)
+        if chunk is not None:
+            return chunk, False
+        decoded = []
+
+        def decode_chunk():
+            # The chunk may have been decoded since our last look into the cache
+            cached_chunk = self._chunk_cache.get_value(chunk_key, record=False)
+            if cached_chunk is not None:
+                return cached_chunk
+            chunks = self._array.chunks
+            new_chunk = self._array[tuple(slice(chunk_coord * chunk_length, (chunk_coord + 1) * chunk_length)
+                                          for chunk_coord, chunk_length in zip(chunk_index, chunks))]
+            # Chunks are shared by all reads
+            new_chunk.flags.writeable = False
+            self._chunk_cache.put_value(chunk_key, new_chunk)
+            decoded.append(True)
+            return new_chunk
+
+        chunk = _CHUNK_DECODES.compute(chunk_key, decode_chunk)
+        return chunk, bool(decoded)
+
+
+def _plan_axis_chunks(start, stop, step, chunk_length):
+    """
+    Plan the reads of the positions range(start, stop, step) of an axis of chunks of the given length.
+    :return: a list of tuples (chunk_coord, result_slice, chunk_slice), one for each chunk that contains a position
+    """
+    plan = []
+    result_pos = 0
+    pos = start
+    while pos < stop:
+        chunk_coord = pos // chunk_length
+        chunk_start = chunk_coord * chunk_length
+        count = (min(chunk_start + chunk_length, stop) - pos + step - 1) // step
+        chunk_pos = pos - chunk_start
+        plan.append((chunk_coord,
+                     slice(result_pos, result_pos + count),
+                     slice(chunk_pos, chunk_pos + (count - 1) * step + 1, step)))
+        result_pos += count
+        pos += count * step
+    return plan
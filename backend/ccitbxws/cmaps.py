@@ -120,3 +120,171 @@ def get_cmaps():
         #import pprint
         #pprint.pprint(_CMAPS)
     return _CMAPS
+
+
+class ColorMapper:
+    """
+    Maps data values to RGBA colors using a lookup table (LUT) of a matplotlib colormap.
+
+    The colormap's colors are precomputed as a uint8 RGBA table with one extra, transparent entry for
+    no-data values (NaN, masked or equal to a given no-data value). Values are turned into table indices
+    in one vectorized pass and colors are gathered with np.take() directly into the output array,
+    which avoids the masked array and float64 temporaries of calling the colormap itself.
+    Data of 8 or 16 bit integer types are mapped by a single gather from a table holding the colors of all possible
+    values, which is computed once per data type and value range.
+    Indices are computed like matplotlib does, so that the result equals that of cmap(normalized_array, bytes=True)
+    with the bad color set to transparent.
+    """
+
+    def __init__(self, cmap_name, num_colors=256):
+        cmap = cm.get_cmap(cmap_name, num_colors)
+        lut = np.zeros((num_colors + 1, 4), dtype=np.uint8)
+        lut[:num_colors] = cmap(np.arange(num_colors), bytes=True)
+        self._cmap_name = cmap_name
+        self._num_colors = num_colors
+        self._lut = lut
+        # Gather whole pixels by viewing each RGBA entry as one 32-bit integer
+        self._lut32 = lut.view(np.uint32).reshape((num_colors + 1,))
+        self._value_tables = {}
+        # Many colormaps have duplicate colors when quantized to bytes, so that a palette
+        # of at most 256 distinct colors often covers all colors and the transparent one
+        palette_colors, palette_indices = np.unique(self._lut32, return_inverse=True)
+        if len(palette_colors) <= 256:
+            self._palette_lut = palette_colors.view(np.uint8).reshape((-1, 4))
+            self._palette_indices = palette_indices.astype(np.uint8)
+        else:
+            self._palette_lut = None
+            self._palette_indices = None
+
+    @property
+    def cmap_name(self):
+        return self._cmap_name
+
+    @property
+    def num_colors(self):
+        return self._num_colors
+
+    @property
+    def lut(self):
+        """The RGBA lookup table of shape (num_colors + 1, 4), the last entry is the transparent no-data color."""
+        return self._lut
+
+    @property
+    def is_opaque(self):
+        """True, if all colors of the colormap are opaque, so that only no-data values are transparent."""
+        return bool(np.all(self._lut[:self._num_colors, 3] == 255))
+
+    def get_indices(self, array, value_range, no_data_value=None):
+        """
+        Compute the lookup table indices of the given values.
+        :param array: a numpy array or masked array
+        :param value_range: the (min, max) value range mapped to the colormap, values outside are clipped
+        :param no_data_value: an optional value which, like NaN and masked values, is mapped to the no-data index
+        :return: an index array of the shape of the given array
+        """
+        value_min, value_max = value_range
+        num_colors = self._num_colors
+        data = np.ma.getdata(array)
+        # Compute in single precision if it represents the values exactly, like matplotlib would for float32 data
+        if data.dtype == np.float32 or (data.dtype.kind in 'biuf' and data.dtype.itemsize <= 2):
+            work_dtype = np.float32
+        else:
+            work_dtype = np.float64
+
+        values = np.subtract(data, value_min, dtype=work_dtype)
+        # Values above value_max end up at the last index, np.clip() would be slower
+        np.maximum(values, work_dtype(0), out=values)
+        if value_max > value_min:
+            values *= work_dtype(1.0 / (value_max - value_min))
+            values *= work_dtype(num_colors)
+        else:
+            values[...] = 0
+        np.minimum(values, work_dtype(num_colors - 1), out=values)
+
+        no_data = np.ma.getmask(array)
+        if data.dtype.kind == 'f':
+            no_data = np.logical_or(no_data, np.isnan(data))
+        if no_data_value is not None:
+            no_data = np.logical_or(no_data, data == no_data_value)
+        if no_data is not np.ma.nomask:
+            np.putmask(values, no_data, num_colors)
+        return values.astype(np.intp)
+
+    def map(self, array, value_range, no_data_value=None, out=None):
+        """
+        Map values to RGBA colors.
+        :param array: a numpy array or masked array
+        :param value_range: the (min, max) value range mapped to the colormap, values outside are clipped
+        :param no_data_value: an optional value which, like NaN and masked values, is mapped to transparent
+        :param out: an optional C-contiguous uint8 output array of shape array.shape + (4,)
+        :return: a uint8 RGBA array of shape array.shape + (4,)
+        """
+        data = np.ma.getdata(array)
+        if out is None:
+            out = np.empty(data.shape + (4,), dtype=np.uint8)
+        out32 = out.view(np.uint32).reshape(data.shape)
+        if data.dtype.kind in 'biu' and data.dtype.itemsize <= 2:
+            value_table = self._get_value_table(data.dtype, value_range, no_data_value)
+            np.take(value_table, data.view(np.uint8 if data.dtype.itemsize == 1 else np.uint16), out=out32)
+            mask = np.ma.getmask(array)
+            if mask is not np.ma.nomask:
+                np.putmask(out32, mask, self._lut32[self._num_colors])
+        else:
+            indices = self.get_indices(array, value_range, no_data_value=no_data_value)
+            np.take(self._lut32, indices, out=out32)
+        return out
+
+    def map_to_palette_image(self, array, value_range, no_data_value=None):
+        """
+        Map values to a palette (mode 'P') PIL image whose palette holds the colors used and whose
+        'transparency' info holds their alpha values, so that it can be saved as an 8-bit PNG with a tRNS chunk.
+        The image decodes to the same RGBA pixels as returned by map().
+        :param array: a numpy array or masked array
+        :param value_range: the (min, max) value range mapped to the colormap, values outside are clipped
+        :param no_data_value: an optional value which, like NaN and masked values, is mapped to transparent
+        :return: a PIL image or None, if more than 256 different colors are used
+        """
+        indices = self.get_indices(array, value_range, no_data_value=no_data_value)
+        if self._palette_lut is not None:
+            lut = self._palette_lut
+            indices = np.take(self._palette_indices, indices)
+        else:
+            # Only the colors actually used go into the palette
+            used = np.bincount(indices.ravel(), minlength=len(self._lut)) > 0
+            if np.count_nonzero(used) > 256:
+                return None
+            lut = self._lut[used]
+            indices = np.take((np.cumsum(used) - 1).astype(np.uint8), indices)
+        image = Image.fromarray(indices, mode='P')
+        image.putpalette(lut[:, :3].tobytes(), rawmode='RGB')
+        image.info['transparency'] = lut[:, 3].tobytes()
+        return image
+
+    def _get_value_table(self, dtype, value_range, no_data_value):
+        key = dtype.str, tuple(value_range), no_data_value
+        value_table = self._value_tables.get(key)
+        if value_table is None:
+            num_values = 1 << (8 * dtype.itemsize)
+            # All values of the data type, ordered by their unsigned bit patterns
+            values = np.arange(num_values, dtype=np.uint8 if num_values == 256 else np.uint16).view(dtype)
+            value_table = self._lut32[self.get_indices(values, value_range, no_data_value=no_data_value)]
+            if len(self._value_tables) >= 16:
+                self._value_tables.clear()
+            self._value_tables[key] = value_table
+        return value_table
+
+
+_COLOR_MAPPERS = {}
+
+
+def get_color_mapper(cmap_name, num_colors=256):
+    """
+    :return: a shared ColorMapper instance for the given colormap name and number of colors
+    """
+    key = cmap_name, num_colors
+    color_mapper = _COLOR_MAPPERS.get(key)
+    if color_mapper is None:
+        color_mapper = ColorMapper(cmap_name, num_colors=num_colors)
+        with _LOCK:
+            color_mapper = _COLOR_MAPPERS.setdefault(key, color_mapper)
+    return color_mapper
@@ -1,11 +1,26 @@
 import numpy as np
+from ..chunk_cache import ChunkCachedArray, get_default_chunk_cache
 from ..image import OpImage, ImagePyramid, create_ndarray_downsampling_image
 from ..utils import compute_tile_size
 
 
 class H5PyDatasetImage(OpImage):
-    def __init__(self, h5_dataset, tile_size=None):
+    def __init__(self, h5_dataset, tile_size=None, chunk_cache=None, index=None):
+        """
+        Constructor.
+        :param h5_dataset: the H5Py dataset object
+        :param tile_size: an optional tuple (tile_width, tile_height), default is derived from the chunk size
+        :param chunk_cache: an optional chunk cache, see ChunkCachedArray
+        :param index: an optional tuple of indexes into the leading dimensions of the dataset, e.g. (time, depth),
+               so that only the selected 2D slice is read. If None, tiles have all leading dimensions.
+        """
         self._h5_dataset = h5_dataset
+        self._index = tuple(index) if index is not None else (slice(None),) * (len(h5_dataset.shape) - 2)
+        if chunk_cache is None:
+            chunk_cache = get_default_chunk_cache()
+        # Chunked datasets are read through the chunk cache, so that tiles don't decode shared chunks again
+        self._reader = ChunkCachedArray(h5_dataset, chunk_cache=chunk_cache) \
+            if chunk_cache is not None and h5_dataset.chunks else h5_dataset
         width, height = h5_dataset.shape[-1], h5_dataset.shape[-2]
         if tile_size is None:
             if h5_dataset.chunks:
@@ -23,8 +38,8 @@ class H5PyDatasetImage(OpImage):
 
     def compute_tile(self, tile_x, tile_y, rectangle):
         x, y, w, h = rectangle
-        tile = self._h5_dataset[:, y:y + h, x:x + w]
-        _, dh, dw = tile.shape
+        tile = self._reader[self._index + (slice(y, y + h), slice(x, x + w))]
+        dh, dw = tile.shape[-2:]
         fill_value = self._h5_dataset.fillvalue
 
         if dh < h or dw < w:
@@ -36,8 +51,8 @@ class H5PyDatasetImage(OpImage):
                     background_value = np.nan
                 else:
                     background_value = 0
-            new_data = np.full((1, h, w), background_value, dtype=tile.dtype)
-            new_data[:, 0:dh, 0:dw] = tile
+            new_data = np.full(tile.shape[:-2] + (h, w), background_value, dtype=tile.dtype)
+            new_data[..., 0:dh, 0:dw] = tile
             tile = new_data
 
         if not np.ma.is_masked(tile):
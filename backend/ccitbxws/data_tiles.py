@@ -0,0 +1,143 @@
+"""
+Binary data tiles, which carry the (quantized) values of a tile instead of its colors, so that clients can color-map,
+threshold and probe tiles themselves.
+
+A data tile consists of
+  * the magic bytes DATA_TILE_MAGIC,
+  * the length of the header as little-endian uint32,
+  * the header, a UTF-8 encoded JSON object with the keys
+    'version', 'dtype' and 'shape' of the values, 'scale', 'offset', 'noData', 'compression' and
+    'min', 'max', the range of the tile's valid values, or null if there are none,
+  * the zlib-compressed, little-endian values.
+
+Values of the integer types are decoded as offset + scale * value, values equal to noData are no-data.
+Values of type float16 are the values themselves, no-data values are NaN, and noData is null.
+"""
+
+import json
+import struct
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from .image import DecoratorImage
+
+DATA_TILE_MAGIC = b'CCDT'
+DATA_TILE_VERSION = 1
+DEFAULT_COMPRESS_LEVEL = 1
+
+# Quantized types and their no-data values
+DATA_TILE_DTYPES = OrderedDict([('uint8', 255),
+                                ('uint16', 65535),
+                                ('float16', None)])
+
+_FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+def encode_data_tile(tile, dtype='uint16', value_range=None, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Quantize and encode a tile.
+
+    :param tile: a 2D numpy array or masked array, masked and non-finite values are no-data
+    :param dtype: one of the keys of DATA_TILE_DTYPES
+    :param value_range: an optional (min, max) range of the quantized values, values outside are clipped,
+           default is the range of the tile's valid values
+    :param compress_level: zlib compression level, 0 (none) to 9 (best)
+    :return: the data tile as bytes
+    """
+    if dtype not in DATA_TILE_DTYPES:
+        raise ValueError('illegal data tile type %r, must be one of %s' % (dtype, ', '.join(DATA_TILE_DTYPES.keys())))
+    data = np.ma.getdata(tile).astype(np.float64)
+    valid = np.isfinite(data)
+    mask = np.ma.getmask(tile)
+    if mask is not np.ma.nomask:
+        valid &= ~mask
+    any_valid = bool(valid.any())
+    valid_min = float(data[valid].min()) if any_valid else None
+    valid_max = float(data[valid].max()) if any_valid else None
+
+    no_data = DATA_TILE_DTYPES[dtype]
+    if dtype == 'float16':
+        scale, offset = 1.0, 0.0
+        values = np.where(valid, np.clip(data, -_FLOAT16_MAX, _FLOAT16_MAX), np.nan).astype('<f2')
+    else:
+        value_min, value_max = value_range if value_range is not None else (valid_min, valid_max)
+        if value_min is None or value_max is None or not value_max > value_min:
+            scale = 1.0
+        else:
+            # The largest code is reserved for no-data
+            scale = (value_max - value_min) / (no_data - 1)
+        offset = value_min if value_min is not None else 0.0
+        codes = np.zeros(data.shape, dtype=np.float64)
+        np.subtract(data, offset, out=codes, where=valid)
+        codes /= scale
+        np.clip(np.rint(codes), 0, no_data - 1, out=codes)
+        codes[~valid] = no_data
+        values = codes.astype('<u1' if dtype == 'uint8' else '<u2')
+
+    header = json.dumps(dict(version=DATA_TILE_VERSION,
+                             dtype=dtype,
+                             shape=list(values.shape),
+                             scale=scale,
+                             offset=offset,
+                             noData=no_data,
+                             compression='zlib',
+                             min=valid_min,
+                             max=valid_max)).encode('utf-8')
+    return DATA_TILE_MAGIC + struct.pack('<I', len(header)) + header \
+           + zlib.compress(np.ascontiguousarray(values).tobytes(), compress_level)
+
+
+def decode_data_tile(data_tile):
+    """
+    Decode a data tile.
+    :param data_tile: the data tile as bytes, see encode_data_tile()
+    :return: a (header, values) tuple, where values is a masked float array of the decoded values
+    """
+    if data_tile[:4] != DATA_TILE_MAGIC:
+        raise ValueError('not a data tile')
+    header_length, = struct.unpack('<I', data_tile[4:8])
+    header = json.loads(data_tile[8:8 + header_length].decode('utf-8'))
+    if header['version'] != DATA_TILE_VERSION:
+        raise ValueError('unsupported data tile version %s' % header['version'])
+    dtype = {'uint8': '<u1', 'uint16': '<u2', 'float16': '<f2'}[header['dtype']]
+    values = np.frombuffer(zlib.decompress(data_tile[8 + header_length:]), dtype=dtype).reshape(header['shape'])
+    if header['noData'] is None:
+        return header, np.ma.masked_invalid(values.astype(np.float32))
+    decoded_values = header['offset'] + header['scale'] * values.astype(np.float64)
+    return header, np.ma.array(decoded_values, mask=values == header['noData'])
+
+
+class QuantizedDataImage(DecoratorImage):
+    """
+    Encodes the tiles of a source image that provides tiles as numpy-like arrays, e.g. a TransformArrayImage
+    of a data pyramid, as data tiles, see encode_data_tile(). Source tiles with a single-element leading dimension
+    become 2D data tiles.
+    """
+
+    def __init__(self, source_image, dtype='uint16', value_range=None, compress_level=DEFAULT_COMPRESS_LEVEL,
+                 image_id=None, tile_cache=None):
+        """
+        Constructor.
+        :param source_image: the source image
+        :param dtype: one of the keys of DATA_TILE_DTYPES
+        :param value_range: an optional (min, max) range of the quantized values, default is per tile
+        :param compress_level: zlib compression level, 0 (none) to 9 (best)
+        :param image_id: an optional ID primarily used for caching
+        :param tile_cache: an optional tile cache, see Cache type
+        """
+        if dtype not in DATA_TILE_DTYPES:
+            raise ValueError('illegal data tile type %r, must be one of %s'
+                             % (dtype, ', '.join(DATA_TILE_DTYPES.keys())))
+        super().__init__(source_image, format='CCDT', mode=dtype, image_id=image_id, tile_cache=tile_cache)
+        self._dtype = dtype
+        self._value_range = value_range
+        self._compress_level = compress_level
+
+    def compute_tile_from_source_tile(self, tile_x, tile_y, rectangle, source_tile):
+        shape = source_tile.shape
+        if len(shape) > 2 and int(np.prod(shape[:-2])) == 1:
+            source_tile = np.reshape(source_tile, shape[-2:])
+        return encode_data_tile(source_tile, dtype=self._dtype, value_range=self._value_range,
+                                compress_level=self._compress_level)
@@ -1,42 +1,73 @@
 import io
-import sys
+import re
+import time
 import uuid
+import zlib
 from abc import ABCMeta, abstractmethod, abstractproperty
+from collections import OrderedDict
+from threading import Event, Lock
 
-import matplotlib.cm as cm
 import numpy as np
 from PIL import Image
 
-from .cache import Cache, MemoryCacheStore
+from .cache import Cache, ShardedCache, POLICY_LRU
+from .cmaps import get_color_mapper
+from .pyramid_sidecar import open_pyramid_sidecar
+from .tile_stores import MemoryTileCacheStore, CompressedTileCacheStore, FileTileCacheStore, get_shared_tile, \
+    MAX_NUM_SHARED_TILES
 from .utils import *
 
 _DEFAULT_TILE_CACHE = None
 
+_LEVEL_PATTERN = re.compile(r'-L(\d+)')
 
-class MemoryTileCacheStore(MemoryCacheStore):
-    def store_value(self, key, tile):
-        if hasattr(tile, 'nbytes'):
-            # A numpy ndarray instance
-            size = tile.nbytes
-        elif hasattr(tile, 'size') and hasattr(tile, 'mode'):
-            # A PIL Image instance
-            w, h = tile.size
-            m = tile.mode
-            size = w * h * (4 if m in ('RGBA', 'RGBx', 'I', 'F') else
-                            3 if m in ('RGB', 'YCbCr', 'LAB', 'HSV') else
-                            1. / 8. if m == '1' else
-                            1)
-        else:
-            size = sys.getsizeof(tile)
-        return tile, size
+# zlib strategies for encoding PNG tiles, see ColorMappedRgbaImage
+PNG_COMPRESS_TYPES = OrderedDict([('default', zlib.Z_DEFAULT_STRATEGY),
+                                  ('filtered', zlib.Z_FILTERED),
+                                  ('huffman', zlib.Z_HUFFMAN_ONLY),
+                                  ('rle', zlib.Z_RLE),
+                                  ('fixed', zlib.Z_FIXED)])
 
 
-def set_default_tile_cache(cache=None, no_cache=False, capacity=64 * 1024 * 1024, threshold=0.75):
+def set_default_tile_cache(cache=None, no_cache=False, capacity=64 * 1024 * 1024, threshold=0.75,
+                           policy=POLICY_LRU, admission=None, num_shards=1, compress=False,
+                           disk_cache_dir=None, disk_cache_capacity=1024 ** 3):
+    """
+    Set the tile cache used by all OpImage instances that have not been given an explicit one.
+
+    :param cache: the cache to be used; if None, a new in-memory tile cache is created
+    :param no_cache: if True, tiles will not be cached by default
+    :param capacity: capacity in bytes of a newly created cache
+    :param threshold: threshold of a newly created cache, see Cache
+    :param policy: replacement policy of a newly created cache, see Cache
+    :param admission: admission filter of a newly created cache, e.g. a TinyLfuAdmission instance, see Cache
+    :param num_shards: if greater than one, a ShardedCache with the given number of shards is created
+           so that concurrent tile requests rarely contend for the same lock
+    :param compress: if True, a newly created cache keeps ndarray tiles compressed, see CompressedTileCacheStore
+    :param disk_cache_dir: if given, tiles evicted from a newly created cache are moved into a parent cache
+           that stores them in this directory, see FileTileCacheStore
+    :param disk_cache_capacity: capacity in bytes of the parent cache given by disk_cache_dir
+
+    The statistics of a newly created cache are broken down by pyramid level and image, see get_tile_id_groups().
+    """
     global _DEFAULT_TILE_CACHE
     if no_cache:
         _DEFAULT_TILE_CACHE = None
     elif cache is None:
-        _DEFAULT_TILE_CACHE = Cache(MemoryTileCacheStore(), capacity=capacity, threshold=threshold)
+        parent_cache = None
+        if disk_cache_dir:
+            parent_cache = Cache(FileTileCacheStore(disk_cache_dir), capacity=disk_cache_capacity,
+                                 threshold=threshold, policy=policy, stats_group_func=get_tile_id_groups)
+            parent_cache.restore_stored_items()
+        store = CompressedTileCacheStore() if compress else MemoryTileCacheStore()
+        if num_shards > 1:
+            _DEFAULT_TILE_CACHE = ShardedCache(store, capacity=capacity, threshold=threshold,
+                                               policy=policy, parent_cache=parent_cache, admission=admission,
+                                               stats_group_func=get_tile_id_groups, num_shards=num_shards)
+        else:
+            _DEFAULT_TILE_CACHE = Cache(store, capacity=capacity, threshold=threshold,
+                                        policy=policy, parent_cache=parent_cache, admission=admission,
+                                        stats_group_func=get_tile_id_groups)
     else:
         _DEFAULT_TILE_CACHE = cache
 
@@ -46,6 +77,124 @@ def get_default_tile_cache():
     return _DEFAULT_TILE_CACHE
 
 
+def get_tile_id_groups(tile_id):
+    """
+    Break down a tile ID into the groups used for cache statistics, see CacheStats.
+    The image group is the image ID without its pyramid level, so that all levels of a pyramid are counted together.
+
+    :param tile_id: a tile ID as returned by TiledImage.get_tile_id()
+    :return: a tuple of ('image', image group) and, if the image is a pyramid level, ('level', level) pairs
+    """
+    if not isinstance(tile_id, str):
+        return ()
+    image_id = tile_id.rsplit('/', 2)[0]
+    level_matches = list(_LEVEL_PATTERN.finditer(image_id))
+    if not level_matches:
+        return ('image', image_id),
+    level_match = level_matches[-1]
+    image_group = image_id[:level_match.start()] + image_id[level_match.end():]
+    return ('image', image_group), ('level', level_match.group(1))
+
+
+class TileComputations:
+    """
+    Coalesces concurrent computations of the same tile:
+    the first caller computes the tile, later callers for the same tile ID wait for and share its result.
+    If the computation fails, the error is raised in all callers.
+    """
+
+    class Computation:
+        __slots__ = ('event', 'tile', 'error')
+
+        def __init__(self):
+            self.event = Event()
+            self.tile = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = Lock()
+        self._computations = {}
+        self._num_computed = 0
+        self._num_coalesced = 0
+
+    def compute(self, tile_id, compute_tile):
+        """
+        Compute a tile unless it is already being computed.
+        :param tile_id: the tile ID
+        :param compute_tile: a function without arguments that computes the tile
+        :return: the tile
+        """
+        with self._lock:
+            computation = self._computations.get(tile_id)
+            if computation is None:
+                computation = TileComputations.Computation()
+                self._computations[tile_id] = computation
+                self._num_computed += 1
+                is_owner = True
+            else:
+                self._num_coalesced += 1
+                is_owner = False
+
+        if not is_owner:
+            computation.event.wait()
+            if computation.error is not None:
+                raise computation.error
+            return computation.tile
+
+        try:
+            computation.tile = compute_tile()
+            return computation.tile
+        except BaseException as error:
+            computation.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._computations[tile_id]
+            computation.event.set()
+
+    def get_stats(self):
+        """
+        :return: a dictionary with the number of tile computations performed, the number of
+                 computations saved by coalescing, and the number of computations in progress
+        """
+        with self._lock:
+            return dict(num_computed=self._num_computed,
+                        num_coalesced=self._num_coalesced,
+                        num_in_progress=len(self._computations))
+
+
+_TILE_COMPUTATIONS = TileComputations()
+
+
+def get_tile_computation_stats():
+    """
+    :return: statistics about tile computations of all OpImage instances, see TileComputations.get_stats()
+    """
+    return _TILE_COMPUTATIONS.get_stats()
+
+
+# Encoded, fully transparent tiles of ColorMappedRgbaImage instances, see is_empty_tile(). Tiles are compared
+# by value, so that copies, e.g. from a shared memory or disk cache, are recognized, too. There is one empty tile
+# per tile format, encoding and size, but like shared tiles, no more than MAX_NUM_EMPTY_TILES are kept.
+_EMPTY_TILES = set()
+_EMPTY_TILES_LOCK = Lock()
+MAX_NUM_EMPTY_TILES = MAX_NUM_SHARED_TILES
+
+
+def _add_empty_tile(tile):
+    with _EMPTY_TILES_LOCK:
+        if len(_EMPTY_TILES) < MAX_NUM_EMPTY_TILES:
+            _EMPTY_TILES.add(tile)
+
+
+def is_empty_tile(tile):
+    """
+    :return: True, if the given tile is an encoded, fully transparent tile of a ColorMappedRgbaImage,
+             e.g. a tile of an ocean variable that lies completely over land
+    """
+    return isinstance(tile, bytes) and tile in _EMPTY_TILES
+
+
 class TiledImage(metaclass=ABCMeta):
     """
     The interface for tiled images.
@@ -128,7 +277,7 @@ class AbstractTiledImage(TiledImage, metaclass=ABCMeta):
         self._tile_height = tile_size[1] if tile_size else compute_tile_size(self._height)
         self._num_tiles_x = num_tiles[0] if num_tiles else cardinal_div_round(self._width, self._tile_width)
         self._num_tiles_y = num_tiles[1] if num_tiles else cardinal_div_round(self._height, self._tile_height)
-        self._id = image_id if image_id else str(uuid.uuid4)
+        self._id = image_id if image_id else str(uuid.uuid4())
         self._mode = mode
         self._format = format
 
@@ -184,17 +333,28 @@ class OpImage(AbstractTiledImage, metaclass=ABCMeta):
         return self._tile_cache
 
     def get_tile(self, tile_x, tile_y):
-        tile_id = None
+        tile_id = self.get_tile_id(tile_x, tile_y)
         cache = self._tile_cache
-        if cache:
-            tile_id = self.get_tile_id(tile_x, tile_y)
+        if cache is not None:
             tile = cache.get_value(tile_id)
             if tile is not None:
                 return tile
+        # Concurrent requests for the same tile wait for a single computation
+        return _TILE_COMPUTATIONS.compute(tile_id, lambda: self._compute_and_cache_tile(tile_x, tile_y, tile_id))
+
+    def _compute_and_cache_tile(self, tile_x, tile_y, tile_id):
+        cache = self._tile_cache
+        if cache is not None:
+            # The tile may have been computed since our last look into the cache
+            tile = cache.get_value(tile_id, record=False)
+            if tile is not None:
+                return tile
         tw, th = self.tile_size
+        t0 = time.perf_counter()
         tile = self.compute_tile(tile_x, tile_y, (tw * tile_x, th * tile_y, tw, th))
-        if cache:
-            cache.put_value(tile_id, tile)
+        if cache is not None:
+            # Pass the compute time, so that cost-aware policies such as POLICY_GDS keep expensive tiles longer
+            cache.put_value(tile_id, tile, cost=time.perf_counter() - t0)
         return tile
 
     @abstractmethod
@@ -203,7 +363,7 @@ class OpImage(AbstractTiledImage, metaclass=ABCMeta):
 
     def dispose(self):
         cache = self._tile_cache
-        if cache:
+        if cache is not None:
             num_tiles_x, num_tiles_y = self.num_tiles
             for tile_y in range(num_tiles_y):
                 for tile_x in range(num_tiles_x):
@@ -262,17 +422,33 @@ class TransformArrayImage(DecoratorImage):
     Performs basic (numpy) array transforms. Currently available: force_masked, flip_y.
     Expects the source image to provide (numpy) arrays.
     """
-    def __init__(self, source_image, flip_y=False, force_masked=True, no_data_value=None, tile_cache=None):
-        super().__init__(source_image, tile_cache=tile_cache)
+    def __init__(self, source_image, flip_y=False, force_masked=True, no_data_value=None, image_id=None,
+                 tile_cache=None, tile_stats=None):
+        """
+        Constructor.
+        :param tile_stats: optional statistics of this image's level, see TileStatsTree.get_level(), which are
+               recorded for each computed tile. Tiles known to be empty are not read from the source image.
+        """
+        super().__init__(source_image, image_id=image_id, tile_cache=tile_cache)
         self._force_masked = force_masked
         self._flip_y = flip_y
         self._no_data_value = no_data_value
+        self._tile_stats = tile_stats
 
     @property
     def no_data_value(self):
         return self._no_data_value
 
     def compute_tile(self, tile_x, tile_y, rectangle):
+        tile_stats = self._tile_stats
+        if tile_stats is not None and self._force_masked and tile_stats.tile_layout is not None \
+                and tile_stats.is_empty(tile_x, tile_y):
+            leading_shape, dtype = tile_stats.tile_layout
+            shape = leading_shape + (self.tile_size[1], self.tile_size[0])
+            fill_value = self._no_data_value
+            return get_shared_tile(('masked', shape, dtype.str, repr(fill_value)),
+                                   lambda: _create_masked_tile(shape, dtype, fill_value))
+        target_tile_y = tile_y
         if self._flip_y:
             num_tiles_y = self.num_tiles[1]
             tile_size_y = self.tile_size[1]
@@ -283,6 +459,8 @@ class TransformArrayImage(DecoratorImage):
         target_tile = None
         if source_tile is not None:
             target_tile = self.compute_tile_from_source_tile(tile_x, tile_y, rectangle, source_tile)
+            if tile_stats is not None:
+                tile_stats.record(tile_x, target_tile_y, target_tile)
         return target_tile
 
     def compute_tile_from_source_tile(self, tile_x, tile_y, rectangle, tile):
@@ -297,16 +475,118 @@ class TransformArrayImage(DecoratorImage):
             elif np.issubdtype(tile.dtype, float) or np.issubdtype(tile.dtype, complex):
                 # and it is of float type, return a masked tile with a mask from invalids, i.e. NaN, -Inf, +Inf
                 tile = np.ma.masked_invalid(tile)
+        if self._force_masked and _is_fully_masked(tile):
+            # All fully masked tiles of the same layout are the same, so share one read-only tile
+            shape, dtype = tile.shape, tile.dtype
+            fill_value = tile.fill_value if isinstance(tile, np.ma.MaskedArray) else None
+            tile = get_shared_tile(('masked', shape, dtype.str, repr(fill_value)),
+                                   lambda: _create_masked_tile(shape, dtype, fill_value))
         return tile
 
 
+class StackedArrayImage(AbstractTiledImage):
+    """
+    Stacks the (numpy) array tiles of source images of the same layout along a new leading dimension, e.g. the tiles
+    of the time steps of a variable, so that a ColorMappedRgbaImage renders them as a sprite sheet.
+    Stacked tiles are not cached, because the source tiles usually are.
+    """
+
+    def __init__(self, source_images, image_id=None):
+        """
+        Constructor.
+        :param source_images: the source images, which provide 2D array tiles
+        :param image_id: an optional ID
+        """
+        source_image = source_images[0]
+        super().__init__(source_image.size,
+                         tile_size=source_image.tile_size,
+                         num_tiles=source_image.num_tiles,
+                         mode=source_image.mode,
+                         format=source_image.format,
+                         image_id=image_id)
+        self._source_images = list(source_images)
+
+    @property
+    def source_images(self):
+        return list(self._source_images)
+
+    def get_tile(self, tile_x, tile_y):
+        return np.ma.stack([source_image.get_tile(tile_x, tile_y) for source_image in self._source_images])
+
+
+def _is_fully_masked(tile):
+    """
+    :return: True, if all values of the given tile are masked or invalid, i.e. NaN, -Inf, +Inf
+    """
+    mask = np.ma.getmask(tile)
+    if mask is not np.ma.nomask and mask.all():
+        return True
+    if tile.dtype.kind not in 'fc':
+        return False
+    data = np.ma.getdata(tile)
+    if mask is np.ma.nomask:
+        return not np.isfinite(data.flat[0]) and not np.isfinite(data).any()
+    return np.all(mask | ~np.isfinite(data))
+
+
+def _create_masked_tile(shape, dtype, fill_value):
+    if fill_value is None:
+        fill_value = np.ma.default_fill_value(np.dtype(dtype))
+    data = np.full(shape, fill_value, dtype=dtype)
+    data.flags.writeable = False
+    mask = np.ones(shape, dtype=np.bool_)
+    mask.flags.writeable = False
+    return np.ma.array(data, mask=mask, fill_value=fill_value, copy=False)
+
+
+def render_color_mapped_tile(array, color_mapper, value_range=(0.0, 1.0), no_data_value=None, mode='RGBA',
+                             format=None, palette=False, encoder_options=None):
+    """
+    Color-map a 2D tile and encode it.
+
+    :param array: a 2D numpy array or masked array
+    :param color_mapper: the ColorMapper
+    :param value_range: the (min, max) value range mapped to the colormap
+    :param no_data_value: an optional value which, like NaN and masked values, becomes transparent
+    :param mode: the PIL mode of unencoded tiles
+    :param format: the PIL format of the encoded tile, if None, the tile is returned as PIL image
+    :param palette: if True and format is PNG, the tile is encoded as palette image, if possible
+    :param encoder_options: the keyword arguments of the PIL encoder
+    :return: the encoded tile or a PIL image
+    """
+    image = None
+    if format and palette:
+        image = color_mapper.map_to_palette_image(array, value_range, no_data_value=no_data_value)
+    if image is None:
+        # NaN, masked and no-data values become transparent, see ColorMapper
+        array = color_mapper.map(array, value_range, no_data_value=no_data_value)
+        if format == 'JPEG':
+            # JPEG has no alpha channel, transparent no-data pixels become black
+            image = Image.fromarray(np.ascontiguousarray(array[..., :3]), mode='RGB')
+        else:
+            image = Image.fromarray(array, mode=mode)
+
+    if format:
+        ostream = io.BytesIO()
+        image.save(ostream, format=format, **(encoder_options or {}))
+        encoded_image = ostream.getvalue()
+        ostream.close()
+        return encoded_image
+    else:
+        return image
+
+
 class ColorMappedRgbaImage(DecoratorImage):
     """
     Creates a color-mapped image from a source image that provide tiles as numpy-like image arrays.
+    Source tiles with leading dimensions, e.g. stacks of time steps, become sprite sheets of their 2D slices
+    from top to bottom.
     """
 
     def __init__(self, source_image, value_range=(0.0, 1.0), cmap_name=None, num_colors=256,
-                 no_data_value=None, encode=False, format=None, tile_cache=None):
+                 no_data_value=None, encode=False, format=None, image_id=None, tile_cache=None,
+                 palette=False, compress_level=None, compress_type=None, quality=None, lossless=False,
+                 render_pool=None):
         """
         Constructor.
 
@@ -317,47 +597,94 @@ class ColorMappedRgbaImage(DecoratorImage):
         :param no_data_value: fill value which will be mapped
         :param encode:
         :param format:
+        :param image_id: an optional ID primarily used for caching
+        :param palette: if True, PNG tiles are encoded as 8-bit palette images with a tRNS chunk,
+               which are much smaller and faster to compress than RGBA images but decode to the same pixels
+        :param compress_level: zlib compression level of PNG tiles, 0 (none) to 9 (best), default is 6
+        :param compress_type: zlib strategy of PNG tiles, one of the keys of PNG_COMPRESS_TYPES
+        :param quality: quality of lossy WEBP and JPEG tiles, 1 (smallest) to 100 (best)
+        :param lossless: if True, WEBP tiles are encoded lossless
+        :param render_pool: an optional TileRenderPool that color-maps and encodes tiles in worker processes
         :return:
         """
-        super().__init__(source_image, format=format, mode='RGBA', tile_cache=tile_cache)
+        super().__init__(source_image, format=format, mode='RGBA', image_id=image_id, tile_cache=tile_cache)
         self._value_range = value_range
         self._cmap_name = cmap_name if cmap_name else 'jet'
-        self._cmap = cm.get_cmap(self._cmap_name, num_colors)
-        self._cmap.set_bad('k', 0)
+        self._color_mapper = get_color_mapper(self._cmap_name, num_colors)
         self._no_data_value = no_data_value
         self._encode = encode
+        self._palette = palette and format == 'PNG'
+        self._render_pool = render_pool
+        self._encoder_options = {}
+        if format == 'PNG':
+            if compress_level is not None:
+                self._encoder_options['compress_level'] = compress_level
+            if compress_type is not None:
+                self._encoder_options['compress_type'] = PNG_COMPRESS_TYPES[compress_type]
+        elif format == 'WEBP':
+            self._encoder_options['lossless'] = lossless
+            if quality is not None:
+                self._encoder_options['quality'] = quality
+        elif format == 'JPEG':
+            if quality is not None:
+                self._encoder_options['quality'] = quality
 
     def compute_tile_from_source_tile(self, tile_x, tile_y, rectangle, source_tile):
-        value_min, value_max = self._value_range
-        if not np.ma.is_masked(source_tile):
-            if self._no_data_value is not None:
-                array = np.ma.masked_equal(source_tile, self._no_data_value)
-                array = array.clip(value_min, value_max, out=array)
-            elif np.issubdtype(source_tile.dtype, float) or np.issubdtype(source_tile.dtype, complex):
-                array = np.ma.masked_invalid(source_tile)
-                array = array.clip(value_min, value_max, out=array)
-            else:
-                array = source_tile.clip(value_min, value_max)
-        else:
-            array = source_tile.clip(value_min, value_max)
+        old_shape = source_tile.shape
+        array = np.reshape(source_tile, (-1, old_shape[-1]))
+        if self._encode and self.format:
+            color = self._get_uniform_color(array)
+            if color is not None:
+                # Fully masked and constant-value tiles, e.g. of ocean variables over land, are encoded only once
+                key = ('encoded', self.format, self._palette, tuple(sorted(self._encoder_options.items())),
+                       array.shape, color)
+                return get_shared_tile(key, lambda: self._compute_uniform_tile(array, color))
+        return self._compute_tile(array)
+
+    def _get_uniform_color(self, array):
+        """
+        :return: the RGBA color of all pixels, if the given tile is fully masked or has a constant value, otherwise None
+        """
+        lut = self._color_mapper.lut
+        mask = np.ma.getmask(array)
+        if mask is not np.ma.nomask:
+            if mask.all():
+                return tuple(lut[-1].tolist())
+            if mask.any():
+                return None
+        data = np.ma.getdata(array)
+        value = data[0, 0]
+        if data.dtype.kind == 'f' and np.isnan(value):
+            return tuple(lut[-1].tolist()) if np.isnan(data).all() else None
+        # Most tiles are rejected by looking at a few pixels
+        if data[-1, -1] != value or data[data.shape[0] // 2, data.shape[1] // 2] != value or not np.all(data == value):
+            return None
+        index = self._color_mapper.get_indices(data[:1, :1], self._value_range, no_data_value=self._no_data_value)
+        return tuple(lut[index[0, 0]].tolist())
+
+    def _compute_uniform_tile(self, array, color):
+        tile = self._compute_tile(array)
+        if color[3] == 0:
+            _add_empty_tile(tile)
+        return tile
 
-        old_shape = array.shape
-        array = np.reshape(array, (old_shape[-2], old_shape[-1]))
-        # check if we can optimize the following calls by using Numexpr
-        # see https://github.com/pydata/numexpr/wiki/Numexpr-Users-Guide
-        array -= value_min
-        array *= 1.0 / (value_max - value_min)
-        array = self._cmap(array, bytes=True)
-        image = Image.fromarray(array, mode=self.mode)
+    def _compute_tile(self, array):
+        render_options = self.render_options
+        if self._render_pool is not None and render_options['format']:
+            return self._render_pool.render(array, self._color_mapper, render_options)
+        return render_color_mapped_tile(array, self._color_mapper, **render_options)
 
-        if self._encode and self.format:
-            ostream = io.BytesIO()
-            image.save(ostream, format=self.format)
-            encoded_image = ostream.getvalue()
-            ostream.close()
-            return encoded_image
-        else:
-            return image
+    @property
+    def render_options(self):
+        """
+        The keyword arguments of render_color_mapped_tile() other than the array and color mapper.
+        """
+        return dict(value_range=self._value_range,
+                    no_data_value=self._no_data_value,
+                    mode=self.mode,
+                    format=self.format if self._encode else None,
+                    palette=self._encode and self._palette,
+                    encoder_options=self._encoder_options)
 
     def create_pyramid(self):
         if self._encode:
@@ -482,15 +809,30 @@ class NdarrayDownsamplingImage(DownsamplingImage):
         self._aggregator = aggregator
 
     def aggregate_and_stitch_source_tiles(self, source_tiles, target_size, target_positions):
+        if target_size[0] % 2 or target_size[1] % 2:
+            # The aggregated halves of odd-sized tiles don't fit into the target tile, so stitch first
+            if any(isinstance(source_tile, np.ma.MaskedArray) for source_tile in source_tiles):
+                concatenate = np.ma.concatenate
+            else:
+                concatenate = np.concatenate
+            upper_tile = concatenate((source_tiles[0], source_tiles[2]), axis=-1)
+            lower_tile = concatenate((source_tiles[1], source_tiles[3]), axis=-1)
+            target_tile = downsample_ndarray(concatenate((upper_tile, lower_tile), axis=-2),
+                                             aggregator=self._aggregator)
+            # Don't keep the stitched tile alive through a strided view
+            return target_tile.copy() if self._aggregator is aggregate_ndarray_first else target_tile
         prototype_tile = source_tiles[0]
         agg_tiles = [downsample_ndarray(source_tile, aggregator=self._aggregator) for source_tile in source_tiles]
         target_shape = list(prototype_tile.shape)
         target_shape[-1] = target_size[0]
         target_shape[-2] = target_size[1]
-        if np.ma.is_masked(prototype_tile):
-            target_tile = np.ma.empty_like(prototype_tile)
+        dtype = agg_tiles[0].dtype
+        if any(isinstance(agg_tile, np.ma.MaskedArray) for agg_tile in agg_tiles):
+            target_tile = np.ma.array(np.empty(target_shape, dtype=dtype), mask=np.zeros(target_shape, dtype=np.bool_))
+            if isinstance(prototype_tile, np.ma.MaskedArray):
+                target_tile.fill_value = prototype_tile.fill_value
         else:
-            target_tile = np.empty_like(prototype_tile)
+            target_tile = np.empty(target_shape, dtype=dtype)
         for i in range(len(agg_tiles)):
             agg_x = target_positions[i][0]
             agg_y = target_positions[i][1]
@@ -511,15 +853,19 @@ class FastNdarrayDownsamplingImage(OpImage):
                  tile_size,
                  z_index,
                  num_levels,
-                 tile_cache=None):
+                 image_id=None,
+                 tile_cache=None,
+                 index=None):
         """
         Constructor.
         :param source_image: a tiled source image (type TiledImage) whose source tiles must be PIL Images
-        :param key: an optional key prefix string used for caching
+        :param image_id: an optional ID prefix primarily used for caching, the level is appended
         :param tile_cache: an optional tile cache of type Cache
+        :param index: an optional tuple of indexes into the leading dimensions of the array, e.g. (time, depth),
+               so that only the selected 2D slice is read. If None, tiles have all leading dimensions.
         """
         zoom = 1 << (num_levels - z_index - 1)
-        image_id = '%s-L%d' % (uuid.uuid4(), z_index)
+        image_id = '%s-L%d' % (image_id if image_id else uuid.uuid4(), z_index)
         source_width, source_height = array.shape[-1], array.shape[-2]
         width, height = source_width // zoom, source_height // zoom
         tile_width, tile_height = tile_size
@@ -535,6 +881,7 @@ class FastNdarrayDownsamplingImage(OpImage):
         self._array = array
         self._z_index = z_index
         self._zoom = zoom
+        self._index = tuple(index) if index is not None else (Ellipsis,)
 
     def compute_tile(self, tile_x, tile_y, rectangle):
         x, y, w, h = rectangle
@@ -544,7 +891,7 @@ class FastNdarrayDownsamplingImage(OpImage):
         w *= zoom
         h *= zoom
 
-        tile = self._array[..., y:y + h:zoom, x:x + w:zoom]
+        tile = self._array[self._index + (slice(y, y + h, zoom), slice(x, x + w, zoom))]
 
         actual_tile_size = tile.shape[-1], tile.shape[-2]
 
@@ -610,12 +957,16 @@ class ImagePyramid:
         This is a fast pyramid exploiting the array's underlying slicing capabilities.
         For example, if array is a H5Py dataset object, the created pyramid will take advantage of
         the HDF-5 libraries's slicing.
+        If array is a H5Py dataset object that has a valid pyramid sidecar file (see pyramid_sidecar module),
+        the lower levels are read from the sidecar instead. Unless the sidecar's aggregation is 'first',
+        its aggregation is appended to the image ID of the lower levels.
 
         :param array: numpy-like array that supports stepping in it's subscript operator, e.g.
                       array[..., y::step, x:step]
         :param tile_size: a tuple (tile_width, tile_height)
         :param num_level_zero_tiles: a tuple (num_level_zero_tiles_x, num_level_zero_tiles_y)
         :param num_levels: number of levels
+        :param kwargs: keyword arguments passed to FastNdarrayDownsamplingImage, e.g. image_id, tile_cache or index
         :return: a new ImagePyramid instance
         """
         max_size, tile_size, \
@@ -623,10 +974,70 @@ class ImagePyramid:
                                                                        tile_size=tile_size,
                                                                        num_level_zero_tiles=num_level_zero_tiles,
                                                                        num_levels=num_levels)
+        sidecar = open_pyramid_sidecar(array, tile_size, num_level_zero_tiles, num_levels)
         level_images = [None] * num_levels
         for i in range(0, num_levels):
             z_index = num_levels - 1 - i
-            level_images[z_index] = FastNdarrayDownsamplingImage(array, tile_size, z_index, num_levels, **kwargs)
+            if sidecar is not None and z_index < num_levels - 1:
+                aggregation, overviews = sidecar
+                overview_kwargs = dict(kwargs)
+                if aggregation != 'first' and kwargs.get('image_id'):
+                    overview_kwargs['image_id'] = '%s|%s' % (kwargs['image_id'], aggregation)
+                # A level of the sidecar is read as the highest level of a pyramid with z_index + 1 levels
+                level_images[z_index] = FastNdarrayDownsamplingImage(overviews[z_index], tile_size, z_index,
+                                                                     z_index + 1, **overview_kwargs)
+            else:
+                level_images[z_index] = FastNdarrayDownsamplingImage(array, tile_size, z_index, num_levels, **kwargs)
+        return ImagePyramid(num_level_zero_tiles, tile_size, level_images)
+
+    @staticmethod
+    def create_overviews_from_array(array,
+                                    tile_size=None,
+                                    num_level_zero_tiles=None,
+                                    num_levels=None,
+                                    aggregator=aggregate_ndarray_nanmean,
+                                    level_transform=None,
+                                    image_id=None,
+                                    tile_cache=None,
+                                    index=None):
+        """
+        Create an image pyramid from a numpy-like array, where only the highest level reads from the array
+        and each lower level is an overview aggregated from the tiles of the level above, see NdarrayDownsamplingImage.
+        Unlike create_from_array(), whose lower levels read the array with strides and so touch (and decompress)
+        nearly every chunk of a chunked HDF-5 dataset for a single tile, each chunk is read at most once
+        as long as the tiles of the levels above are cached.
+
+        :param array: numpy-like array, e.g. a H5Py dataset object
+        :param tile_size: a tuple (tile_width, tile_height)
+        :param num_level_zero_tiles: a tuple (num_level_zero_tiles_x, num_level_zero_tiles_y)
+        :param num_levels: number of levels
+        :param aggregator: the aggregator function, see utils.AGGREGATORS
+        :param level_transform: optional function that is applied to each level image before the next lower level
+               is computed from it, called as so: level_images[z_index] = level_transform(level_image, z_index),
+               e.g. to mask no-data values using a TransformArrayImage
+        :param image_id: an optional ID prefix primarily used for caching, the level is appended
+        :param tile_cache: an optional tile cache of type Cache
+        :param index: an optional tuple of indexes into the leading dimensions of the array,
+               see FastNdarrayDownsamplingImage
+        :return: a new ImagePyramid instance
+        """
+        max_size, tile_size, \
+        num_level_zero_tiles, num_levels = ImagePyramid.compute_layout(array=array,
+                                                                       tile_size=tile_size,
+                                                                       num_level_zero_tiles=num_level_zero_tiles,
+                                                                       num_levels=num_levels)
+        image_id = image_id if image_id else str(uuid.uuid4())
+        z_index_max = num_levels - 1
+        level_images = [None] * num_levels
+        level_image = FastNdarrayDownsamplingImage(array, tile_size, z_index_max, num_levels,
+                                                   image_id=image_id, tile_cache=tile_cache, index=index)
+        for z_index in range(z_index_max, -1, -1):
+            if z_index < z_index_max:
+                level_image = NdarrayDownsamplingImage(level_image, image_id='%s-L%d' % (image_id, z_index),
+                                                       tile_cache=tile_cache, aggregator=aggregator)
+            if level_transform is not None:
+                level_image = level_transform(level_image, z_index)
+            level_images[z_index] = level_image
         return ImagePyramid(num_level_zero_tiles, tile_size, level_images)
 
     @staticmethod
@@ -683,13 +1094,21 @@ class ImagePyramid:
                 num_levels += 1
         return max_size, tile_size, num_level_zero_tiles, num_levels
 
-    def __init__(self, num_level_zero_tiles, tile_size, level_images):
+    def __init__(self, num_level_zero_tiles, tile_size, level_images, tile_stats=None):
+        """
+        Constructor.
+        :param num_level_zero_tiles: a tuple (num_level_zero_tiles_x, num_level_zero_tiles_y)
+        :param tile_size: a tuple (tile_width, tile_height)
+        :param level_images: the level images, lowest resolution first
+        :param tile_stats: optional per-tile statistics of the pyramid, see TileStatsTree
+        """
         self._num_level_zero_tiles_x = num_level_zero_tiles[0]
         self._num_level_zero_tiles_y = num_level_zero_tiles[1]
         self._tile_width = tile_size[0]
         self._tile_height = tile_size[1]
         self._num_levels = len(level_images)
         self._level_images = list(level_images)
+        self._tile_stats = tile_stats
 
     @property
     def num_level_zero_tiles(self):
@@ -703,6 +1122,10 @@ class ImagePyramid:
     def num_levels(self):
         return self._num_levels
 
+    @property
+    def tile_stats(self):
+        return self._tile_stats
+
     def get_level_image(self, z_index):
         return self._level_images[z_index]
 
@@ -717,7 +1140,8 @@ class ImagePyramid:
     def apply(self, level_mapper, *args, **kwargs):
         return ImagePyramid(self.num_level_zero_tiles,
                             self.tile_size,
-                            [level_mapper(level_image, *args, **kwargs) for level_image in self._level_images])
+                            [level_mapper(level_image, *args, **kwargs) for level_image in self._level_images],
+                            tile_stats=self._tile_stats)
 
 
 def create_pil_downsampling_image(source_image, higher_level_image, z_index, num_levels, **kwargs):
@@ -1,9 +1,13 @@
 import base64
 import json
+import multiprocessing
 import os
 import pprint
 import sys
 import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from threading import current_thread, Lock
 
@@ -11,9 +15,24 @@ import cherrypy
 import falcon
 import h5py
 import numpy
-
-from ccitbxws.cmaps import get_cmaps
-from ccitbxws.image import ColorMappedRgbaImage, ImagePyramid, TransformArrayImage
+from cherrypy.process.plugins import Monitor
+
+import ccitbxws.cache
+from ccitbxws.cache import TinyLfuAdmission
+from ccitbxws.chunk_cache import ChunkCachedArray, DEFAULT_CHUNK_CACHE_CAPACITY, get_chunk_read_stats, \
+    get_default_chunk_cache, set_default_chunk_cache
+from ccitbxws.cmaps import get_cmaps, get_color_mapper
+from ccitbxws.data_tiles import QuantizedDataImage, DATA_TILE_DTYPES, \
+    DEFAULT_COMPRESS_LEVEL as DEFAULT_DATA_TILE_COMPRESS_LEVEL
+from ccitbxws.image import ColorMappedRgbaImage, ImagePyramid, StackedArrayImage, TransformArrayImage, \
+    set_default_tile_cache, get_default_tile_cache, get_tile_computation_stats, is_empty_tile, PNG_COMPRESS_TYPES
+from ccitbxws.prefetch import TilePrefetcher, DEFAULT_MAX_CACHE_LOAD, DEFAULT_MAX_PENDING_PER_CLIENT, \
+    DEFAULT_MAX_PENDING_PER_PYRAMID, DEFAULT_PRESSURE_WINDOW
+from ccitbxws.pyramid_sidecar import close_pyramid_sidecars, get_sidecar_path
+from ccitbxws.render_pool import TileRenderPool, DEFAULT_MAX_TILE_SIZE, DEFAULT_RENDER_TIMEOUT
+from ccitbxws.shared_cache import SharedMemoryCache
+from ccitbxws.tile_stats import TileStatsTree
+from ccitbxws.utils import AGGREGATORS
 
 __version__ = '0.0.1'
 
@@ -21,8 +40,36 @@ CONFIG = {}
 _CONFIG_FILE = './ccitbxws-conf.py'
 _JOBS = {}
 _DATASETS = {}
-PYRAMIDS = dict()
+# Color-mapped pyramids, keyed by (file_path, var_name, cmap_name, cmap_min, cmap_max, encoding),
+# most recently used last
+PYRAMIDS = OrderedDict()
+MAX_NUM_PYRAMIDS = 64
+# Data pyramids, keyed by (file_path, var_name, index), see _get_index_from_req(), most recently used last.
+# Tile stacks use the data pyramids of all their time steps, see _create_stack_pyramid().
+# Those not requested by themselves are kept in STACK_STEP_PYRAMIDS instead.
+DATA_PYRAMIDS = OrderedDict()
+MAX_NUM_DATA_PYRAMIDS = 1024
+_SHARED_TILE_CACHE = None
+# Background prefetcher of the tiles around served tiles, see _init_tile_prefetcher()
+_TILE_PREFETCHER = None
+# Worker processes color-mapping and encoding tiles, see _init_tile_render_pool()
+_TILE_RENDER_POOL = None
+# Thread pool computing the tiles of FileVarTiles requests, see _get_tile_batch_executor()
+_TILE_BATCH_EXECUTOR = None
+MAX_NUM_BATCH_TILES = 256
+DATA_TILE_MEDIA_TYPE = 'application/octet-stream'
+# Maximum number of time steps of FileVarTileStack requests, a year of daily data
+MAX_NUM_STACK_STEPS = 366
+# Data pyramids of the time steps of tile stacks, keyed and ordered like DATA_PYRAMIDS, so that large stacks don't
+# evict the data pyramids requested by other clients, see _get_stack_step_pyramids()
+STACK_STEP_PYRAMIDS = OrderedDict()
+MAX_NUM_STACK_STEP_PYRAMIDS = 2 * MAX_NUM_STACK_STEPS
 GLOBAL_LOCK = Lock()
+# Tile formats by file extension, as (PIL format, media type) pairs
+TILE_FORMATS = OrderedDict([('png', ('PNG', 'image/png')),
+                            ('webp', ('WEBP', 'image/webp')),
+                            ('jpg', ('JPEG', 'image/jpeg')),
+                            ('jpeg', ('JPEG', 'image/jpeg'))])
 
 
 # see http://stackoverflow.com/questions/3488934/simplejson-and-numpy-array/
@@ -86,6 +133,101 @@ def _get_param_as_float(req, name, default=None):
     return default
 
 
+def _get_param_as_int(req, name, default=None, min_value=None, max_value=None):
+    str_value = req.get_param(name, required=default is None)
+    if str_value is not None:
+        try:
+            value = int(str_value)
+        except ValueError:
+            raise falcon.HTTPBadRequest('Illegal query parameter', 'parameter \'%s\' must be an integer' % name)
+        if (min_value is not None and value < min_value) or (max_value is not None and value > max_value):
+            raise falcon.HTTPBadRequest('Illegal query parameter',
+                                        'parameter \'%s\' must be in the range %s to %s' % (name, min_value, max_value))
+        return value
+    return default
+
+
+def _get_optional_param_as_int(req, name, default, min_value=None, max_value=None):
+    if req.get_param(name) is None:
+        return default
+    return _get_param_as_int(req, name, min_value=min_value, max_value=max_value)
+
+
+def _get_param_as_list(req, name, required=False):
+    # Items are given as repeated parameters or comma-separated, depending on the Falcon version's parsing
+    values = req.get_param_as_list(name, required=required) or []
+    return [item for value in values for item in value.split(',') if item]
+
+
+def _get_param_as_bool(req, name, default=None):
+    str_value = req.get_param(name, required=default is None)
+    if str_value is not None:
+        if str_value.lower() in ('1', 'true', 'yes'):
+            return True
+        if str_value.lower() in ('0', 'false', 'no'):
+            return False
+        raise falcon.HTTPBadRequest('Illegal query parameter', 'parameter \'%s\' must be a boolean' % name)
+    return default
+
+
+def _get_tile_format(req, ext, cmap_name):
+    """
+    Get the format of tiles from the file extension of the requested tile, e.g. '0.webp', or, if there is none,
+    from the request's Accept header. JPEG is only available for colormaps without transparent colors.
+    :return: a (format, media_type) tuple
+    """
+    opaque = get_color_mapper(cmap_name).is_opaque
+    if ext is not None:
+        if ext not in TILE_FORMATS:
+            raise falcon.HTTPNotFound()
+        tile_format, media_type = TILE_FORMATS[ext]
+        if tile_format == 'JPEG' and not opaque:
+            raise falcon.HTTPBadRequest('Illegal tile format',
+                                        'JPEG tiles are not available for colormap \'%s\'' % cmap_name)
+        return tile_format, media_type
+    # Ties are resolved in favour of the last media type, so that clients accepting anything get PNG
+    media_types = ['image/webp', 'image/png']
+    if opaque:
+        media_types.insert(0, 'image/jpeg')
+    media_type = req.client_prefers(media_types)
+    if media_type is None:
+        raise falcon.HTTPNotAcceptable(description='tiles are available as %s' % ', '.join(media_types))
+    for tile_format, format_media_type in TILE_FORMATS.values():
+        if format_media_type == media_type:
+            return tile_format, media_type
+
+
+def _get_tile_encoding(req, tile_format='PNG'):
+    """
+    Get the encoding of tiles of the given format from optional request parameters, which default to
+    the TILE_<format>_* settings.
+    PNG tiles use the parameters 'palette', 'compress' (zlib level) and 'strategy' (zlib strategy),
+    WEBP tiles 'lossless' and 'quality', and JPEG tiles 'quality'.
+    :return: a (format, options) tuple, where options is a tuple of (name, value) pairs of encoder options
+    """
+    if tile_format == 'PNG':
+        palette = _get_param_as_bool(req, 'palette', default=CONFIG.get('TILE_PNG_PALETTE', True))
+        compress_level = _get_optional_param_as_int(req, 'compress', CONFIG.get('TILE_PNG_COMPRESS_LEVEL'), 0, 9)
+        compress_type = req.get_param('strategy') or CONFIG.get('TILE_PNG_COMPRESS_TYPE')
+        if compress_type is not None and compress_type not in PNG_COMPRESS_TYPES:
+            raise falcon.HTTPBadRequest('Illegal query parameter',
+                                        'parameter \'strategy\' must be one of %s' % ', '.join(PNG_COMPRESS_TYPES))
+        options = (('palette', palette), ('compress_level', compress_level), ('compress_type', compress_type))
+    elif tile_format == 'WEBP':
+        lossless = _get_param_as_bool(req, 'lossless', default=CONFIG.get('TILE_WEBP_LOSSLESS', False))
+        quality = _get_optional_param_as_int(req, 'quality', CONFIG.get('TILE_WEBP_QUALITY'), 1, 100)
+        options = (('lossless', lossless), ('quality', quality))
+    else:
+        quality = _get_optional_param_as_int(req, 'quality', CONFIG.get('TILE_JPEG_QUALITY'), 1, 100)
+        options = (('quality', quality),)
+    return tile_format, tuple((name, value) for name, value in options if value is not None)
+
+
+def _get_tile_encoding_id(encoding):
+    tile_format, options = encoding
+    return ''.join([tile_format] + ['-%s=%s' % (name, value) for name, value in options])
+
+
 def _get_norm_path(file_name):
     if os.path.isabs(file_name):
         file_path = file_name
@@ -113,6 +255,13 @@ def _close_dataset(file_path):
     if file_path in _DATASETS:
         dataset = _DATASETS[file_path]
         del _DATASETS[file_path]
+        _save_tile_stats(file_path)
+        with GLOBAL_LOCK:
+            # Pyramids must not read from the closed dataset
+            for pyramids in (PYRAMIDS, DATA_PYRAMIDS, STACK_STEP_PYRAMIDS):
+                for key in [key for key in pyramids.keys() if key[0] == file_path]:
+                    del pyramids[key]
+        close_pyramid_sidecars(file_path)
         dataset.close()
         return True
     return False
@@ -157,6 +306,89 @@ print('CONFIG = ')
 pprint.pprint(CONFIG)
 
 
+def _init_tile_cache():
+    global _SHARED_TILE_CACHE
+    policy_name = CONFIG.get('TILE_CACHE_POLICY', 'LRU')
+    set_default_tile_cache(capacity=CONFIG.get('TILE_CACHE_CAPACITY', 64 * 1024 * 1024),
+                           policy=getattr(ccitbxws.cache, 'POLICY_' + policy_name),
+                           admission=TinyLfuAdmission() if CONFIG.get('TILE_CACHE_ADMISSION') else None,
+                           num_shards=CONFIG.get('TILE_CACHE_NUM_SHARDS', 1),
+                           compress=CONFIG.get('TILE_CACHE_COMPRESS', False),
+                           disk_cache_dir=CONFIG.get('TILE_CACHE_DIR'),
+                           disk_cache_capacity=CONFIG.get('TILE_CACHE_DIR_CAPACITY', 1024 ** 3))
+
+    chunk_cache_capacity = CONFIG.get('CHUNK_CACHE_CAPACITY', DEFAULT_CHUNK_CACHE_CAPACITY)
+    set_default_chunk_cache(no_cache=not chunk_cache_capacity, capacity=chunk_cache_capacity)
+
+    shared_file = CONFIG.get('TILE_CACHE_SHARED_FILE')
+    if shared_file:
+        _SHARED_TILE_CACHE = SharedMemoryCache(shared_file,
+                                               capacity=CONFIG.get('TILE_CACHE_SHARED_CAPACITY', 256 * 1024 * 1024))
+
+    snapshot_file = CONFIG.get('TILE_CACHE_SNAPSHOT_FILE')
+    if not snapshot_file:
+        return
+    tile_cache = get_default_tile_cache()
+    if os.path.exists(snapshot_file):
+        try:
+            snapshot = tile_cache.load_snapshot(snapshot_file)
+            print('loaded tile cache snapshot %s: %d tiles, %d outdated' % (snapshot_file,
+                                                                            snapshot.num_entries,
+                                                                            snapshot.num_invalid))
+        except (OSError, ValueError) as e:
+            print('WARNING: failed to load tile cache snapshot %s: %s' % (snapshot_file, e))
+
+    def save_snapshot():
+        t1 = time.perf_counter()
+        num_tiles = tile_cache.save_snapshot(snapshot_file,
+                                             max_size=CONFIG.get('TILE_CACHE_SNAPSHOT_CAPACITY'),
+                                             get_source_path=_get_tile_source_path)
+        t2 = time.perf_counter()
+        print('PERF: saving %d tiles to snapshot %s took %f seconds' % (num_tiles, snapshot_file, t2 - t1))
+
+    cherrypy.engine.subscribe('stop', save_snapshot)
+    snapshot_interval = CONFIG.get('TILE_CACHE_SNAPSHOT_INTERVAL')
+    if snapshot_interval:
+        Monitor(cherrypy.engine, save_snapshot, frequency=snapshot_interval).subscribe()
+
+
+def _init_tile_prefetcher():
+    global _TILE_PREFETCHER
+    num_workers = CONFIG.get('TILE_PREFETCH_WORKERS', 0)
+    if not num_workers:
+        return
+    _TILE_PREFETCHER = TilePrefetcher(num_workers=num_workers,
+                                      max_pending_per_client=CONFIG.get('TILE_PREFETCH_MAX_PENDING_PER_CLIENT',
+                                                                        DEFAULT_MAX_PENDING_PER_CLIENT),
+                                      max_pending_per_pyramid=CONFIG.get('TILE_PREFETCH_MAX_PENDING_PER_PYRAMID',
+                                                                         DEFAULT_MAX_PENDING_PER_PYRAMID),
+                                      max_cache_load=CONFIG.get('TILE_PREFETCH_MAX_CACHE_LOAD',
+                                                                DEFAULT_MAX_CACHE_LOAD),
+                                      pressure_window=CONFIG.get('TILE_PREFETCH_PRESSURE_WINDOW',
+                                                                 DEFAULT_PRESSURE_WINDOW),
+                                      tile_cache=get_default_tile_cache())
+    cherrypy.engine.subscribe('stop', lambda: _TILE_PREFETCHER.shutdown(wait=False))
+
+
+def _init_tile_render_pool():
+    global _TILE_RENDER_POOL
+    num_workers = CONFIG.get('TILE_RENDER_PROCESSES', 0)
+    if not num_workers:
+        return
+    # A negative number leaves that many CPUs to the server's threads
+    if num_workers < 0:
+        num_workers = max(1, multiprocessing.cpu_count() + num_workers)
+    _TILE_RENDER_POOL = TileRenderPool(num_workers=num_workers,
+                                       max_tile_size=CONFIG.get('TILE_RENDER_MAX_TILE_SIZE', DEFAULT_MAX_TILE_SIZE),
+                                       timeout=CONFIG.get('TILE_RENDER_TIMEOUT', DEFAULT_RENDER_TIMEOUT))
+    cherrypy.engine.subscribe('stop', _TILE_RENDER_POOL.close)
+
+
+def _get_tile_source_path(tile_id):
+    # Tile IDs are of the form <file_path>|<var_name>-L<z>|.../<y>/<x>, see FileVarTile
+    return tile_id.split('|', 1)[0]
+
+
 def _get_variable_info(variable):
     # See http://docs.h5py.org/en/latest/
     # print(list(variable.attrs.keys()))
@@ -194,9 +426,9 @@ def _get_variable_info(variable):
 
 
 def _get_variable_image_config(variable):
-    t1 = time.clock()
+    t1 = time.perf_counter()
     max_size, tile_size, num_level_zero_tiles, num_levels = ImagePyramid.compute_layout(array=variable)
-    t2 = time.clock()
+    t2 = time.perf_counter()
     print("PERF: ImagePyramid.compute_layout took %f seconds" % (t2 - t1))
     return {
         # todo - compute imageConfig.sector from variable attributes. See frontend todo.
@@ -282,51 +514,632 @@ def crossdomain(req, resp):
     resp.set_header('Access-Control-Allow-Origin', '*')
 
 
+def _get_data_pyramid(file_path, var_name, index=None):
+    """
+    Get the pyramid of masked data tiles of a variable. It is shared by all color-mapped pyramids of the variable,
+    so that changing the colormap or its value range doesn't read any data again as long as the tiles are cached.
+    :param index: the indexes into the variable's leading dimensions, see _get_index_from_req(), whose 2D slice
+           is read, or None to read all leading dimensions
+    """
+    key = (file_path, var_name, index)
+    variable = None
+    with GLOBAL_LOCK:
+        pyramid = DATA_PYRAMIDS.get(key)
+        if pyramid is not None:
+            DATA_PYRAMIDS.move_to_end(key)
+            return pyramid
+        # The data pyramid of a time step of a tile stack is reused, with the tile statistics gathered so far
+        pyramid = STACK_STEP_PYRAMIDS.pop(key, None)
+        if pyramid is None:
+            variable = _open_dataset(file_path)[var_name]
+    if pyramid is None:
+        # The pyramid is built without holding the lock, so that first requests of other variables are not blocked
+        pyramid = _create_data_pyramid(file_path, var_name, variable, index)
+    with GLOBAL_LOCK:
+        # Another thread may have built the same pyramid in the meantime
+        other_pyramid = DATA_PYRAMIDS.get(key)
+        if other_pyramid is not None:
+            DATA_PYRAMIDS.move_to_end(key)
+            return other_pyramid
+        DATA_PYRAMIDS[key] = pyramid
+        evicted_items = _trim_data_pyramids(DATA_PYRAMIDS, MAX_NUM_DATA_PYRAMIDS)
+    # The statistics of evicted pyramids would be lost otherwise
+    _save_tile_stats_items(evicted_items)
+    return pyramid
+
+
+def _create_data_pyramid(file_path, var_name, variable, index):
+    if variable.chunks and get_default_chunk_cache() is not None:
+        # Tiles are assembled from decoded chunks, which neighbouring tiles and levels share
+        variable = ChunkCachedArray(variable)
+    aggregation = CONFIG.get('TILE_PYRAMID_AGGREGATION')
+    if aggregation:
+        return _create_overview_pyramid(file_path, var_name, variable, aggregation, index)
+    return _create_strided_pyramid(file_path, var_name, variable, index)
+
+
+def _trim_data_pyramids(pyramids, max_num_pyramids):
+    # Called holding GLOBAL_LOCK, returns the (key, tile statistics) items of the evicted pyramids
+    evicted_items = []
+    while len(pyramids) > max_num_pyramids:
+        evicted_key, evicted_pyramid = pyramids.popitem(last=False)
+        evicted_items.append((evicted_key, evicted_pyramid.tile_stats))
+    return evicted_items
+
+
+def _get_stack_step_pyramids(file_path, var_name, step_indexes):
+    """
+    Get the data pyramids of the time steps of a tile stack, taking the lock only twice for all time steps.
+    Those in DATA_PYRAMIDS are used as they are, without becoming more recently used, all others are kept in
+    STACK_STEP_PYRAMIDS, until they are requested by themselves, see _get_data_pyramid().
+    :param step_indexes: the indexes of the time steps, see _get_data_pyramid()
+    """
+    keys = [(file_path, var_name, step_index) for step_index in step_indexes]
+    with GLOBAL_LOCK:
+        pyramids = [_find_stack_step_pyramid(key) for key in keys]
+        variable = _open_dataset(file_path)[var_name]
+    # Variables without time steps have a single data pyramid for all steps of a stack
+    new_pyramids = OrderedDict((key, None) for key, pyramid in zip(keys, pyramids) if pyramid is None)
+    if not new_pyramids:
+        return pyramids
+    for key in new_pyramids:
+        new_pyramids[key] = _create_data_pyramid(file_path, var_name, variable, key[2])
+    with GLOBAL_LOCK:
+        for key, pyramid in new_pyramids.items():
+            # Another thread may have built the same pyramid in the meantime
+            other_pyramid = _find_stack_step_pyramid(key)
+            if other_pyramid is not None:
+                new_pyramids[key] = other_pyramid
+            else:
+                STACK_STEP_PYRAMIDS[key] = pyramid
+        evicted_items = _trim_data_pyramids(STACK_STEP_PYRAMIDS, MAX_NUM_STACK_STEP_PYRAMIDS)
+    _save_tile_stats_items(evicted_items)
+    return [new_pyramids[key] if pyramid is None else pyramid for key, pyramid in zip(keys, pyramids)]
+
+
+def _find_stack_step_pyramid(key):
+    # Called holding GLOBAL_LOCK
+    pyramid = DATA_PYRAMIDS.get(key)
+    if pyramid is None:
+        pyramid = STACK_STEP_PYRAMIDS.get(key)
+        if pyramid is not None:
+            STACK_STEP_PYRAMIDS.move_to_end(key)
+    return pyramid
+
+
+def _create_stack_pyramid(file_path, var_name, index):
+    """
+    Create a pyramid of stacks of masked data tiles of a range of time steps from the data pyramids of the
+    time steps, see _get_stack_step_pyramids(), so that stacks and single time steps share their data tiles and
+    tile statistics. The stack pyramid itself has no tile statistics.
+    :param index: a tuple ((start, stop), index, ...), see _get_stack_index_from_req()
+    """
+    (start, stop), other_index = index[0], index[1:]
+    leading_shape = _open_dataset(file_path)[var_name].shape[:-2]
+    # Variables whose leading dimensions all have a single element have a single data pyramid,
+    # see _get_index_from_req()
+    step_indexes = [(step,) + other_index if any(size != 1 for size in leading_shape) else None
+                    for step in range(start, stop)]
+    pyramids = _get_stack_step_pyramids(file_path, var_name, step_indexes)
+    pyramid = pyramids[0]
+    aggregation = CONFIG.get('TILE_PYRAMID_AGGREGATION') or 'strided'
+    level_images = [StackedArrayImage([step_pyramid.get_level_image(z_index) for step_pyramid in pyramids],
+                                      image_id='%s|%s%s|%s|stack-L%d' % (file_path, var_name, _get_index_id(index),
+                                                                         aggregation, z_index))
+                    for z_index in range(pyramid.num_levels)]
+    return ImagePyramid(pyramid.num_level_zero_tiles, pyramid.tile_size, level_images)
+
+
+def _is_stack_index(index):
+    # See _get_stack_index_from_req()
+    return bool(index) and isinstance(index[0], tuple)
+
+
+def _create_strided_pyramid(file_path, var_name, variable, index):
+    # Image IDs are derived from the request parameters, so that tile IDs remain valid across restarts,
+    # see _get_tile_source_path()
+    pyramid = ImagePyramid.create_from_array(variable,
+                                             image_id='%s|%s%s' % (file_path, var_name, _get_index_id(index)),
+                                             index=index)
+    tile_stats = _load_tile_stats(file_path, var_name, index, pyramid.num_level_zero_tiles, pyramid.num_levels)
+    flip_y = is_y_flipped(variable)
+    level_images = [TransformArrayImage(pyramid.get_level_image(z_index),
+                                        no_data_value=variable.fillvalue,
+                                        force_masked=True,
+                                        flip_y=flip_y,
+                                        image_id='%s|masked' % pyramid.get_level_image(z_index).id,
+                                        tile_stats=tile_stats.get_level(z_index))
+                    for z_index in range(pyramid.num_levels)]
+    return ImagePyramid(pyramid.num_level_zero_tiles, pyramid.tile_size, level_images, tile_stats=tile_stats)
+
+
+def _create_overview_pyramid(file_path, var_name, variable, aggregation, index):
+    # Only the highest level reads the variable, each lower level aggregates the (cached) masked tiles
+    # of the level above, so that every HDF-5 chunk is decoded at most once per pyramid
+    aggregator = AGGREGATORS.get(aggregation)
+    if aggregator is None:
+        raise ValueError('illegal TILE_PYRAMID_AGGREGATION %r, must be one of %s'
+                         % (aggregation, ', '.join(sorted(AGGREGATORS.keys()))))
+    max_size, tile_size, num_level_zero_tiles, num_levels = ImagePyramid.compute_layout(array=variable)
+    tile_stats = _load_tile_stats(file_path, var_name, index, num_level_zero_tiles, num_levels)
+    flip_y = is_y_flipped(variable)
+
+    def mask_level_image(level_image, z_index):
+        # Lower levels are computed from flipped tiles already
+        return TransformArrayImage(level_image,
+                                   no_data_value=variable.fillvalue,
+                                   force_masked=True,
+                                   flip_y=flip_y and z_index == num_levels - 1,
+                                   image_id='%s|masked' % level_image.id,
+                                   tile_stats=tile_stats.get_level(z_index))
+
+    pyramid = ImagePyramid.create_overviews_from_array(variable,
+                                                       tile_size=tile_size,
+                                                       num_level_zero_tiles=num_level_zero_tiles,
+                                                       num_levels=num_levels,
+                                                       aggregator=aggregator,
+                                                       level_transform=mask_level_image,
+                                                       image_id='%s|%s%s|%s' % (file_path, var_name,
+                                                                                 _get_index_id(index), aggregation),
+                                                       index=index)
+    level_images = [pyramid.get_level_image(z_index) for z_index in range(num_levels)]
+    return ImagePyramid(num_level_zero_tiles, tile_size, level_images, tile_stats=tile_stats)
+
+
+def _get_index_id(index):
+    # Appended to image IDs and file names of the data pyramid of a 2D slice of a variable,
+    # and to the image IDs of a stack of 2D slices, see _create_stack_pyramid()
+    if index is None:
+        return ''
+    return '[%s]' % ','.join('%d:%d' % i if isinstance(i, tuple) else str(i) for i in index)
+
+
+def _get_tile_stats_path(file_path, var_name, index=None):
+    # Overview pyramids have different lower level values than strided ones
+    aggregation = CONFIG.get('TILE_PYRAMID_AGGREGATION')
+    var_name = var_name.replace('/', '_') + _get_index_id(index) + ('.' + aggregation if aggregation else '')
+    return '%s.%s%s' % (file_path, var_name, TileStatsTree.FILE_EXT)
+
+
+def _load_tile_stats(file_path, var_name, index, num_level_zero_tiles, num_levels):
+    """
+    Load the persisted tile statistics of a variable's data pyramid, if they are still valid,
+    otherwise create new ones.
+    """
+    source_mtime = os.path.getmtime(file_path)
+    sidecar_path = get_sidecar_path(file_path, var_name)
+    if os.path.exists(sidecar_path):
+        # Lower levels may be read from a sidecar built after the statistics
+        source_mtime = max(source_mtime, os.path.getmtime(sidecar_path))
+    stats_path = _get_tile_stats_path(file_path, var_name, index)
+    if CONFIG.get('TILE_STATS_PERSIST', True) and os.path.exists(stats_path):
+        try:
+            return TileStatsTree.load(stats_path,
+                                      num_level_zero_tiles=num_level_zero_tiles,
+                                      num_levels=num_levels,
+                                      source_mtime=source_mtime)
+        except (OSError, ValueError, KeyError) as e:
+            print('WARNING: ignoring tile statistics %s: %s' % (stats_path, e))
+    return TileStatsTree(num_level_zero_tiles, num_levels, source_mtime=source_mtime)
+
+
+def _save_tile_stats(file_path=None):
+    """
+    Save the changed tile statistics of all data pyramids, or of those of the given file, next to the data files.
+    """
+    with GLOBAL_LOCK:
+        items = [(key, pyramid.tile_stats) for pyramids in (DATA_PYRAMIDS, STACK_STEP_PYRAMIDS)
+                 for key, pyramid in pyramids.items() if file_path is None or key[0] == file_path]
+    _save_tile_stats_items(items)
+
+
+def _save_tile_stats_items(items):
+    # The items are (data pyramid key, tile statistics) pairs
+    if not CONFIG.get('TILE_STATS_PERSIST', True):
+        return
+    for (data_file_path, var_name, index), tile_stats in items:
+        if tile_stats.num_changes == 0:
+            continue
+        stats_path = _get_tile_stats_path(data_file_path, var_name, index)
+        try:
+            tile_stats.save(stats_path)
+        except OSError as e:
+            print('WARNING: failed to save tile statistics %s: %s' % (stats_path, e))
+
+
+def _get_color_mapped_pyramid(file_path, var_name, cmap_name, cmap_min, cmap_max, encoding=('PNG', ()),
+                              index=None):
+    """
+    Get a lightweight pyramid of encoded tiles that color-maps the tiles of the variable's data pyramid.
+    Only the MAX_NUM_PYRAMIDS most recently used color-mapped pyramids are kept.
+    :param encoding: the tile encoding, see _get_tile_encoding()
+    :param index: the indexes into the variable's leading dimensions, see _get_data_pyramid(),
+           or the range of time steps of a tile stack, see _create_stack_pyramid()
+    """
+    key = (file_path, var_name, cmap_name, cmap_min, cmap_max, encoding, index)
+    tile_format, options = encoding
+    encoding_id = _get_tile_encoding_id(encoding)
+
+    def create_pyramid():
+        if _is_stack_index(index):
+            pyramid = _create_stack_pyramid(file_path, var_name, index)
+        else:
+            pyramid = _get_data_pyramid(file_path, var_name, index=index)
+        return pyramid.apply(lambda image: ColorMappedRgbaImage(image,
+                                                                value_range=(cmap_min, cmap_max),
+                                                                cmap_name=cmap_name,
+                                                                encode=True, format=tile_format,
+                                                                tile_cache=_SHARED_TILE_CACHE,
+                                                                render_pool=_TILE_RENDER_POOL,
+                                                                image_id='%s|%s|%s|%s|%s' % (image.id,
+                                                                                             cmap_name,
+                                                                                             cmap_min,
+                                                                                             cmap_max,
+                                                                                             encoding_id),
+                                                                **dict(options)))
+
+    return _get_cached_pyramid(key, create_pyramid)
+
+
+def _get_data_tile_pyramid(file_path, var_name, dtype, value_range=None, index=None):
+    """
+    Get a lightweight pyramid of data tiles, see data_tiles module, of the tiles of the variable's data pyramid.
+    It shares the MAX_NUM_PYRAMIDS most recently used pyramids with the color-mapped pyramids.
+    :param dtype: the quantized type, one of the keys of DATA_TILE_DTYPES
+    :param value_range: an optional (min, max) range of the quantized values, default is per tile
+    :param index: the indexes into the variable's leading dimensions, see _get_data_pyramid()
+    """
+    # The data type and range take the places of the colormap and its range in the keys of color-mapped pyramids
+    key = (file_path, var_name, 'data', value_range, None, dtype, index)
+    range_id = '%s|%s' % value_range if value_range is not None else 'tile'
+    compress_level = CONFIG.get('TILE_DATA_COMPRESS_LEVEL', DEFAULT_DATA_TILE_COMPRESS_LEVEL)
+
+    def create_pyramid():
+        pyramid = _get_data_pyramid(file_path, var_name, index=index)
+        return pyramid.apply(lambda image: QuantizedDataImage(image,
+                                                              dtype=dtype,
+                                                              value_range=value_range,
+                                                              compress_level=compress_level,
+                                                              tile_cache=_SHARED_TILE_CACHE,
+                                                              image_id='%s|data|%s|%s|%s' % (image.id, dtype,
+                                                                                             range_id,
+                                                                                             compress_level)))
+
+    return _get_cached_pyramid(key, create_pyramid)
+
+
+def _get_cached_pyramid(key, create_pyramid):
+    # Pyramids are kept in PYRAMIDS, most recently used last
+    with GLOBAL_LOCK:
+        pyramid = PYRAMIDS.get(key)
+        if pyramid is not None:
+            PYRAMIDS.move_to_end(key)
+            return pyramid
+    pyramid = create_pyramid()
+    with GLOBAL_LOCK:
+        PYRAMIDS[key] = pyramid
+        while len(PYRAMIDS) > MAX_NUM_PYRAMIDS:
+            PYRAMIDS.popitem(last=False)
+    return pyramid
+
+
+def _get_color_mapped_pyramid_from_req(req, file_path, var_name, ext, index=None):
+    """
+    Get the color-mapped pyramid of a variable given by the request parameters 'cmap', 'min', 'max' and those
+    of the tile encoding, see _get_tile_encoding().
+    :param ext: the tile format's file extension or None, see _get_tile_format()
+    :param index: the indexes into the variable's leading dimensions, see _get_index_from_req()
+    :return: a (pyramid, media_type) tuple
+    """
+    cmap_name = req.get_param('cmap', default='jet')
+    cmap_min = _get_param_as_float(req, 'min', default=0.0)
+    cmap_max = _get_param_as_float(req, 'max', default=1.0)
+
+    tile_format, media_type = _get_tile_format(req, ext, cmap_name)
+    encoding = _get_tile_encoding(req, tile_format)
+
+    pyramid = _get_color_mapped_pyramid(file_path, var_name, cmap_name, cmap_min, cmap_max, encoding=encoding,
+                                        index=index)
+    return pyramid, media_type
+
+
+def _get_index_from_req(req, file_path, var_name):
+    """
+    Get the indexes into the leading dimensions of a variable, e.g. time, depth or band, given by the list
+    parameter 'index', whose 2D slice is read. Missing indexes are 0.
+    :return: a tuple of indexes, or None if all leading dimensions have a single element
+    """
+    leading_shape = _open_dataset(file_path)[var_name].shape[:-2]
+    index = _get_index_items_from_req(req, leading_shape)
+    if all(size == 1 for size in leading_shape):
+        # Nothing to select, the pyramid is that of the whole variable
+        return None
+    return tuple(index)
+
+
+def _get_stack_index_from_req(req, file_path, var_name):
+    """
+    Get the range of the first leading dimension of a variable, usually time, given by the parameters 'start'
+    (inclusive, default 0) and 'stop' (exclusive, default all), and the indexes into the other leading dimensions
+    given by the list parameter 'index', see _get_index_from_req().
+    :return: a tuple ((start, stop), index, ...)
+    """
+    leading_shape = _open_dataset(file_path)[var_name].shape[:-2]
+    if not leading_shape:
+        raise falcon.HTTPBadRequest('Illegal query parameter', 'variable \'%s\' has no time dimension' % var_name)
+    num_steps = leading_shape[0]
+    start = _get_optional_param_as_int(req, 'start', 0, min_value=0, max_value=num_steps - 1)
+    stop = _get_optional_param_as_int(req, 'stop', num_steps, min_value=start + 1, max_value=num_steps)
+    max_num_steps = CONFIG.get('TILE_STACK_MAX_STEPS', MAX_NUM_STACK_STEPS)
+    if stop - start > max_num_steps:
+        raise falcon.HTTPBadRequest('Illegal query parameter',
+                                    'a tile stack must not have more than %d time steps' % max_num_steps)
+    return ((start, stop),) + tuple(_get_index_items_from_req(req, leading_shape[1:]))
+
+
+def _get_index_items_from_req(req, leading_shape):
+    # The indexes of the list parameter 'index' into the given leading dimensions, missing indexes are 0
+    items = _get_param_as_list(req, 'index')
+    if len(items) > len(leading_shape):
+        raise falcon.HTTPBadRequest('Illegal query parameter',
+                                    'parameter \'index\' must not have more than %d items' % len(leading_shape))
+    try:
+        index = [int(item) for item in items]
+    except ValueError:
+        raise falcon.HTTPBadRequest('Illegal query parameter', 'items of parameter \'index\' must be integers')
+    index += [0] * (len(leading_shape) - len(index))
+    for dim, (i, size) in enumerate(zip(index, leading_shape)):
+        if not 0 <= i < size:
+            raise falcon.HTTPBadRequest('Illegal query parameter',
+                                        'index %d of dimension %d must be in the range 0 to %d' % (i, dim, size - 1))
+    return index
+
+
 class FileVarTile:
     def on_get(self, req, resp, z, y, x):
         # GLOBAL_LOCK.acquire()
 
+        # The tile format is given by the extension of x, e.g. '0.webp', or negotiated by the Accept header
+        x, _, ext = x.partition('.')
+        z, y, x = _get_tile_index_from_path(z, y, x)
+
         file_path = _get_file_from_req(req)
-        dataset = _open_dataset(file_path)
 
         var_name = req.get_param('var', required=True)
         cmap_name = req.get_param('cmap', default='jet')
-        cmap_min = _get_param_as_float(req, 'min', default=0.0)
-        cmap_max = _get_param_as_float(req, 'max', default=1.0)
+        index = _get_index_from_req(req, file_path, var_name)
 
-        image_id = '%s|%s|%s|%s|%s' % (file_path, var_name, cmap_name, cmap_min, cmap_max)
+        pyramid, media_type = _get_color_mapped_pyramid_from_req(req, file_path, var_name, ext or None, index=index)
+        if not _has_tile(pyramid, z, y, x):
+            raise falcon.HTTPNotFound()
 
-        global PYRAMIDS
-        if image_id in PYRAMIDS:
-            pyramid = PYRAMIDS[image_id]
+        print('PERF: >>> Tile:', current_thread(), file_path, var_name, cmap_name, z, y, x)
+
+        prefetcher = _TILE_PREFETCHER
+        t1 = time.perf_counter()
+        if prefetcher is not None:
+            prefetcher.record_request(pyramid.get_level_image(z).get_tile_id(x, y))
+            with prefetcher.serving():
+                tile = pyramid.get_tile(x, y, z)
+            prefetcher.prefetch(pyramid, x, y, z, client_key=req.remote_addr, pyramid_key=(file_path, var_name, index))
         else:
-            variable = dataset[var_name]
+            tile = pyramid.get_tile(x, y, z)
+        t2 = time.perf_counter()
+
+        if not ext:
+            resp.set_header('Vary', 'Accept')
+        if is_empty_tile(tile) and _get_param_as_bool(req, 'no_content',
+                                                      default=CONFIG.get('TILE_EMPTY_NO_CONTENT', False)):
+            # Let clients skip fully transparent tiles
+            resp.status = falcon.HTTP_NO_CONTENT
+        else:
+            resp.data = tile
+            resp.content_type = media_type
+            resp.status = falcon.HTTP_OK
+
+        print('PERF: <<< Tile:', current_thread(), file_path, var_name, cmap_name, z, y, x, 'took', t2 - t1, 'seconds')
+        # GLOBAL_LOCK.release()
 
-            pyramid = ImagePyramid.create_from_array(variable)
-            pyramid = pyramid.apply(lambda image: TransformArrayImage(image,
-                                                                      no_data_value=variable.fillvalue,
-                                                                      force_masked=True,
-                                                                      flip_y=is_y_flipped(variable)))
-            pyramid = pyramid.apply(lambda image: ColorMappedRgbaImage(image,
-                                                                       value_range=(cmap_min, cmap_max),
-                                                                       cmap_name=cmap_name,
-                                                                       encode=True, format='PNG'))
-            PYRAMIDS[image_id] = pyramid
-            print('num_level_zero_tiles:', pyramid.num_level_zero_tiles)
-            print('num_levels:', pyramid.num_levels)
 
-        print('PERF: >>> Tile:', current_thread(), file_path, var_name, cmap_name, z, y, x)
+class FileVarDataTile:
+    def on_get(self, req, resp, z, y, x):
+        """
+        Get the data behind a tile of FileVarTile as data tile, see data_tiles module, whose values are quantized
+        to the type given by the parameter 'dtype', 'uint8', 'uint16' (the default) or 'float16'.
+        Integer values are scaled to the value range given by the parameters 'min' and 'max', or to the range of
+        the tile's values if they aren't given. The other parameters are 'file', 'var' and 'index'.
+        """
+        z, y, x = _get_tile_index_from_path(z, y, x)
+        file_path = _get_file_from_req(req)
+        var_name = req.get_param('var', required=True)
+        index = _get_index_from_req(req, file_path, var_name)
+        dtype = req.get_param('dtype', default='uint16')
+        if dtype not in DATA_TILE_DTYPES:
+            raise falcon.HTTPBadRequest('Illegal query parameter',
+                                        'parameter \'dtype\' must be one of %s' % ', '.join(DATA_TILE_DTYPES.keys()))
+        value_range = None
+        if req.get_param('min') is not None or req.get_param('max') is not None:
+            value_range = (_get_param_as_float(req, 'min'), _get_param_as_float(req, 'max'))
+            if not value_range[1] > value_range[0]:
+                raise falcon.HTTPBadRequest('Illegal query parameter', 'parameter \'max\' must be greater than \'min\'')
+
+        pyramid = _get_data_tile_pyramid(file_path, var_name, dtype, value_range=value_range, index=index)
+        if not _has_tile(pyramid, z, y, x):
+            raise falcon.HTTPNotFound()
+
+        resp.data = pyramid.get_tile(x, y, z)
+        resp.content_type = DATA_TILE_MEDIA_TYPE
+        resp.status = falcon.HTTP_OK
+
+
+class FileVarTileStack:
+    def on_get(self, req, resp, z, y, x):
+        """
+        Get a tile for a range of time steps, given by the parameters 'start' and 'stop', see
+        _get_stack_index_from_req(), as a single PNG sprite sheet of the time steps' tiles from top to bottom.
+        All other parameters are those of FileVarTile. Palette PNGs share a single palette between all time steps.
+
+        The tile is assembled from the (cached) data tiles of the time steps and cached as a unit. The X-Tile-Stack
+        header gives the time steps '<start>:<stop>', so that frame i is the i-th tile height high part of the
+        sprite sheet.
+        """
+        x, _, ext = x.partition('.')
+        if ext and ext != 'png':
+            raise falcon.HTTPNotFound()
+        z, y, x = _get_tile_index_from_path(z, y, x)
+
+        file_path = _get_file_from_req(req)
+        var_name = req.get_param('var', required=True)
+        cmap_name = req.get_param('cmap', default='jet')
+        cmap_min = _get_param_as_float(req, 'min', default=0.0)
+        cmap_max = _get_param_as_float(req, 'max', default=1.0)
+        index = _get_stack_index_from_req(req, file_path, var_name)
+        encoding = _get_tile_encoding(req, 'PNG')
 
-        t1 = time.clock()
-        tile = pyramid.get_tile(int(x), int(y), int(z))
-        t2 = time.clock()
+        pyramid = _get_color_mapped_pyramid(file_path, var_name, cmap_name, cmap_min, cmap_max, encoding=encoding,
+                                            index=index)
+        if not _has_tile(pyramid, z, y, x):
+            raise falcon.HTTPNotFound()
 
-        resp.data = tile
-        resp.content_type = 'image/png'
+        resp.data = pyramid.get_tile(x, y, z)
+        resp.content_type = TILE_FORMATS['png'][1]
+        resp.set_header('X-Tile-Stack', '%d:%d' % index[0])
         resp.status = falcon.HTTP_OK
 
-        print('PERF: <<< Tile:', current_thread(), file_path, var_name, cmap_name, z, y, x, 'took', t2 - t1, 'seconds')
-        # GLOBAL_LOCK.release()
+
+class FileVarTiles:
+    def on_get(self, req, resp):
+        """
+        Get a batch of tiles of one or more variables, given by the list parameters 'var' and 'tiles',
+        whose items are of the form '<z>/<y>/<x>'. All other parameters are those of FileVarTile, the tile format
+        is given by the optional parameter 'format', e.g. 'webp', or negotiated by the Accept header.
+
+        The tiles are computed in parallel and streamed back as they are finished, as the parts of a
+        multipart/mixed body. Every part has a Content-Length header, an X-Tile header '<var>/<z>/<y>/<x>'
+        and an X-Tile-Status header, which is 200, or 204 for empty tiles if 'no_content' is set,
+        or 500 if the tile could not be computed.
+        """
+        file_path = _get_file_from_req(req)
+        var_names = _get_param_as_list(req, 'var', required=True)
+        tile_indexes = _get_tile_indexes_from_req(req)
+        ext = req.get_param('format')
+        if ext is not None and ext not in TILE_FORMATS:
+            raise falcon.HTTPBadRequest('Illegal query parameter',
+                                        'parameter \'format\' must be one of %s' % ', '.join(TILE_FORMATS.keys()))
+        no_content = _get_param_as_bool(req, 'no_content', default=CONFIG.get('TILE_EMPTY_NO_CONTENT', False))
+
+        tiles = []
+        for var_name in var_names:
+            index = _get_index_from_req(req, file_path, var_name)
+            pyramid, media_type = _get_color_mapped_pyramid_from_req(req, file_path, var_name, ext, index=index)
+            for z, y, x in tile_indexes:
+                if not _has_tile(pyramid, z, y, x):
+                    raise falcon.HTTPBadRequest('Illegal query parameter', 'illegal tile %d/%d/%d' % (z, y, x))
+                tiles.append((var_name, pyramid, media_type, z, y, x))
+
+        if not ext:
+            resp.set_header('Vary', 'Accept')
+        boundary = uuid.uuid4().hex
+        resp.content_type = 'multipart/mixed; boundary=%s' % boundary
+        resp.stream = _generate_tile_parts(tiles, boundary, no_content)
+        resp.status = falcon.HTTP_OK
+
+
+def _get_tile_indexes_from_req(req):
+    items = _get_param_as_list(req, 'tiles', required=True)
+    max_num_tiles = CONFIG.get('TILE_BATCH_MAX_TILES', MAX_NUM_BATCH_TILES)
+    if len(items) > max_num_tiles:
+        raise falcon.HTTPBadRequest('Illegal query parameter',
+                                    'parameter \'tiles\' must not have more than %d items' % max_num_tiles)
+    tile_indexes = []
+    for item in items:
+        try:
+            tile_indexes.append(_parse_tile_index(*item.split('/')))
+        except (TypeError, ValueError):
+            raise falcon.HTTPBadRequest('Illegal query parameter',
+                                        'items of parameter \'tiles\' must be of the form <z>/<y>/<x> '
+                                        'of non-negative integers')
+    return tile_indexes
+
+
+def _get_tile_index_from_path(z, y, x):
+    """
+    Get the tile index given by the path segments z, y and x of a tile request.
+    :return: a tuple (z, y, x) of integers
+    :raise falcon.HTTPBadRequest: if the indexes are not non-negative integers
+    """
+    try:
+        return _parse_tile_index(z, y, x)
+    except ValueError:
+        raise falcon.HTTPBadRequest('Illegal tile', 'tile indexes must be non-negative integers, '
+                                                    'got %s/%s/%s' % (z, y, x))
+
+
+def _parse_tile_index(z, y, x):
+    # Raises ValueError, if the indexes are not non-negative integers
+    z, y, x = int(z), int(y), int(x)
+    if z < 0 or y < 0 or x < 0:
+        raise ValueError('illegal tile %d/%d/%d' % (z, y, x))
+    return z, y, x
+
+
+def _has_tile(pyramid, z, y, x):
+    if z >= pyramid.num_levels:
+        return False
+    num_tiles_x, num_tiles_y = pyramid.get_level_image(z).num_tiles
+    return x < num_tiles_x and y < num_tiles_y
+
+
+def _get_tile_batch_executor():
+    global _TILE_BATCH_EXECUTOR
+    with GLOBAL_LOCK:
+        if _TILE_BATCH_EXECUTOR is None:
+            _TILE_BATCH_EXECUTOR = ThreadPoolExecutor(max_workers=CONFIG.get('TILE_BATCH_WORKERS', 4))
+        return _TILE_BATCH_EXECUTOR
+
+
+def _compute_batch_tile(pyramid, x, y, z):
+    prefetcher = _TILE_PREFETCHER
+    if prefetcher is None:
+        return pyramid.get_tile(x, y, z)
+    prefetcher.record_request(pyramid.get_level_image(z).get_tile_id(x, y))
+    with prefetcher.serving():
+        return pyramid.get_tile(x, y, z)
+
+
+def _generate_tile_parts(tiles, boundary, no_content):
+    """
+    Compute tiles in parallel and generate the parts of a multipart/mixed body in the order the tiles are finished.
+    :param tiles: a list of (var_name, pyramid, media_type, z, y, x) tuples
+    """
+    executor = _get_tile_batch_executor()
+    futures = OrderedDict((executor.submit(_compute_batch_tile, pyramid, x, y, z), (var_name, media_type, z, y, x))
+                          for var_name, pyramid, media_type, z, y, x in tiles)
+    delimiter = ('--%s\r\n' % boundary).encode('ascii')
+    try:
+        for future in as_completed(futures):
+            var_name, media_type, z, y, x = futures[future]
+            try:
+                data = future.result()
+                status = 204 if no_content and is_empty_tile(data) else 200
+                if status == 204:
+                    data = b''
+            except Exception as e:
+                print('WARNING: computing tile %s/%d/%d/%d failed: %s' % (var_name, z, y, x, e))
+                data = str(e).encode('utf-8')
+                media_type = 'text/plain; charset=utf-8'
+                status = 500
+            headers = ('Content-Type: %s\r\n'
+                       'Content-Length: %d\r\n'
+                       'X-Tile: %s/%d/%d/%d\r\n'
+                       'X-Tile-Status: %d\r\n'
+                       '\r\n') % (media_type, len(data), var_name, z, y, x, status)
+            yield delimiter + headers.encode('utf-8') + data + b'\r\n'
+        yield ('--%s--\r\n' % boundary).encode('ascii')
+    finally:
+        # The client may have gone
+        for future in futures:
+            future.cancel()
 
 
 class FileOpen:
@@ -494,6 +1307,52 @@ class About:
         resp.status = falcon.HTTP_OK
 
 
+class CacheStats:
+    def on_get(self, req, resp):
+        tile_cache = get_default_tile_cache()
+        chunk_cache = get_default_chunk_cache()
+        resp.body = json.dumps({
+            'tileCache': tile_cache.get_stats() if tile_cache is not None else None,
+            'sharedTileCache': _SHARED_TILE_CACHE.get_stats() if _SHARED_TILE_CACHE is not None else None,
+            'tileComputations': get_tile_computation_stats(),
+            'chunkCache': chunk_cache.get_stats() if chunk_cache is not None else None,
+            'chunkReads': get_chunk_read_stats(),
+            'tilePrefetch': _TILE_PREFETCHER.get_stats() if _TILE_PREFETCHER is not None else None,
+            'tileRender': _TILE_RENDER_POOL.get_stats() if _TILE_RENDER_POOL is not None else None,
+        })
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_OK
+
+
+class FileVarStats:
+    def on_get(self, req, resp):
+        """
+        Get the per-tile statistics of a variable: a summary of all levels, or the statistics of all known tiles
+        of level 'z', or, if also given, the value range and the tiles that are not known to be empty
+        of the viewport given by the tile coordinates 'x0', 'y0' (inclusive) and 'x1', 'y1' (exclusive).
+        """
+        file_path = _get_file_from_req(req)
+        var_name = req.get_param('var', required=True)
+        index = _get_index_from_req(req, file_path, var_name)
+        tile_stats = _get_data_pyramid(file_path, var_name, index=index).tile_stats
+
+        z = req.get_param('z')
+        if z is None:
+            result = tile_stats.to_dict()
+        else:
+            z = _get_param_as_int(req, 'z', min_value=0, max_value=tile_stats.num_levels - 1)
+            if req.get_param('x0') is None:
+                result = dict(z=z, tiles=tile_stats.to_dict(z))
+            else:
+                viewport = [_get_param_as_int(req, name, min_value=0) for name in ('x0', 'y0', 'x1', 'y1')]
+                result = tile_stats.get_value_range(z, *viewport)
+                result.update(z=z, non_empty_tiles=tile_stats.get_non_empty_tiles(z, *viewport))
+
+        resp.body = json.dumps(result)
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_OK
+
+
 class NE2:
     import ccitbxws.data_sources as ds
 
@@ -510,12 +1369,17 @@ def main(args=sys.argv):
     # Create instance of our CCI Toolbox' RESTful API, which is a WSGI application instance.
     api = falcon.API(after=[crossdomain])
     api.add_route('/ccitbx', About())
+    api.add_route('/ccitbx/CacheStats', CacheStats())
     api.add_route('/ccitbx/FileOpen', FileOpen())
     api.add_route('/ccitbx/FileClose', FileClose())
     api.add_route('/ccitbx/FileMetadata', FileMetadata())
     api.add_route('/ccitbx/FileVariable', FileVariable())
     api.add_route('/ccitbx/FileTimeSeries', FileTimeSeries())
-    api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}.png', FileVarTile())
+    api.add_route('/ccitbx/FileVarStats', FileVarStats())
+    api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}', FileVarTile())
+    api.add_route('/ccitbx/FileVarTiles', FileVarTiles())
+    api.add_route('/ccitbx/FileVarTileStack/{z}/{y}/{x}', FileVarTileStack())
+    api.add_route('/ccitbx/FileVarDataTile/{z}/{y}/{x}', FileVarDataTile())
     api.add_route('/ccitbx/ColorMaps', ColorMaps())
     api.add_route('/ccitbx/Test', Test())
     api.add_route('/ccitbx/Exit', Exit())
@@ -524,6 +1388,12 @@ def main(args=sys.argv):
     # Natural Earth v2 imagery provider for testing, see NaturalEarth2Image class
     api.add_route('/ccitbx/ne2/{z}/{y}/{x}.jpg', NE2())
 
+    # Worker processes are forked before any threads are started
+    _init_tile_render_pool()
+    _init_tile_cache()
+    _init_tile_prefetcher()
+    cherrypy.engine.subscribe('stop', _save_tile_stats)
+
     # Start a web server with our WSGI application. We use CherryPy here.
     # See docs.cherrypy.org/en/latest/advanced.html?host-a-foreign-wsgi-application-in-cherrypy#host-a-foreign-wsgi-application-in-cherrypy
     cherrypy.tree.graft(api, '/')
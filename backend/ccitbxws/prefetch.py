@@ -0,0 +1,292 @@
+"""
+Speculative background computation of the tiles a client is likely to request next.
+"""
+
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Condition, Thread
+
+DEFAULT_NUM_WORKERS = 2
+DEFAULT_MAX_PENDING_PER_CLIENT = 16
+DEFAULT_MAX_PENDING_PER_PYRAMID = 64
+DEFAULT_MAX_CACHE_LOAD = 0.9
+DEFAULT_PRESSURE_WINDOW = 10.0
+
+# Number of recently prefetched tile IDs remembered for the hit ratio
+_MAX_NUM_PREFETCHED = 4096
+
+
+class TilePrefetcher:
+    """
+    Prefetches the tiles around a served tile of an image pyramid: the ring of its neighbours at the same level,
+    its parent, and its children. Clients pan and zoom predictably, so these are likely the next tiles requested.
+
+    Prefetches run on a small pool of daemon threads at low priority: workers wait while tiles are being served,
+    see serving(). The most recent prefetches run first, and the oldest pending ones are dropped when a client
+    or pyramid has too many. Nothing is prefetched while the tile cache is under pressure, so that prefetched tiles
+    do not flush out tiles that have been requested.
+
+    A full cache stays close to its maximum size, so its size alone doesn't tell pressure. Instead, a cache is under
+    pressure if it is nearly full and has recently evicted more than what fits into its free margin, i.e. its
+    contents are being replaced quickly.
+    """
+
+    class Task:
+        __slots__ = ('pyramid', 'tile_x', 'tile_y', 'z_index', 'tile_id', 'client_key', 'pyramid_key')
+
+        def __init__(self, pyramid, tile_x, tile_y, z_index, tile_id, client_key, pyramid_key):
+            self.pyramid = pyramid
+            self.tile_x = tile_x
+            self.tile_y = tile_y
+            self.z_index = z_index
+            self.tile_id = tile_id
+            self.client_key = client_key
+            self.pyramid_key = pyramid_key
+
+    def __init__(self,
+                 num_workers=DEFAULT_NUM_WORKERS,
+                 max_pending_per_client=DEFAULT_MAX_PENDING_PER_CLIENT,
+                 max_pending_per_pyramid=DEFAULT_MAX_PENDING_PER_PYRAMID,
+                 max_cache_load=DEFAULT_MAX_CACHE_LOAD,
+                 pressure_window=DEFAULT_PRESSURE_WINDOW,
+                 tile_cache=None):
+        """
+        Constructor.
+        :param num_workers: number of worker threads
+        :param max_pending_per_client: maximum number of pending prefetches of a client
+        :param max_pending_per_pyramid: maximum number of pending prefetches of a pyramid
+        :param max_cache_load: the cache is under pressure if its size exceeds this fraction of its maximum size
+               and it has evicted more than the remaining fraction of its maximum size within the pressure window
+        :param pressure_window: the time in seconds over which evictions are counted
+        :param tile_cache: an optional cache, e.g. the default tile cache, whose pressure stops prefetching
+               in addition to the caches of the prefetched tiles
+        """
+        self._max_pending_per_client = max_pending_per_client
+        self._max_pending_per_pyramid = max_pending_per_pyramid
+        self._max_cache_load = max_cache_load
+        self._pressure_window = pressure_window
+        self._tile_cache = tile_cache
+        # Cache -> [window start time, evicted size at window start, evicted size in the previous window]
+        self._eviction_windows = weakref.WeakKeyDictionary()
+        self._condition = Condition()
+        self._tasks = deque()
+        self._pending_ids = set()
+        self._num_pending_per_client = {}
+        self._num_pending_per_pyramid = {}
+        self._num_serving = 0
+        self._shutdown = False
+        # Prefetched tile ID -> True if it has been requested since
+        self._prefetched = OrderedDict()
+        self._num_scheduled = 0
+        self._num_dropped = 0
+        self._num_skipped = 0
+        self._num_prefetched = 0
+        self._num_failed = 0
+        self._num_requests = 0
+        self._num_hits = 0
+        self._workers = [Thread(target=self._run, name='TilePrefetcher-%d' % i, daemon=True)
+                         for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @contextmanager
+    def serving(self):
+        """
+        A context in which a requested tile is served, prefetches wait until all requested tiles are served.
+        """
+        with self._condition:
+            self._num_serving += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._num_serving -= 1
+                if self._num_serving == 0:
+                    self._condition.notify_all()
+
+    def record_request(self, tile_id):
+        """
+        Record a request of a tile, for the prefetch hit ratio.
+        """
+        with self._condition:
+            self._num_requests += 1
+            if self._prefetched.get(tile_id) is False:
+                self._prefetched[tile_id] = True
+                self._num_hits += 1
+
+    def prefetch(self, pyramid, tile_x, tile_y, z_index, client_key=None, pyramid_key=None):
+        """
+        Schedule the prefetches of the neighbours, parent and children of a served tile.
+        :param pyramid: the image pyramid, see ImagePyramid
+        :param tile_x: the served tile's x index
+        :param tile_y: the served tile's y index
+        :param z_index: the served tile's level
+        :param client_key: an optional key of the requesting client, e.g. its address
+        :param pyramid_key: an optional key of the pyramid, default is the pyramid itself
+        """
+        pyramid_key = pyramid_key if pyramid_key is not None else id(pyramid)
+        tasks = []
+        for neighbour_x, neighbour_y, neighbour_z in self._get_neighbours(pyramid, tile_x, tile_y, z_index):
+            level_image = pyramid.get_level_image(neighbour_z)
+            if self._is_under_pressure(level_image.tile_cache):
+                with self._condition:
+                    self._num_skipped += 1
+                return
+            tile_id = level_image.get_tile_id(neighbour_x, neighbour_y)
+            if self._is_cached(level_image.tile_cache, tile_id):
+                continue
+            tasks.append(TilePrefetcher.Task(pyramid, neighbour_x, neighbour_y, neighbour_z, tile_id,
+                                             client_key, pyramid_key))
+        with self._condition:
+            if self._shutdown:
+                return
+            # The nearest tiles are run first
+            for task in reversed(tasks):
+                if task.tile_id in self._pending_ids:
+                    continue
+                self._tasks.append(task)
+                self._pending_ids.add(task.tile_id)
+                self._num_scheduled += 1
+                self._add_pending(task, 1)
+                self._drop_excess_tasks(task)
+            self._condition.notify_all()
+
+    def shutdown(self, wait=True):
+        """
+        Stop prefetching, pending prefetches are dropped.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._num_dropped += len(self._tasks)
+            self._tasks.clear()
+            self._pending_ids.clear()
+            self._num_pending_per_client.clear()
+            self._num_pending_per_pyramid.clear()
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def get_stats(self):
+        """
+        :return: a dictionary with the numbers of scheduled, dropped, pending, computed and failed prefetches,
+                 of prefetches skipped because of cache pressure, of tile requests and of requests of prefetched
+                 tiles (hits), the hit ratio, i.e. the fraction of prefetched tiles that have been requested,
+                 and the fraction of requests served by prefetched tiles
+        """
+        with self._condition:
+            num_prefetched = self._num_prefetched
+            num_requests = self._num_requests
+            return dict(num_scheduled=self._num_scheduled,
+                        num_dropped=self._num_dropped,
+                        num_pending=len(self._tasks),
+                        num_skipped=self._num_skipped,
+                        num_prefetched=num_prefetched,
+                        num_failed=self._num_failed,
+                        num_requests=num_requests,
+                        num_hits=self._num_hits,
+                        hit_ratio=self._num_hits / num_prefetched if num_prefetched else 0.0,
+                        request_hit_ratio=self._num_hits / num_requests if num_requests else 0.0)
+
+    @staticmethod
+    def _get_neighbours(pyramid, tile_x, tile_y, z_index):
+        neighbours = []
+        num_tiles_x, num_tiles_y = pyramid.get_level_image(z_index).num_tiles
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                x, y = tile_x + dx, tile_y + dy
+                if (dx or dy) and 0 <= x < num_tiles_x and 0 <= y < num_tiles_y:
+                    neighbours.append((x, y, z_index))
+        if z_index > 0:
+            neighbours.append((tile_x // 2, tile_y // 2, z_index - 1))
+        if z_index < pyramid.num_levels - 1:
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    neighbours.append((2 * tile_x + dx, 2 * tile_y + dy, z_index + 1))
+        return neighbours
+
+    def _is_under_pressure(self, tile_cache):
+        for cache in (tile_cache, self._tile_cache):
+            if cache is not None and cache.size > self._max_cache_load * cache.max_size \
+                    and self._get_recently_evicted_size(cache) > (1.0 - self._max_cache_load) * cache.max_size:
+                return True
+        return False
+
+    def _get_recently_evicted_size(self, cache):
+        # The size evicted within the current or the previous pressure window, whichever is larger
+        now = time.perf_counter()
+        evicted_size = cache.evicted_size
+        with self._condition:
+            window = self._eviction_windows.get(cache)
+            if window is None or evicted_size < window[1]:
+                # First seen, or the cache's statistics have been reset
+                window = self._eviction_windows[cache] = [now, 0, 0]
+            elif now - window[0] >= self._pressure_window:
+                # Evictions of windows longer ago are forgotten
+                previous_evicted_size = evicted_size - window[1] if now - window[0] < 2 * self._pressure_window else 0
+                window[:] = [now, evicted_size, previous_evicted_size]
+            return max(window[2], evicted_size - window[1])
+
+    @staticmethod
+    def _is_cached(tile_cache, tile_id):
+        return tile_cache is not None and tile_cache.contains(tile_id)
+
+    def _add_pending(self, task, amount):
+        for counts, key in ((self._num_pending_per_client, task.client_key),
+                            (self._num_pending_per_pyramid, task.pyramid_key)):
+            count = counts.get(key, 0) + amount
+            if count > 0:
+                counts[key] = count
+            else:
+                counts.pop(key, None)
+
+    def _drop_excess_tasks(self, task):
+        # Drop the oldest pending prefetches of the task's client and pyramid
+        for counts, key, max_count, get_key in ((self._num_pending_per_client, task.client_key,
+                                                 self._max_pending_per_client, lambda t: t.client_key),
+                                                (self._num_pending_per_pyramid, task.pyramid_key,
+                                                 self._max_pending_per_pyramid, lambda t: t.pyramid_key)):
+            while counts.get(key, 0) > max_count:
+                oldest_task = next(t for t in self._tasks if get_key(t) == key)
+                self._tasks.remove(oldest_task)
+                self._pending_ids.discard(oldest_task.tile_id)
+                self._add_pending(oldest_task, -1)
+                self._num_dropped += 1
+
+    def _next_task(self):
+        with self._condition:
+            while not self._shutdown and (not self._tasks or self._num_serving > 0):
+                self._condition.wait()
+            if self._shutdown:
+                return None
+            task = self._tasks.pop()
+            self._add_pending(task, -1)
+            return task
+
+    def _run(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            try:
+                level_image = task.pyramid.get_level_image(task.z_index)
+                if self._is_under_pressure(level_image.tile_cache):
+                    with self._condition:
+                        self._num_skipped += 1
+                    continue
+                task.pyramid.get_tile(task.tile_x, task.tile_y, task.z_index)
+                with self._condition:
+                    self._num_prefetched += 1
+                    self._prefetched[task.tile_id] = self._prefetched.get(task.tile_id, False)
+                    while len(self._prefetched) > _MAX_NUM_PREFETCHED:
+                        self._prefetched.popitem(last=False)
+            except Exception as e:
+                # E.g. the pyramid's dataset has been closed
+                print('WARNING: prefetching tile %s failed: %s' % (task.tile_id, e))
+                with self._condition:
+                    self._num_failed += 1
+            finally:
+                with self._condition:
+                    self._pending_ids.discard(task.tile_id)
@@ -0,0 +1,332 @@
+"""
+Pyramid sidecar files hold the precomputed overview levels of a variable of a HDF-5/NetCDF-4 file.
+
+A sidecar is built offline by the ``ccitbxws-build-pyramid`` tool, which reads the variable once, block by block,
+and aggregates each block down to all lower levels at once. Its levels are stored as datasets ``L0``, ``L1``, ...
+with tile-aligned chunks, next to the data file as ``<file>.<var>.pyramid.h5``. ImagePyramid.create_from_array()
+reads the lower levels from the sidecar, if there is a valid one, so that a tile is a single chunk read
+instead of a strided scan of the variable.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from threading import Lock
+
+import h5py
+import numpy as np
+
+from .utils import AGGREGATORS, aggregate_ndarray_first, downsample_ndarray
+
+SIDECAR_EXT = '.pyramid.h5'
+SIDECAR_FORMAT_VERSION = 1
+
+DEFAULT_BLOCK_SIZE = 1024
+
+_SIDECARS = {}
+_SIDECARS_LOCK = Lock()
+
+# The source variable of a worker process, see _init_worker()
+_WORKER_STATE = {}
+
+
+def get_sidecar_path(file_path, var_name):
+    """
+    Get the path of the pyramid sidecar file of a variable.
+    """
+    return '%s.%s%s' % (file_path, var_name.lstrip('/').replace('/', '_'), SIDECAR_EXT)
+
+
+def open_pyramid_sidecar(array, tile_size, num_level_zero_tiles, num_levels):
+    """
+    Open the pyramid sidecar file of a H5Py dataset, if there is one that matches the given pyramid layout
+    and whose data file has not been modified since. Opened sidecars are kept open until close_pyramid_sidecars()
+    is called.
+
+    :param array: numpy-like array, sidecars are only found for H5Py dataset objects
+    :param tile_size: a tuple (tile_width, tile_height)
+    :param num_level_zero_tiles: a tuple (num_level_zero_tiles_x, num_level_zero_tiles_y)
+    :param num_levels: number of levels
+    :return: a tuple (aggregation, overviews) where overviews is the list of H5Py datasets of the levels
+             0 to num_levels - 2, or None
+    """
+    h5_file = getattr(array, 'file', None)
+    file_path = getattr(h5_file, 'filename', None)
+    if not file_path or num_levels < 2:
+        return None
+    sidecar_path = get_sidecar_path(file_path, array.name)
+    if not os.path.exists(sidecar_path):
+        return None
+    with _SIDECARS_LOCK:
+        sidecar = _SIDECARS.get(sidecar_path)
+        if sidecar is None:
+            try:
+                sidecar = h5py.File(sidecar_path, 'r')
+            except (OSError, IOError) as e:
+                print('WARNING: ignoring pyramid sidecar %s: %s' % (sidecar_path, e))
+                return None
+            _SIDECARS[sidecar_path] = sidecar
+    try:
+        _check_sidecar(sidecar, os.path.getmtime(file_path), array.shape, tile_size, num_level_zero_tiles, num_levels)
+    except (ValueError, KeyError) as e:
+        print('WARNING: ignoring pyramid sidecar %s: %s' % (sidecar_path, e))
+        return None
+    overviews = [sidecar['L%d' % z_index] for z_index in range(num_levels - 1)]
+    return str(sidecar.attrs['aggregation']), overviews
+
+
+def close_pyramid_sidecars(file_path):
+    """
+    Close the opened pyramid sidecar files of all variables of the given data file.
+    """
+    prefix = file_path + '.'
+    with _SIDECARS_LOCK:
+        sidecar_paths = [sidecar_path for sidecar_path in _SIDECARS.keys() if sidecar_path.startswith(prefix)]
+        for sidecar_path in sidecar_paths:
+            _SIDECARS.pop(sidecar_path).close()
+
+
+def _check_sidecar(sidecar, source_mtime, source_shape, tile_size, num_level_zero_tiles, num_levels):
+    attrs = sidecar.attrs
+    if int(attrs['format_version']) != SIDECAR_FORMAT_VERSION:
+        raise ValueError('unsupported format version %s' % attrs['format_version'])
+    if float(attrs['source_mtime']) != source_mtime:
+        raise ValueError('sidecar is outdated')
+    if tuple(attrs['source_shape'].tolist()) != tuple(source_shape):
+        raise ValueError('sidecar is of a different variable shape')
+    if tuple(attrs['tile_size'].tolist()) != tuple(tile_size) \
+            or tuple(attrs['num_level_zero_tiles'].tolist()) != tuple(num_level_zero_tiles) \
+            or int(attrs['num_levels']) != num_levels:
+        raise ValueError('sidecar is of a different pyramid layout')
+    for z_index in range(num_levels - 1):
+        zoom = 1 << (num_levels - 1 - z_index)
+        expected_shape = tuple(source_shape[:-2]) + (source_shape[-2] // zoom, source_shape[-1] // zoom)
+        if sidecar['L%d' % z_index].shape != expected_shape:
+            raise ValueError('level %d is corrupt' % z_index)
+
+
+def build_pyramid_sidecar(file_path,
+                          var_name,
+                          aggregation='nanmean',
+                          tile_size=None,
+                          num_level_zero_tiles=None,
+                          num_levels=None,
+                          num_workers=None,
+                          block_size=DEFAULT_BLOCK_SIZE,
+                          compression='lzf',
+                          monitor=None):
+    """
+    Build the pyramid sidecar file of a variable, written atomically.
+
+    The variable is read once in blocks of whole chunks, whose sizes are multiples of the zoom factor
+    of level zero, so that every block can be aggregated down to all lower levels independently.
+    Blocks are aggregated in parallel by a pool of worker processes.
+
+    :param file_path: the HDF-5/NetCDF-4 file path
+    :param var_name: the variable name
+    :param aggregation: the aggregation, one of the keys of utils.AGGREGATORS
+    :param tile_size: optional tile size (tile_width, tile_height), see ImagePyramid.compute_layout()
+    :param num_level_zero_tiles: optional number of level zero tiles
+    :param num_levels: optional number of levels
+    :param num_workers: number of worker processes, default is the number of CPUs, 0 aggregates in this process
+    :param block_size: the minimum width and height of a block
+    :param compression: the HDF-5 compression filter of the levels, e.g. 'lzf' or 'gzip', or None
+    :param monitor: an optional function called with the number of done and total blocks
+    :return: the sidecar file path
+    """
+    from .image import ImagePyramid
+
+    if aggregation not in AGGREGATORS:
+        raise ValueError('illegal aggregation %r, must be one of %s'
+                         % (aggregation, ', '.join(sorted(AGGREGATORS.keys()))))
+    source_mtime = os.path.getmtime(file_path)
+    with h5py.File(file_path, 'r') as dataset:
+        variable = dataset[var_name]
+        shape = variable.shape
+        dtype = variable.dtype
+        chunks = variable.chunks
+        fill_value = variable.fillvalue
+        _, tile_size, \
+        num_level_zero_tiles, num_levels = ImagePyramid.compute_layout(array=variable,
+                                                                       tile_size=tile_size,
+                                                                       num_level_zero_tiles=num_level_zero_tiles,
+                                                                       num_levels=num_levels)
+    if num_levels < 2:
+        raise ValueError('variable %s has no overview levels' % var_name)
+
+    max_zoom = 1 << (num_levels - 1)
+    height, width = shape[-2], shape[-1]
+    block_height = _get_block_length(chunks[-2] if chunks else None, max_zoom, height, block_size)
+    block_width = _get_block_length(chunks[-1] if chunks else None, max_zoom, width, block_size)
+    # Rows and columns beyond the last multiple of max_zoom are not part of any overview level
+    blocks = [(y, x, min(block_height, height - height % max_zoom - y), min(block_width, width - width % max_zoom - x))
+              for y in range(0, height - height % max_zoom, block_height)
+              for x in range(0, width - width % max_zoom, block_width)]
+
+    sidecar_path = get_sidecar_path(file_path, var_name)
+    dir_path = os.path.dirname(os.path.abspath(sidecar_path))
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=dir_path)
+    os.close(fd)
+    try:
+        with h5py.File(temp_path, 'w') as sidecar:
+            attrs = sidecar.attrs
+            attrs['format_version'] = SIDECAR_FORMAT_VERSION
+            attrs['source_mtime'] = source_mtime
+            attrs['source_shape'] = np.array(shape, dtype=np.int64)
+            attrs['tile_size'] = np.array(tile_size, dtype=np.int64)
+            attrs['num_level_zero_tiles'] = np.array(num_level_zero_tiles, dtype=np.int64)
+            attrs['num_levels'] = num_levels
+            attrs['aggregation'] = aggregation
+            no_data_value = _get_no_data_value(dtype, fill_value)
+            overviews = []
+            for z_index in range(num_levels - 1):
+                zoom = 1 << (num_levels - 1 - z_index)
+                level_shape = tuple(shape[:-2]) + (height // zoom, width // zoom)
+                level_chunks = (1,) * len(shape[:-2]) + (min(tile_size[1], level_shape[-2]),
+                                                          min(tile_size[0], level_shape[-1]))
+                overviews.append(sidecar.create_dataset('L%d' % z_index, shape=level_shape, dtype=dtype,
+                                                        chunks=level_chunks, compression=compression,
+                                                        fillvalue=no_data_value))
+
+            tasks = [(y, x, h, w, num_levels - 1, aggregation) for y, x, h, w in blocks]
+            if num_workers is None:
+                num_workers = multiprocessing.cpu_count()
+            if num_workers > 0:
+                pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(file_path, var_name))
+                try:
+                    _write_blocks(overviews, pool.imap_unordered(_aggregate_block, tasks), len(tasks), monitor)
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                _init_worker(file_path, var_name)
+                try:
+                    _write_blocks(overviews, map(_aggregate_block, tasks), len(tasks), monitor)
+                finally:
+                    _WORKER_STATE.pop('dataset').close()
+        os.replace(temp_path, sidecar_path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    close_pyramid_sidecars(file_path)
+    return sidecar_path
+
+
+def _write_blocks(overviews, results, num_blocks, monitor):
+    num_levels = len(overviews) + 1
+    for i, (y, x, block_levels) in enumerate(results):
+        for level_index, block_level in enumerate(block_levels):
+            zoom = 2 << level_index
+            level_y, level_x = y // zoom, x // zoom
+            level_h, level_w = block_level.shape[-2], block_level.shape[-1]
+            overviews[num_levels - 2 - level_index][..., level_y:level_y + level_h,
+                                                    level_x:level_x + level_w] = block_level
+        if monitor is not None:
+            monitor(i + 1, num_blocks)
+
+
+def _init_worker(file_path, var_name):
+    dataset = h5py.File(file_path, 'r')
+    _WORKER_STATE['dataset'] = dataset
+    _WORKER_STATE['variable'] = dataset[var_name]
+
+
+def _aggregate_block(task):
+    """
+    Read a block of the variable and aggregate it down to all overview levels.
+    :return: a tuple (y, x, block_levels) where block_levels[i] is the block downsampled by a factor of 2 ** (i + 1)
+    """
+    y, x, h, w, num_overview_levels, aggregation = task
+    variable = _WORKER_STATE['variable']
+    fill_value = variable.fillvalue
+    no_data_value = _get_no_data_value(variable.dtype, fill_value)
+    aggregator = AGGREGATORS[aggregation]
+    block = variable[..., y:y + h, x:x + w]
+    if aggregator is not aggregate_ndarray_first:
+        block = _mask_no_data(block, fill_value)
+    block_levels = []
+    for _ in range(num_overview_levels):
+        block = downsample_ndarray(block, aggregator=aggregator)
+        block_levels.append(np.ma.filled(block, no_data_value) if isinstance(block, np.ma.MaskedArray)
+                            else np.ascontiguousarray(block))
+    return y, x, block_levels
+
+
+def _mask_no_data(block, fill_value):
+    # Like TransformArrayImage, so that the aggregators ignore no-data values
+    if block.dtype.kind in 'fc':
+        mask = ~np.isfinite(block)
+        if fill_value is not None and np.isfinite(fill_value):
+            mask |= block == fill_value
+    elif fill_value is not None:
+        mask = block == fill_value
+    else:
+        return block
+    return np.ma.array(block, mask=mask)
+
+
+def _get_no_data_value(dtype, fill_value):
+    if fill_value is not None:
+        return fill_value
+    return np.nan if np.dtype(dtype).kind in 'fc' else 0
+
+
+def _get_block_length(chunk_length, max_zoom, length, min_length):
+    # A multiple of both the chunk length and max_zoom, so that no chunk is read twice
+    # and every block is a whole number of level zero pixels
+    unit = _lcm(chunk_length, max_zoom) if chunk_length else max_zoom
+    block_length = unit * max(1, (min_length + unit - 1) // unit)
+    return min(block_length, max(max_zoom, length - length % max_zoom))
+
+
+def _lcm(a, b):
+    x, y = a, b
+    while y:
+        x, y = y, x % y
+    return a * b // x
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='ccitbxws-build-pyramid',
+                                     description='Build the overview levels of a variable of a HDF-5/NetCDF-4 file '
+                                                 'into a pyramid sidecar file <file>.<var>%s, '
+                                                 'which is used by ccitbxws instead of strided reads.' % SIDECAR_EXT)
+    parser.add_argument('file', help='the HDF-5/NetCDF-4 file')
+    parser.add_argument('var', nargs='+', help='the variable name(s)')
+    parser.add_argument('-a', '--aggregation', default='nanmean', choices=sorted(AGGREGATORS.keys()),
+                        help="the aggregation of lower levels, default is 'nanmean', 'first' is equal to strided reads")
+    parser.add_argument('-t', '--tile-size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help='the tile size, default is the tile size used by ccitbxws')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes, default is the number of CPUs')
+    parser.add_argument('-b', '--block-size', type=int, default=DEFAULT_BLOCK_SIZE,
+                        help='minimum block width and height read at once, default is %d' % DEFAULT_BLOCK_SIZE)
+    parser.add_argument('-c', '--compression', default='lzf', choices=['lzf', 'gzip', 'none'],
+                        help="the compression of the levels, default is 'lzf'")
+    parsed_args = parser.parse_args(sys.argv[1:] if args is None else args)
+
+    def monitor(num_done_blocks, num_blocks):
+        if num_done_blocks == num_blocks or num_done_blocks % 16 == 0:
+            print('  %d of %d blocks' % (num_done_blocks, num_blocks))
+
+    for var_name in parsed_args.var:
+        print('building pyramid of %s: %s' % (parsed_args.file, var_name))
+        t0 = time.perf_counter()
+        sidecar_path = build_pyramid_sidecar(parsed_args.file, var_name,
+                                             aggregation=parsed_args.aggregation,
+                                             tile_size=tuple(parsed_args.tile_size) if parsed_args.tile_size else None,
+                                             num_workers=parsed_args.workers,
+                                             block_size=parsed_args.block_size,
+                                             compression=None if parsed_args.compression == 'none'
+                                             else parsed_args.compression,
+                                             monitor=monitor)
+        print('wrote %s in %.1f s' % (sidecar_path, time.perf_counter() - t0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
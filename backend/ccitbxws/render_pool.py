@@ -0,0 +1,155 @@
+"""
+Color-mapping and encoding of tiles in a pool of worker processes, so that tile rendering isn't limited to one core
+by the GIL.
+
+Tiles are passed to the workers through slots of shared memory allocated when the pool is created, so that only
+the slot index, the tile's shape and dtype and the rendering options are pickled. Only the encoded tiles,
+which are small, are pickled back.
+"""
+
+import multiprocessing
+import queue
+from threading import Lock
+
+import numpy as np
+
+from .cmaps import get_color_mapper
+from .image import render_color_mapped_tile
+
+DEFAULT_MAX_TILE_SIZE = (512, 512)
+DEFAULT_RENDER_TIMEOUT = 10.0
+
+# The shared memory of a worker process, see _init_worker()
+_WORKER_STATE = {}
+
+
+class TileRenderPool:
+    """
+    Renders tiles, see render_color_mapped_tile(), in a pool of worker processes. Any number of threads may call
+    render() concurrently, a call blocks, without holding the GIL, until a worker has rendered the tile.
+    Tiles larger than the maximum tile size, or of other than numeric dtypes, are rendered by the calling thread.
+    So are tiles for which no slot becomes free or no worker returns within the timeout, e.g. because a worker
+    process died, so that a broken pool slows rendering down but never blocks it.
+
+    The pool should be created before any threads are started, because the worker processes are forked
+    from the creating process on POSIX systems.
+    """
+
+    def __init__(self, num_workers=None, max_tile_size=DEFAULT_MAX_TILE_SIZE, num_slots=None,
+                 timeout=DEFAULT_RENDER_TIMEOUT):
+        """
+        Constructor.
+        :param num_workers: number of worker processes, default is the number of CPUs
+        :param max_tile_size: the maximum (width, height) of tiles rendered by workers
+        :param num_slots: number of tiles in shared memory, i.e. the maximum number of tiles rendered or waiting
+               for a worker at a time, default is twice the number of workers
+        :param timeout: the time in seconds to wait for a free slot, and then for a worker's tile
+        """
+        if not num_workers:
+            num_workers = multiprocessing.cpu_count()
+        if not num_slots:
+            num_slots = 2 * num_workers
+        max_width, max_height = max_tile_size
+        self._slot_mask_nbytes = max_width * max_height
+        # Room for 64-bit values
+        self._slot_nbytes = 8 * self._slot_mask_nbytes
+        self._data_buffer = multiprocessing.RawArray('b', num_slots * self._slot_nbytes)
+        self._mask_buffer = multiprocessing.RawArray('b', num_slots * self._slot_mask_nbytes)
+        self._free_slots = queue.Queue()
+        for slot_index in range(num_slots):
+            self._free_slots.put(slot_index)
+        self._num_workers = num_workers
+        self._timeout = timeout
+        self._pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                          initargs=(self._data_buffer, self._mask_buffer,
+                                                    self._slot_nbytes, self._slot_mask_nbytes))
+        self._lock = Lock()
+        self._num_rendered = 0
+        self._num_local = 0
+        self._num_failed = 0
+
+    @property
+    def num_workers(self):
+        return self._num_workers
+
+    def render(self, array, color_mapper, render_options):
+        """
+        Color-map and encode a tile.
+        :param array: a 2D numpy array or masked array
+        :param color_mapper: the ColorMapper, workers use the shared one of the same colormap and number of colors
+        :param render_options: the other keyword arguments of render_color_mapped_tile()
+        :return: the encoded tile, or a PIL image if no format is given
+        """
+        data = np.ma.getdata(array)
+        if data.dtype.kind not in 'biuf' or data.nbytes > self._slot_nbytes or data.size > self._slot_mask_nbytes:
+            with self._lock:
+                self._num_local += 1
+            return render_color_mapped_tile(array, color_mapper, **render_options)
+
+        mask = np.ma.getmask(array)
+        try:
+            slot_index = self._free_slots.get(timeout=self._timeout)
+        except queue.Empty:
+            return self._render_failed(array, color_mapper, render_options)
+        try:
+            slot_data = np.frombuffer(self._data_buffer, dtype=data.dtype, count=data.size,
+                                      offset=slot_index * self._slot_nbytes).reshape(data.shape)
+            np.copyto(slot_data, data)
+            masked = mask is not np.ma.nomask
+            if masked:
+                slot_mask = np.frombuffer(self._mask_buffer, dtype=np.bool_, count=data.size,
+                                          offset=slot_index * self._slot_mask_nbytes).reshape(data.shape)
+                np.copyto(slot_mask, mask)
+            result = self._pool.apply_async(_render_slot, (slot_index, data.shape, data.dtype.str, masked,
+                                                           color_mapper.cmap_name, color_mapper.num_colors,
+                                                           render_options))
+            tile = result.get(self._timeout)
+        except multiprocessing.TimeoutError:
+            # The worker may still read the slot when it is reused, but its tile is never returned
+            return self._render_failed(array, color_mapper, render_options)
+        finally:
+            self._free_slots.put(slot_index)
+        with self._lock:
+            self._num_rendered += 1
+        return tile
+
+    def _render_failed(self, array, color_mapper, render_options):
+        with self._lock:
+            self._num_failed += 1
+        return render_color_mapped_tile(array, color_mapper, **render_options)
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        self._pool.terminate()
+        self._pool.join()
+
+    def get_stats(self):
+        """
+        :return: a dictionary with the number of workers, of tiles rendered by workers and by calling threads,
+                 and of tiles rendered by calling threads because a slot or a worker timed out
+        """
+        with self._lock:
+            return dict(num_workers=self._num_workers,
+                        num_rendered=self._num_rendered,
+                        num_local=self._num_local,
+                        num_failed=self._num_failed)
+
+
+def _init_worker(data_buffer, mask_buffer, slot_nbytes, slot_mask_nbytes):
+    _WORKER_STATE['data_buffer'] = data_buffer
+    _WORKER_STATE['mask_buffer'] = mask_buffer
+    _WORKER_STATE['slot_nbytes'] = slot_nbytes
+    _WORKER_STATE['slot_mask_nbytes'] = slot_mask_nbytes
+
+
+def _render_slot(slot_index, shape, dtype, masked, cmap_name, num_colors, render_options):
+    size = int(np.prod(shape))
+    array = np.frombuffer(_WORKER_STATE['data_buffer'], dtype=np.dtype(dtype), count=size,
+                          offset=slot_index * _WORKER_STATE['slot_nbytes']).reshape(shape)
+    if masked:
+        mask = np.frombuffer(_WORKER_STATE['mask_buffer'], dtype=np.bool_, count=size,
+                             offset=slot_index * _WORKER_STATE['slot_mask_nbytes']).reshape(shape)
+        array = np.ma.array(array, mask=mask, copy=False)
+    return render_color_mapped_tile(array, get_color_mapper(cmap_name, num_colors), **render_options)
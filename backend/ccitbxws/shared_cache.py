@@ -0,0 +1,462 @@
+import hashlib
+import mmap
+import os
+import random
+import struct
+from contextlib import contextmanager
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+_MAGIC = b'CCITBXM1'
+# magic, page size, number of pages, number of index slots, minimum chunk size, number of size classes
+_GEOMETRY = struct.Struct('<8sIIIII')
+_COUNTER = struct.Struct('<Q')
+_UINT32 = struct.Struct('<I')
+# index slot: key hash (0 = empty slot), access tick, chunk address
+_ENTRY = struct.Struct('<QQI4x')
+# chunk header: index slot (_FREE_CHUNK if the chunk is free), key length,
+# value length, or the next free chunk address + 1 if the chunk is free
+_CHUNK = struct.Struct('<IHxxI')
+
+_HEADER_SIZE = 4096
+_COUNTERS_OFFSET = _GEOMETRY.size
+_NUM_COUNTERS = 9
+_FREE_HEADS_OFFSET = _COUNTERS_OFFSET + _NUM_COUNTERS * _COUNTER.size
+_MAX_NUM_CLASSES = 32
+_PAGE_COUNTS_OFFSET = _FREE_HEADS_OFFSET + _MAX_NUM_CLASSES * _UINT32.size
+
+_TICK, _NUM_ITEMS, _SIZE, _NUM_ASSIGNED_PAGES, _HITS, _MISSES, _PUTS, _EVICTIONS, _EVICTED_SIZE = \
+    range(_NUM_COUNTERS)
+
+_FREE_CHUNK = 0xffffffff
+
+
+class SharedMemoryCache:
+    """
+    A cache of encoded tiles (bytes) that is shared by all processes which open the same file.
+    The file is memory-mapped, so for best performance it should reside in a memory file system, e.g. /dev/shm on Linux.
+
+    The file is an arena of fixed-size pages. Pages are assigned on demand to size classes whose chunk sizes are
+    powers of two, from min_chunk_size up to the page size. A value is stored, together with its key, in a chunk
+    of the smallest fitting size class. A shared open-addressing hash table maps keys to chunks.
+    If a size class has no free chunk left, the least recently used of a few randomly sampled chunks is evicted;
+    if it has no page at all, a randomly chosen page is taken away from another size class.
+    Values larger than a page and values other than bytes, e.g. None or numpy array tiles, are not cached.
+
+    All accesses are serialized by a lock of the file, so that the cache can be used by multiple threads and processes.
+    Values are copied out of the shared memory while the lock is held, because another process may replace them
+    as soon as the lock is released.
+
+    The interface is that of Cache, so that a SharedMemoryCache can be given as the tile_cache of OpImage instances
+    whose tiles are encoded. Keys must be strings.
+    """
+
+    def __init__(self, file_path, capacity=256 * 1024 * 1024, page_size=1024 * 1024, min_chunk_size=1024,
+                 num_samples=8):
+        """
+        Constructor.
+        If the file already holds a cache, it is used with the capacity, page size and minimum chunk size it has been
+        created with; the respective arguments are then ignored.
+
+        :param file_path: path of the cache file, will be created if it doesn't exist
+        :param capacity: size in bytes of the page arena
+        :param page_size: size in bytes of a page, a power of two
+        :param min_chunk_size: the smallest chunk size in bytes, a power of two
+        :param num_samples: number of chunks sampled to find a victim for eviction
+        """
+        if page_size & (page_size - 1) or min_chunk_size & (min_chunk_size - 1) \
+                or not _CHUNK.size < min_chunk_size <= page_size:
+            raise ValueError('page_size and min_chunk_size must be powers of two, min_chunk_size <= page_size')
+        num_classes = (page_size // min_chunk_size).bit_length()
+        if num_classes > _MAX_NUM_CLASSES:
+            raise ValueError('page_size / min_chunk_size too large')
+        self._file_path = file_path
+        self._num_samples = num_samples
+        self._thread_lock = Lock()
+        self._fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o600)
+        try:
+            self._lock_file()
+            try:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                header = os.read(self._fd, _GEOMETRY.size)
+                geometry = _GEOMETRY.unpack(header) if len(header) == _GEOMETRY.size else None
+                if geometry is not None and geometry[0] == _MAGIC:
+                    _, page_size, num_pages, num_slots, min_chunk_size, num_classes = geometry
+                else:
+                    num_pages = max(1, capacity // page_size)
+                    if num_pages * (page_size // min_chunk_size) >= _FREE_CHUNK:
+                        raise ValueError('capacity / min_chunk_size too large')
+                    num_slots = num_pages * (page_size // min_chunk_size) * 3 // 2 + 1
+                self._init_layout(page_size, num_pages, num_slots, min_chunk_size, num_classes)
+                if geometry is None or geometry[0] != _MAGIC or os.fstat(self._fd).st_size != self._file_size:
+                    # New or invalid file: zero-fill, then commit the geometry by writing the magic
+                    os.ftruncate(self._fd, 0)
+                    os.ftruncate(self._fd, self._file_size)
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    os.write(self._fd, _GEOMETRY.pack(_MAGIC, page_size, num_pages, num_slots, min_chunk_size,
+                                                      num_classes))
+                self._mm = mmap.mmap(self._fd, self._file_size)
+            finally:
+                self._unlock_file()
+        except:
+            os.close(self._fd)
+            raise
+
+    def _init_layout(self, page_size, num_pages, num_slots, min_chunk_size, num_classes):
+        self._page_size = page_size
+        self._num_pages = num_pages
+        self._num_slots = num_slots
+        self._min_chunk_size = min_chunk_size
+        self._num_classes = num_classes
+        self._max_chunks_per_page = page_size // min_chunk_size
+        self._page_table_offset = _HEADER_SIZE
+        self._index_offset = (_HEADER_SIZE + num_pages + 7) // 8 * 8
+        self._pages_offset = (self._index_offset + num_slots * _ENTRY.size + 4095) // 4096 * 4096
+        self._file_size = self._pages_offset + num_pages * page_size
+
+    @property
+    def file_path(self):
+        return self._file_path
+
+    @property
+    def parent_cache(self):
+        return None
+
+    @property
+    def capacity(self):
+        return self._num_pages * self._page_size
+
+    @property
+    def max_size(self):
+        return self.capacity
+
+    @property
+    def page_size(self):
+        return self._page_size
+
+    @property
+    def size(self):
+        """The total size in bytes of all chunks in use."""
+        return self._get_counter(_SIZE)
+
+    @property
+    def num_items(self):
+        return self._get_counter(_NUM_ITEMS)
+
+    @property
+    def evicted_size(self):
+        """The total size in bytes of all chunks evicted so far by all processes."""
+        return self._get_counter(_EVICTED_SIZE)
+
+    def get_stats(self):
+        """
+        :return: a JSON-serializable dictionary of the counters of all processes using this cache,
+                 its current size, number of items, capacity, and hit ratio, see Cache.get_stats()
+        """
+        with self._locked():
+            stats = dict(hits=self._get_counter(_HITS),
+                         misses=self._get_counter(_MISSES),
+                         puts=self._get_counter(_PUTS),
+                         evictions=self._get_counter(_EVICTIONS),
+                         evicted_size=self._get_counter(_EVICTED_SIZE),
+                         size=self._get_counter(_SIZE),
+                         num_items=self._get_counter(_NUM_ITEMS),
+                         num_assigned_pages=self._get_counter(_NUM_ASSIGNED_PAGES),
+                         capacity=self.capacity,
+                         max_size=self.max_size)
+        num_requests = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / num_requests if num_requests else None
+        return stats
+
+    def get_value(self, key, record=True):
+        """
+        :param key: the key
+        :param record: whether to record the access in the statistics
+        :return: a copy of the value or None
+        """
+        key_bytes = key.encode('utf-8')
+        key_hash = _get_key_hash(key_bytes)
+        mm = self._mm
+        with self._locked():
+            slot, address = self._find(key_hash, key_bytes)
+            if slot < 0:
+                if record:
+                    self._add_counter(_MISSES, 1)
+                return None
+            offset = self._get_chunk_offset(address)
+            _, key_length, value_length = _CHUNK.unpack_from(mm, offset)
+            value_offset = offset + _CHUNK.size + key_length
+            value = mm[value_offset:value_offset + value_length]
+            _COUNTER.pack_into(mm, self._index_offset + slot * _ENTRY.size + 8, self._add_counter(_TICK, 1))
+            if record:
+                self._add_counter(_HITS, 1)
+            return value
+
+    def contains(self, key):
+        """
+        :param key: the key
+        :return: True, if a value for the key is in this cache, without copying the value or marking it as used
+        """
+        key_bytes = key.encode('utf-8')
+        with self._locked():
+            return self._find(_get_key_hash(key_bytes), key_bytes)[0] >= 0
+
+    def put_value(self, key, value, cost=None, access_count=1):
+        """
+        Put a value into this cache. Values larger than the page size minus the key length and values
+        other than bytes are ignored, and replace a previous value of the key.
+        :param key: the key
+        :param value: the value
+        :param cost: ignored, for compatibility with Cache
+        :param access_count: ignored, for compatibility with Cache
+        """
+        key_bytes = key.encode('utf-8')
+        key_hash = _get_key_hash(key_bytes)
+        size_class = None
+        if isinstance(value, (bytes, bytearray)):
+            size_class = self._get_size_class(_CHUNK.size + len(key_bytes) + len(value))
+        mm = self._mm
+        with self._locked():
+            slot, address = self._find(key_hash, key_bytes)
+            if slot >= 0:
+                self._remove(slot, address)
+            if size_class is None:
+                return
+            address = self._allocate(size_class)
+            slot = self._insert(key_hash, self._add_counter(_TICK, 1), address)
+            offset = self._get_chunk_offset(address)
+            _CHUNK.pack_into(mm, offset, slot, len(key_bytes), len(value))
+            key_offset = offset + _CHUNK.size
+            value_offset = key_offset + len(key_bytes)
+            mm[key_offset:value_offset] = key_bytes
+            mm[value_offset:value_offset + len(value)] = value
+            self._add_counter(_NUM_ITEMS, 1)
+            self._add_counter(_SIZE, self._min_chunk_size << size_class)
+            self._add_counter(_PUTS, 1)
+
+    def remove_value(self, key):
+        key_bytes = key.encode('utf-8')
+        with self._locked():
+            slot, address = self._find(_get_key_hash(key_bytes), key_bytes)
+            if slot >= 0:
+                self._remove(slot, address)
+
+    def clear(self, clear_parent=True):
+        with self._locked():
+            mm = self._mm
+            mm[_COUNTERS_OFFSET:_HEADER_SIZE] = bytes(_HEADER_SIZE - _COUNTERS_OFFSET)
+            mm[self._page_table_offset:self._pages_offset] = bytes(self._pages_offset - self._page_table_offset)
+
+    def trim(self, extra_size=0):
+        pass
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+            os.close(self._fd)
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            self._lock_file()
+            try:
+                yield
+            finally:
+                self._unlock_file()
+
+    def _lock_file(self):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            while True:
+                try:
+                    msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    pass
+
+    def _unlock_file(self):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+
+    def _get_counter(self, index):
+        return _COUNTER.unpack_from(self._mm, _COUNTERS_OFFSET + index * _COUNTER.size)[0]
+
+    def _add_counter(self, index, amount):
+        offset = _COUNTERS_OFFSET + index * _COUNTER.size
+        value = _COUNTER.unpack_from(self._mm, offset)[0] + amount
+        _COUNTER.pack_into(self._mm, offset, value)
+        return value
+
+    def _get_size_class(self, size):
+        chunk_size = self._min_chunk_size
+        for size_class in range(self._num_classes):
+            if size <= chunk_size:
+                return size_class
+            chunk_size <<= 1
+        return None
+
+    def _get_page_class(self, page):
+        return self._mm[self._page_table_offset + page] - 1
+
+    def _get_chunk_offset(self, address):
+        page, chunk = divmod(address, self._max_chunks_per_page)
+        chunk_size = self._min_chunk_size << self._get_page_class(page)
+        return self._pages_offset + page * self._page_size + chunk * chunk_size
+
+    def _find(self, key_hash, key_bytes):
+        mm = self._mm
+        index_offset = self._index_offset
+        num_slots = self._num_slots
+        slot = key_hash % num_slots
+        while True:
+            entry_hash, _, address = _ENTRY.unpack_from(mm, index_offset + slot * _ENTRY.size)
+            if entry_hash == 0:
+                return -1, None
+            if entry_hash == key_hash:
+                offset = self._get_chunk_offset(address)
+                key_length = _CHUNK.unpack_from(mm, offset)[1]
+                if mm[offset + _CHUNK.size:offset + _CHUNK.size + key_length] == key_bytes:
+                    return slot, address
+            slot = (slot + 1) % num_slots
+
+    def _insert(self, key_hash, tick, address):
+        mm = self._mm
+        index_offset = self._index_offset
+        num_slots = self._num_slots
+        slot = key_hash % num_slots
+        while _COUNTER.unpack_from(mm, index_offset + slot * _ENTRY.size)[0] != 0:
+            slot = (slot + 1) % num_slots
+        _ENTRY.pack_into(mm, index_offset + slot * _ENTRY.size, key_hash, tick, address)
+        return slot
+
+    def _delete(self, slot):
+        # Backward shift deletion keeps all entries reachable without tombstones
+        mm = self._mm
+        index_offset = self._index_offset
+        num_slots = self._num_slots
+        i = j = slot
+        while True:
+            j = (j + 1) % num_slots
+            entry = _ENTRY.unpack_from(mm, index_offset + j * _ENTRY.size)
+            if entry[0] == 0:
+                break
+            k = entry[0] % num_slots
+            if (k <= i or k > j) if i <= j else (k <= i and k > j):
+                _ENTRY.pack_into(mm, index_offset + i * _ENTRY.size, *entry)
+                _UINT32.pack_into(mm, self._get_chunk_offset(entry[2]), i)
+                i = j
+        mm[index_offset + i * _ENTRY.size:index_offset + (i + 1) * _ENTRY.size] = bytes(_ENTRY.size)
+
+    def _remove(self, slot, address):
+        size_class = self._get_page_class(address // self._max_chunks_per_page)
+        self._delete(slot)
+        self._push_free_chunk(size_class, address)
+        self._add_counter(_NUM_ITEMS, -1)
+        self._add_counter(_SIZE, -(self._min_chunk_size << size_class))
+
+    def _evict(self, slot, address):
+        size_class = self._get_page_class(address // self._max_chunks_per_page)
+        self._remove(slot, address)
+        self._add_counter(_EVICTIONS, 1)
+        self._add_counter(_EVICTED_SIZE, self._min_chunk_size << size_class)
+
+    def _push_free_chunk(self, size_class, address):
+        head_offset = _FREE_HEADS_OFFSET + size_class * _UINT32.size
+        _CHUNK.pack_into(self._mm, self._get_chunk_offset(address), _FREE_CHUNK, 0,
+                         _UINT32.unpack_from(self._mm, head_offset)[0])
+        _UINT32.pack_into(self._mm, head_offset, address + 1)
+
+    def _pop_free_chunk(self, size_class):
+        head_offset = _FREE_HEADS_OFFSET + size_class * _UINT32.size
+        head = _UINT32.unpack_from(self._mm, head_offset)[0]
+        if head == 0:
+            return None
+        address = head - 1
+        _UINT32.pack_into(self._mm, head_offset, _CHUNK.unpack_from(self._mm, self._get_chunk_offset(address))[2])
+        return address
+
+    def _allocate(self, size_class):
+        address = self._pop_free_chunk(size_class)
+        if address is not None:
+            return address
+        num_assigned_pages = self._get_counter(_NUM_ASSIGNED_PAGES)
+        if num_assigned_pages < self._num_pages:
+            self._add_counter(_NUM_ASSIGNED_PAGES, 1)
+            self._assign_page(num_assigned_pages, size_class)
+        elif _UINT32.unpack_from(self._mm, _PAGE_COUNTS_OFFSET + size_class * _UINT32.size)[0] > 0:
+            self._evict_sampled_chunk(size_class)
+        else:
+            self._reassign_page(random.randrange(self._num_pages), size_class)
+        return self._pop_free_chunk(size_class)
+
+    def _assign_page(self, page, size_class):
+        self._mm[self._page_table_offset + page] = size_class + 1
+        self._add_page_count(size_class, 1)
+        num_chunks = self._page_size // (self._min_chunk_size << size_class)
+        for chunk in reversed(range(num_chunks)):
+            self._push_free_chunk(size_class, page * self._max_chunks_per_page + chunk)
+
+    def _add_page_count(self, size_class, amount):
+        offset = _PAGE_COUNTS_OFFSET + size_class * _UINT32.size
+        _UINT32.pack_into(self._mm, offset, _UINT32.unpack_from(self._mm, offset)[0] + amount)
+
+    def _evict_sampled_chunk(self, size_class):
+        mm = self._mm
+        page_table_offset = self._page_table_offset
+        page_table_end = page_table_offset + self._num_pages
+        class_byte = bytes((size_class + 1,))
+        num_chunks = self._page_size // (self._min_chunk_size << size_class)
+        victim = None
+        for _ in range(self._num_samples):
+            start = page_table_offset + random.randrange(self._num_pages)
+            page_offset = mm.find(class_byte, start, page_table_end)
+            if page_offset < 0:
+                page_offset = mm.find(class_byte, page_table_offset, start)
+            address = (page_offset - page_table_offset) * self._max_chunks_per_page + random.randrange(num_chunks)
+            slot = _CHUNK.unpack_from(mm, self._get_chunk_offset(address))[0]
+            tick = _COUNTER.unpack_from(mm, self._index_offset + slot * _ENTRY.size + 8)[0]
+            if victim is None or tick < victim[0]:
+                victim = tick, slot, address
+        self._evict(victim[1], victim[2])
+
+    def _reassign_page(self, page, size_class):
+        mm = self._mm
+        old_size_class = self._get_page_class(page)
+        num_chunks = self._page_size // (self._min_chunk_size << old_size_class)
+        first_address = page * self._max_chunks_per_page
+        for address in range(first_address, first_address + num_chunks):
+            slot = _CHUNK.unpack_from(mm, self._get_chunk_offset(address))[0]
+            if slot != _FREE_CHUNK:
+                self._evict(slot, address)
+        # Unlink the page's chunks from the free list of its old size class
+        previous_offset = _FREE_HEADS_OFFSET + old_size_class * _UINT32.size
+        link = _UINT32.unpack_from(mm, previous_offset)[0]
+        while link != 0:
+            address = link - 1
+            offset = self._get_chunk_offset(address)
+            next_link = _CHUNK.unpack_from(mm, offset)[2]
+            if address // self._max_chunks_per_page == page:
+                _UINT32.pack_into(mm, previous_offset, next_link)
+            else:
+                # the next-link field of a chunk header
+                previous_offset = offset + _CHUNK.size - _UINT32.size
+            link = next_link
+        self._add_page_count(old_size_class, -1)
+        self._assign_page(page, size_class)
+
+
+def _get_key_hash(key_bytes):
+    # Python's hash() differs between processes, and zero marks empty index slots
+    return int.from_bytes(hashlib.md5(key_bytes).digest()[:8], 'little') | 1
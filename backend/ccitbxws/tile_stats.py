@@ -0,0 +1,396 @@
+import os
+import tempfile
+from threading import Lock
+
+import numpy as np
+
+from .tile_stores import is_shared_tile
+
+_UNKNOWN = -1
+
+
+def compute_tile_stats(tile):
+    """
+    Compute the statistics of a numpy-like tile.
+    Masked values and, for floating point tiles, NaN, -Inf and +Inf are not valid.
+    :return: a tuple (min, max, count, valid_count), min and max are NaN if there are no valid values
+    """
+    data = np.ma.getdata(tile)
+    mask = np.ma.getmask(tile)
+    count = data.size
+    if is_shared_tile(tile) and mask is not np.ma.nomask:
+        # A shared, fully masked tile, see TransformArrayImage
+        return float('nan'), float('nan'), count, 0
+    valid = None
+    if data.dtype.kind in 'fc':
+        valid = np.isfinite(data)
+    if mask is not np.ma.nomask:
+        valid = ~mask if valid is None else np.logical_and(valid, ~mask, out=valid)
+    if valid is None:
+        values = data
+        valid_count = count
+    else:
+        valid_count = int(np.count_nonzero(valid))
+        values = data[valid] if valid_count < count else data
+    if valid_count == 0:
+        return float('nan'), float('nan'), count, 0
+    return float(values.min()), float(values.max()), count, valid_count
+
+
+class TileStatsTree:
+    """
+    A quadtree of per-tile statistics of an image pyramid: for each tile, the minimum and maximum of its valid values,
+    the number of its values and the number of its valid values.
+
+    Statistics are recorded as tiles are computed, see TransformArrayImage, and are propagated up the levels.
+    Tile values of lower levels are derived from the values of the tiles below, so as soon as the four child tiles
+    of a tile are known, their value range is the exact value range of the tile's region, and a tile whose
+    children are all empty is empty. Tiles are empty only if their region has no valid value at the highest level,
+    which lets us skip known-empty tiles without reading any data, and prune region queries at empty subtrees.
+    """
+
+    FILE_EXT = '.tilestats.npz'
+
+    class Level:
+        """
+        The statistics of a single pyramid level, as seen by a level image.
+        """
+
+        def __init__(self, tree, z_index):
+            self._tree = tree
+            self._z_index = z_index
+
+        @property
+        def tile_layout(self):
+            return self._tree.tile_layout
+
+        def is_empty(self, tile_x, tile_y):
+            return self._tree.is_empty(self._z_index, tile_x, tile_y)
+
+        def record(self, tile_x, tile_y, tile):
+            self._tree.record(self._z_index, tile_x, tile_y, tile)
+
+    def __init__(self, num_level_zero_tiles, num_levels, source_mtime=None):
+        """
+        Constructor.
+        :param num_level_zero_tiles: a tuple (num_level_zero_tiles_x, num_level_zero_tiles_y)
+        :param num_levels: number of levels
+        :param source_mtime: optional modification time of the data source, used to validate persisted statistics
+        """
+        self._num_level_zero_tiles = tuple(num_level_zero_tiles)
+        self._num_levels = num_levels
+        self._source_mtime = source_mtime
+        num_tiles_x, num_tiles_y = self._num_level_zero_tiles
+        self._min = []
+        self._max = []
+        self._count = []
+        self._valid_count = []
+        # 1 if the tile's region is known to be empty, 0 if it is known to contain valid values, -1 if unknown
+        self._empty = []
+        # True, if min and max are those of the tile's whole region at the highest level
+        self._exact = []
+        for z_index in range(num_levels):
+            shape = (num_tiles_y << z_index, num_tiles_x << z_index)
+            self._min.append(np.full(shape, np.nan))
+            self._max.append(np.full(shape, np.nan))
+            self._count.append(np.full(shape, _UNKNOWN, dtype=np.int64))
+            self._valid_count.append(np.full(shape, _UNKNOWN, dtype=np.int64))
+            self._empty.append(np.full(shape, _UNKNOWN, dtype=np.int8))
+            self._exact.append(np.zeros(shape, dtype=np.bool_))
+        self._tile_layout = None
+        self._num_changes = 0
+        self._lock = Lock()
+
+    @property
+    def num_level_zero_tiles(self):
+        return self._num_level_zero_tiles
+
+    @property
+    def num_levels(self):
+        return self._num_levels
+
+    @property
+    def source_mtime(self):
+        return self._source_mtime
+
+    @property
+    def tile_layout(self):
+        """
+        The layout of recorded tiles as tuple (leading_shape, dtype), where leading_shape is the shape
+        of a tile without its last two (y, x) dimensions, or None, if no tile has been recorded yet.
+        """
+        return self._tile_layout
+
+    @property
+    def num_changes(self):
+        """The number of changes since this tree has been created, loaded or saved."""
+        return self._num_changes
+
+    def get_level(self, z_index):
+        return TileStatsTree.Level(self, z_index)
+
+    def get_num_tiles(self, z_index):
+        num_tiles_y, num_tiles_x = self._min[z_index].shape
+        return num_tiles_x, num_tiles_y
+
+    def record(self, z_index, tile_x, tile_y, tile):
+        """
+        Record the statistics of a computed tile and propagate them up the levels.
+        """
+        tile_min, tile_max, count, valid_count = compute_tile_stats(tile)
+        with self._lock:
+            if self._tile_layout is None:
+                self._tile_layout = (tuple(tile.shape[:-2]), np.dtype(tile.dtype))
+            self._set_tile_stats(z_index, tile_x, tile_y, tile_min, tile_max, count, valid_count)
+
+    def set_tile_stats(self, z_index, tile_x, tile_y, tile_min, tile_max, count, valid_count):
+        with self._lock:
+            self._set_tile_stats(z_index, tile_x, tile_y, tile_min, tile_max, count, valid_count)
+
+    def _set_tile_stats(self, z_index, tile_x, tile_y, tile_min, tile_max, count, valid_count):
+        self._count[z_index][tile_y, tile_x] = count
+        self._valid_count[z_index][tile_y, tile_x] = valid_count
+        self._num_changes += 1
+        if not self._exact[z_index][tile_y, tile_x]:
+            self._min[z_index][tile_y, tile_x] = tile_min
+            self._max[z_index][tile_y, tile_x] = tile_max
+        if z_index == self._num_levels - 1:
+            self._exact[z_index][tile_y, tile_x] = True
+            self._empty[z_index][tile_y, tile_x] = 1 if valid_count == 0 else 0
+        elif valid_count > 0:
+            self._empty[z_index][tile_y, tile_x] = 0
+        self._propagate(z_index, tile_x, tile_y)
+
+    def _propagate(self, z_index, tile_x, tile_y):
+        while z_index > 0:
+            x0, y0 = tile_x & ~1, tile_y & ~1
+            tile_x //= 2
+            tile_y //= 2
+            z_index -= 1
+            child_empty = self._empty[z_index + 1][y0:y0 + 2, x0:x0 + 2]
+            changed = False
+            if np.any(child_empty == 0) and self._empty[z_index][tile_y, tile_x] != 0:
+                self._empty[z_index][tile_y, tile_x] = 0
+                changed = True
+            elif np.all(child_empty == 1) and self._empty[z_index][tile_y, tile_x] != 1:
+                self._empty[z_index][tile_y, tile_x] = 1
+                changed = True
+            if np.all(self._exact[z_index + 1][y0:y0 + 2, x0:x0 + 2]) and not self._exact[z_index][tile_y, tile_x]:
+                child_min = self._min[z_index + 1][y0:y0 + 2, x0:x0 + 2]
+                child_max = self._max[z_index + 1][y0:y0 + 2, x0:x0 + 2]
+                empty = np.all(np.isnan(child_min))
+                self._min[z_index][tile_y, tile_x] = np.nan if empty else np.nanmin(child_min)
+                self._max[z_index][tile_y, tile_x] = np.nan if empty else np.nanmax(child_max)
+                self._exact[z_index][tile_y, tile_x] = True
+                changed = True
+            if not changed:
+                break
+
+    def get_tile_stats(self, z_index, tile_x, tile_y):
+        """
+        :return: a dictionary with the tile's min, max, count, valid_count, empty and exact values,
+                 or None, if nothing is known about the tile
+        """
+        with self._lock:
+            count = int(self._count[z_index][tile_y, tile_x])
+            empty = int(self._empty[z_index][tile_y, tile_x])
+            if count == _UNKNOWN and empty == _UNKNOWN and not self._exact[z_index][tile_y, tile_x]:
+                return None
+            return dict(min=_to_json_float(self._min[z_index][tile_y, tile_x]),
+                        max=_to_json_float(self._max[z_index][tile_y, tile_x]),
+                        count=count if count != _UNKNOWN else None,
+                        valid_count=int(self._valid_count[z_index][tile_y, tile_x]) if count != _UNKNOWN else None,
+                        empty=bool(empty) if empty != _UNKNOWN else None,
+                        exact=bool(self._exact[z_index][tile_y, tile_x]))
+
+    def get_known_tiles(self, z_index):
+        """
+        :return: a list of (tile_x, tile_y) of the tiles of the given level with known statistics
+        """
+        with self._lock:
+            known = (self._count[z_index] != _UNKNOWN) | (self._empty[z_index] != _UNKNOWN) | self._exact[z_index]
+        tile_ys, tile_xs = np.nonzero(known)
+        return list(zip(tile_xs.tolist(), tile_ys.tolist()))
+
+    def is_empty(self, z_index, tile_x, tile_y):
+        """
+        :return: True, if the tile is known to have no valid values, because its region at the highest level has none
+        """
+        with self._lock:
+            while z_index >= 0:
+                empty = self._empty[z_index][tile_y, tile_x]
+                if empty != _UNKNOWN:
+                    return empty == 1
+                tile_x //= 2
+                tile_y //= 2
+                z_index -= 1
+            return False
+
+    def get_value_range(self, z_index, x0=0, y0=0, x1=None, y1=None):
+        """
+        Get the value range of a rectangle of tiles, e.g. of a viewport. Tiles without statistics
+        are estimated from their nearest ancestor with statistics.
+        :param z_index: the level
+        :param x0, y0: the first tile
+        :param x1, y1: the end tile (exclusive), defaults to the number of tiles of the level
+        :return: a dictionary with min, max, num_tiles, num_known_tiles and exact, which is True,
+                 if min and max are those of the whole rectangle at the highest level
+        """
+        num_tiles_x, num_tiles_y = self.get_num_tiles(z_index)
+        x1 = num_tiles_x if x1 is None else min(x1, num_tiles_x)
+        y1 = num_tiles_y if y1 is None else min(y1, num_tiles_y)
+        x0, y0 = max(x0, 0), max(y0, 0)
+        if x0 >= x1 or y0 >= y1:
+            return dict(min=None, max=None, num_tiles=0, num_known_tiles=0, exact=True)
+        with self._lock:
+            known = (self._count[z_index][y0:y1, x0:x1] != _UNKNOWN) | self._exact[z_index][y0:y1, x0:x1]
+            mins = self._min[z_index][y0:y1, x0:x1].copy()
+            maxs = self._max[z_index][y0:y1, x0:x1].copy()
+            exact = np.array(self._exact[z_index][y0:y1, x0:x1])
+            unknown = ~(known | (self._empty[z_index][y0:y1, x0:x1] == 1))
+            tile_ys, tile_xs = np.mgrid[y0:y1, x0:x1]
+            for ancestor_z_index in range(z_index - 1, -1, -1):
+                if not unknown.any():
+                    break
+                shift = z_index - ancestor_z_index
+                ancestor_ys, ancestor_xs = tile_ys[unknown] >> shift, tile_xs[unknown] >> shift
+                ancestor_known = ((self._count[ancestor_z_index][ancestor_ys, ancestor_xs] != _UNKNOWN) |
+                                  self._exact[ancestor_z_index][ancestor_ys, ancestor_xs])
+                ancestor_empty = self._empty[ancestor_z_index][ancestor_ys, ancestor_xs] == 1
+                indices = np.nonzero(unknown)
+                resolved = ancestor_known | ancestor_empty
+                mins[indices[0][resolved], indices[1][resolved]] = \
+                    self._min[ancestor_z_index][ancestor_ys[resolved], ancestor_xs[resolved]]
+                maxs[indices[0][resolved], indices[1][resolved]] = \
+                    self._max[ancestor_z_index][ancestor_ys[resolved], ancestor_xs[resolved]]
+                # Empty ancestors are exact for all of their descendants
+                exact[indices[0][ancestor_empty], indices[1][ancestor_empty]] = True
+                unknown[indices[0][resolved], indices[1][resolved]] = False
+        num_tiles = mins.size
+        num_known_tiles = int(np.count_nonzero(known))
+        has_values = not np.all(np.isnan(mins))
+        return dict(min=float(np.nanmin(mins)) if has_values else None,
+                    max=float(np.nanmax(maxs)) if has_values else None,
+                    num_tiles=num_tiles,
+                    num_known_tiles=num_known_tiles,
+                    exact=bool(np.all(exact) and not unknown.any()))
+
+    def get_non_empty_tiles(self, z_index, x0=0, y0=0, x1=None, y1=None):
+        """
+        Get the tiles of a rectangle that are not known to be empty, by descending the quadtree from level zero
+        and pruning empty subtrees.
+        :return: a list of (tile_x, tile_y)
+        """
+        num_tiles_x, num_tiles_y = self.get_num_tiles(z_index)
+        x1 = num_tiles_x if x1 is None else min(x1, num_tiles_x)
+        y1 = num_tiles_y if y1 is None else min(y1, num_tiles_y)
+        x0, y0 = max(x0, 0), max(y0, 0)
+        tiles = []
+        with self._lock:
+            num_tiles_x, num_tiles_y = self.get_num_tiles(0)
+            stack = [(0, tile_x, tile_y) for tile_y in range(num_tiles_y - 1, -1, -1)
+                     for tile_x in range(num_tiles_x - 1, -1, -1)]
+            while stack:
+                level, tile_x, tile_y = stack.pop()
+                shift = z_index - level
+                # The level's tile covers the level z_index tiles [tile_x << shift, (tile_x + 1) << shift)
+                if (tile_x + 1) << shift <= x0 or tile_x << shift >= x1 or \
+                        (tile_y + 1) << shift <= y0 or tile_y << shift >= y1:
+                    continue
+                if self._empty[level][tile_y, tile_x] == 1:
+                    continue
+                if level == z_index:
+                    tiles.append((tile_x, tile_y))
+                else:
+                    for child_y in (2 * tile_y + 1, 2 * tile_y):
+                        for child_x in (2 * tile_x + 1, 2 * tile_x):
+                            stack.append((level + 1, child_x, child_y))
+        return tiles
+
+    def to_dict(self, z_index=None):
+        """
+        :return: a JSON-serializable summary of all levels or, if z_index is given, the statistics of all known
+                 tiles of a level
+        """
+        if z_index is not None:
+            return [dict(x=tile_x, y=tile_y, **self.get_tile_stats(z_index, tile_x, tile_y))
+                    for tile_x, tile_y in self.get_known_tiles(z_index)]
+        levels = []
+        for z_index in range(self._num_levels):
+            num_tiles_x, num_tiles_y = self.get_num_tiles(z_index)
+            with self._lock:
+                num_empty_tiles = int(np.count_nonzero(self._empty[z_index] == 1))
+            level = self.get_value_range(z_index)
+            level.update(z=z_index, num_empty_tiles=num_empty_tiles)
+            levels.append(level)
+        return dict(num_level_zero_tiles=list(self._num_level_zero_tiles),
+                    num_levels=self._num_levels,
+                    levels=levels)
+
+    def save(self, file_path):
+        """
+        Save this tree to a file, written atomically.
+        """
+        arrays = dict(num_level_zero_tiles=np.array(self._num_level_zero_tiles),
+                      num_levels=np.array(self._num_levels),
+                      source_mtime=np.array(self._source_mtime if self._source_mtime is not None else np.nan))
+        with self._lock:
+            if self._tile_layout is not None:
+                leading_shape, dtype = self._tile_layout
+                arrays['leading_shape'] = np.array(leading_shape, dtype=np.int64)
+                arrays['dtype'] = np.array(dtype.str)
+            for z_index in range(self._num_levels):
+                arrays['min_%d' % z_index] = self._min[z_index]
+                arrays['max_%d' % z_index] = self._max[z_index]
+                arrays['count_%d' % z_index] = self._count[z_index]
+                arrays['valid_count_%d' % z_index] = self._valid_count[z_index]
+                arrays['empty_%d' % z_index] = self._empty[z_index]
+                arrays['exact_%d' % z_index] = self._exact[z_index]
+            dir_path = os.path.dirname(os.path.abspath(file_path))
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=dir_path)
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    np.savez_compressed(fp, **arrays)
+                os.replace(temp_path, file_path)
+            except:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            self._num_changes = 0
+
+    @staticmethod
+    def load(file_path, num_level_zero_tiles=None, num_levels=None, source_mtime=None):
+        """
+        Load a tree from a file.
+        :param file_path: the file path
+        :param num_level_zero_tiles: if given, the expected number of level zero tiles
+        :param num_levels: if given, the expected number of levels
+        :param source_mtime: if given, the expected modification time of the data source
+        :return: the tree
+        :raise ValueError: if the tree doesn't match the expected layout or data source
+        """
+        with np.load(file_path) as arrays:
+            tree = TileStatsTree(tuple(arrays['num_level_zero_tiles'].tolist()), int(arrays['num_levels']),
+                                 source_mtime=float(arrays['source_mtime']))
+            if num_level_zero_tiles is not None and tuple(num_level_zero_tiles) != tree.num_level_zero_tiles:
+                raise ValueError('tile statistics %s are of a different number of level zero tiles' % file_path)
+            if num_levels is not None and num_levels != tree.num_levels:
+                raise ValueError('tile statistics %s are of a different number of levels' % file_path)
+            if source_mtime is not None and source_mtime != tree.source_mtime:
+                raise ValueError('tile statistics %s are outdated' % file_path)
+            if 'dtype' in arrays:
+                tree._tile_layout = (tuple(arrays['leading_shape'].tolist()), np.dtype(str(arrays['dtype'])))
+            for z_index in range(tree.num_levels):
+                shape = tree._min[z_index].shape
+                for name, level_arrays in (('min', tree._min), ('max', tree._max), ('count', tree._count),
+                                           ('valid_count', tree._valid_count), ('empty', tree._empty),
+                                           ('exact', tree._exact)):
+                    array = arrays['%s_%d' % (name, z_index)]
+                    if array.shape != shape:
+                        raise ValueError('tile statistics %s are corrupt' % file_path)
+                    level_arrays[z_index] = array.astype(level_arrays[z_index].dtype)
+        return tree
+
+
+def _to_json_float(value):
+    return None if np.isnan(value) else float(value)
@@ -0,0 +1,276 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import zlib
+from threading import Lock
+
+import numpy as np
+from PIL import Image
+
+from .cache import CacheStore, MemoryCacheStore
+
+# The size of a shared tile in an in-memory cache, which only keeps a reference to it
+SHARED_TILE_SIZE = 8
+MAX_NUM_SHARED_TILES = 4096
+
+_SHARED_TILES = {}
+_SHARED_TILE_IDS = set()
+_SHARED_TILES_LOCK = Lock()
+
+
+def get_shared_tile(key, create_tile):
+    """
+    Get a singleton tile that is shared by all tiles of equal content, such as fully masked or uniformly colored tiles.
+    Shared tiles must not be modified. In-memory tile caches keep only a reference to them.
+    :param key: a hashable key that identifies the tile's content, e.g. ('masked', shape, dtype)
+    :param create_tile: a function that creates the tile, if it doesn't exist yet
+    :return: the shared tile, or a new unshared tile if there are already MAX_NUM_SHARED_TILES shared tiles
+    """
+    tile = _SHARED_TILES.get(key)
+    if tile is None:
+        tile = create_tile()
+        with _SHARED_TILES_LOCK:
+            if key not in _SHARED_TILES and len(_SHARED_TILES) >= MAX_NUM_SHARED_TILES:
+                return tile
+            tile = _SHARED_TILES.setdefault(key, tile)
+            # Shared tiles live as long as the process, so their IDs are never reused
+            _SHARED_TILE_IDS.add(id(tile))
+    return tile
+
+
+def is_shared_tile(tile):
+    return id(tile) in _SHARED_TILE_IDS
+
+
+class MemoryTileCacheStore(MemoryCacheStore):
+    def store_value(self, key, tile):
+        if is_shared_tile(tile):
+            return tile, SHARED_TILE_SIZE
+        elif hasattr(tile, 'nbytes'):
+            # A numpy ndarray instance
+            size = tile.nbytes
+        elif hasattr(tile, 'size') and hasattr(tile, 'mode'):
+            # A PIL Image instance
+            w, h = tile.size
+            m = tile.mode
+            size = w * h * (4 if m in ('RGBA', 'RGBx', 'I', 'F') else
+                            3 if m in ('RGB', 'YCbCr', 'LAB', 'HSV') else
+                            1. / 8. if m == '1' else
+                            1)
+        else:
+            size = sys.getsizeof(tile)
+        return tile, size
+
+
+class CompressedTileCacheStore(MemoryTileCacheStore):
+    """
+    An in-memory tile store that keeps numpy ndarray tiles compressed, masks included.
+    Sizes are accounted as compressed bytes, so a cache of a given capacity holds many more tiles,
+    especially tiles with large masked or NaN areas. Other tiles are stored as by MemoryTileCacheStore.
+
+    Restored arrays may be read-only.
+    """
+
+    class CompressedTile:
+        __slots__ = ('shape', 'dtype', 'data', 'mask', 'fill_value', 'shuffled')
+
+        def __init__(self, shape, dtype, data, mask, fill_value, shuffled):
+            self.shape = shape
+            self.dtype = dtype
+            self.data = data
+            self.mask = mask
+            self.fill_value = fill_value
+            self.shuffled = shuffled
+
+        @property
+        def nbytes(self):
+            return len(self.data) + (len(self.mask) if self.mask is not None else 0)
+
+    def __init__(self, compress_level=1, shuffle=True):
+        """
+        Constructor.
+        :param compress_level: zlib compression level, 1 (fastest) to 9 (best)
+        :param shuffle: whether to group the bytes of multi-byte data types before compression,
+               which usually lets floating point data compress much better
+        """
+        self._compress_level = compress_level
+        self._shuffle = shuffle
+
+    def store_value(self, key, tile):
+        if not isinstance(tile, np.ndarray) or tile.dtype.hasobject or is_shared_tile(tile):
+            return super().store_value(key, tile)
+
+        is_masked = isinstance(tile, np.ma.MaskedArray)
+        data = np.ascontiguousarray(tile.data if is_masked else tile)
+        shuffled = self._shuffle and data.dtype.itemsize > 1
+        if shuffled:
+            data = data.view(np.uint8).reshape((-1, data.dtype.itemsize)).T
+        compressed_data = zlib.compress(np.ascontiguousarray(data).data, self._compress_level)
+        compressed_mask = None
+        fill_value = None
+        if is_masked:
+            mask = np.packbits(np.ma.getmaskarray(tile))
+            compressed_mask = zlib.compress(mask.data, self._compress_level)
+            fill_value = tile.fill_value
+        compressed_tile = CompressedTileCacheStore.CompressedTile(tile.shape, tile.dtype, compressed_data,
+                                                                  compressed_mask, fill_value, shuffled)
+        return compressed_tile, compressed_tile.nbytes
+
+    def restore_value(self, key, stored_value):
+        if not isinstance(stored_value, CompressedTileCacheStore.CompressedTile):
+            return stored_value
+
+        shape, dtype = stored_value.shape, stored_value.dtype
+        data = np.frombuffer(zlib.decompress(stored_value.data), dtype=np.uint8)
+        if stored_value.shuffled:
+            data = np.ascontiguousarray(data.reshape((dtype.itemsize, -1)).T)
+        array = data.view(dtype).reshape(shape)
+        if stored_value.mask is None:
+            return array
+        size = array.size
+        mask = np.unpackbits(np.frombuffer(zlib.decompress(stored_value.mask), dtype=np.uint8))[:size]
+        return np.ma.array(array, mask=mask.view(np.bool_).reshape(shape), fill_value=stored_value.fill_value)
+
+
+class FileTileCacheStore(CacheStore):
+    """
+    A cache store that writes tiles into files of a local directory, so that it can serve as a
+    second-level (parent) cache of the in-memory tile cache.
+
+    Encoded tiles (bytes) are written as-is, numpy ndarray tiles are written in NPY format and are
+    read back memory-mapped (masked arrays get an extra NPY file for their mask), PIL images are written as PNG.
+
+    Each value is committed by writing a small JSON entry file after its data files have been written.
+    All files are written to temporary files first and then atomically renamed, so a crashed process
+    leaves at most orphaned files that are removed by get_stored_items().
+    Keys must be strings. The store doesn't limit its size, this is done by the Cache that uses it, e.g.
+
+        Cache(FileTileCacheStore(dir_path), capacity=4 * 1024 ** 3)
+    """
+
+    ENTRY_EXT = '.json'
+    TEMP_EXT = '.tmp'
+
+    def __init__(self, dir_path, fsync=False):
+        """
+        Constructor.
+        :param dir_path: the cache directory, will be created if it doesn't exist
+        :param fsync: whether to flush written files to disk before committing them (slower, but survives power loss)
+        """
+        self._dir_path = os.path.abspath(dir_path)
+        self._fsync = fsync
+        os.makedirs(self._dir_path, exist_ok=True)
+
+    @property
+    def dir_path(self):
+        return self._dir_path
+
+    def store_value(self, key, tile):
+        base_path = self._get_base_path(key)
+        os.makedirs(os.path.dirname(base_path), exist_ok=True)
+
+        if isinstance(tile, (bytes, bytearray)):
+            kind = 'bytes'
+            size = self._write_file(base_path + '.bin', lambda fp: fp.write(tile))
+        elif isinstance(tile, np.ndarray):
+            kind = 'ndarray'
+            data = tile.data if isinstance(tile, np.ma.MaskedArray) else tile
+            size = self._write_file(base_path + '.npy', lambda fp: np.save(fp, data))
+            if isinstance(tile, np.ma.MaskedArray):
+                kind = 'masked'
+                mask = np.ma.getmaskarray(tile)
+                size += self._write_file(base_path + '.mask.npy', lambda fp: np.save(fp, mask))
+        elif hasattr(tile, 'size') and hasattr(tile, 'mode'):
+            kind = 'image'
+            size = self._write_file(base_path + '.png', lambda fp: tile.save(fp, format='PNG'))
+        else:
+            raise TypeError('cannot store tile of type %s' % type(tile))
+
+        fill_value = tile.fill_value.item() if kind == 'masked' else None
+        entry = dict(key=key, kind=kind, size=size, fill_value=fill_value)
+        self._write_file(base_path + FileTileCacheStore.ENTRY_EXT,
+                         lambda fp: fp.write(json.dumps(entry).encode('utf-8')))
+        return (base_path, kind, fill_value), size
+
+    def restore_value(self, key, stored_value):
+        base_path, kind, fill_value = stored_value
+        if kind == 'bytes':
+            with open(base_path + '.bin', 'rb') as fp:
+                return fp.read()
+        elif kind == 'ndarray':
+            return np.load(base_path + '.npy', mmap_mode='r')
+        elif kind == 'masked':
+            data = np.load(base_path + '.npy', mmap_mode='r')
+            mask = np.load(base_path + '.mask.npy', mmap_mode='r')
+            return np.ma.array(data, mask=mask, fill_value=fill_value)
+        else:
+            with open(base_path + '.png', 'rb') as fp:
+                image = Image.open(io.BytesIO(fp.read()))
+                image.load()
+                return image
+
+    def discard_value(self, key, stored_value):
+        base_path = stored_value[0]
+        # Remove the entry first, so that the value is no longer committed
+        for ext in (FileTileCacheStore.ENTRY_EXT, '.bin', '.npy', '.mask.npy', '.png'):
+            _remove_file(base_path + ext)
+
+    def get_stored_items(self):
+        """
+        Scan the cache directory for committed values and remove orphaned files.
+        :return: a list of (key, stored_value, stored_size) tuples, least recently modified values first
+        """
+        entry_ext = FileTileCacheStore.ENTRY_EXT
+        stored_items = []
+        for dir_path, _, file_names in os.walk(self._dir_path):
+            base_names = set()
+            for file_name in file_names:
+                if file_name.endswith(entry_ext):
+                    base_names.add(file_name[:-len(entry_ext)])
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                if file_name.endswith(FileTileCacheStore.TEMP_EXT) or file_name.split('.')[0] not in base_names:
+                    _remove_file(file_path)
+            for base_name in base_names:
+                base_path = os.path.join(dir_path, base_name)
+                entry_path = base_path + entry_ext
+                try:
+                    with open(entry_path, 'r') as fp:
+                        entry = json.load(fp)
+                    mtime = os.path.getmtime(entry_path)
+                    stored_item = entry['key'], (base_path, entry['kind'], entry.get('fill_value')), entry['size']
+                except (OSError, ValueError, KeyError):
+                    self.discard_value(None, (base_path, None, None))
+                    continue
+                stored_items.append((mtime, stored_item))
+        stored_items.sort(key=lambda mtime_and_item: mtime_and_item[0])
+        return [stored_item for _, stored_item in stored_items]
+
+    def _get_base_path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._dir_path, digest[:2], digest)
+
+    def _write_file(self, file_path, writer):
+        fd, temp_path = tempfile.mkstemp(suffix=FileTileCacheStore.TEMP_EXT, dir=os.path.dirname(file_path))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                writer(fp)
+                fp.flush()
+                if self._fsync:
+                    os.fsync(fp.fileno())
+                size = fp.tell()
+            os.replace(temp_path, file_path)
+        except:
+            _remove_file(temp_path)
+            raise
+        return size
+
+
+def _remove_file(file_path):
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
@@ -1,8 +1,13 @@
+import numpy as np
+
+
 def aggregate_ndarray_first(a1, a2, a3, a4):
     return a1
 
 
 def aggregate_ndarray_min(a1, a2, a3, a4):
+    if _is_any_masked(a1, a2, a3, a4):
+        return _aggregate_valid_values(np.fmin, (a1, a2, a3, a4))
     a = np.fmin(a1, a2)
     a = np.fmin(a, a3, out=a)
     a = np.fmin(a, a4, out=a)
@@ -10,6 +15,8 @@ def aggregate_ndarray_min(a1, a2, a3, a4):
 
 
 def aggregate_ndarray_max(a1, a2, a3, a4):
+    if _is_any_masked(a1, a2, a3, a4):
+        return _aggregate_valid_values(np.fmax, (a1, a2, a3, a4))
     a = np.fmax(a1, a2)
     a = np.fmax(a, a3, out=a)
     a = np.fmax(a, a4, out=a)
@@ -24,6 +31,63 @@ def aggregate_ndarray_mean(a1, a2, a3, a4):
     return (a1 + a2 + a3 + a4) / 4.
 
 
+def aggregate_ndarray_nanmean(a1, a2, a3, a4):
+    """
+    The mean of the valid values, i.e. values that are neither masked nor NaN. Unlike aggregate_ndarray_mean(),
+    the result is only invalid where all four values are invalid, so that coastlines and swath edges don't shrink
+    on lower levels. Integer data keep their type.
+    """
+    arrays = (a1, a2, a3, a4)
+    dtype = np.ma.getdata(a1).dtype
+    total = np.zeros(a1.shape, dtype=np.float32 if dtype == np.float32 else np.float64)
+    count = np.zeros(a1.shape, dtype=np.uint8)
+    for a in arrays:
+        data, valid = _get_valid_data(a)
+        total += np.where(valid, data, 0)
+        count += valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    if dtype.kind in 'iub':
+        mean = np.where(count > 0, np.rint(mean), 0).astype(dtype)
+    elif mean.dtype != dtype:
+        mean = mean.astype(dtype)
+    if _is_any_masked(*arrays):
+        return np.ma.array(mean, mask=count == 0)
+    return mean
+
+
+AGGREGATORS = dict(first=aggregate_ndarray_first,
+                   min=aggregate_ndarray_min,
+                   max=aggregate_ndarray_max,
+                   mean=aggregate_ndarray_mean,
+                   nanmean=aggregate_ndarray_nanmean)
+
+
+def _is_any_masked(*arrays):
+    for a in arrays:
+        if isinstance(a, np.ma.MaskedArray):
+            return True
+    return False
+
+
+def _get_valid_data(a):
+    data = np.ma.getdata(a)
+    valid = ~np.ma.getmaskarray(a)
+    if data.dtype.kind in 'fc':
+        valid &= ~np.isnan(data)
+    return data, valid
+
+
+def _aggregate_valid_values(ufunc, arrays):
+    # The result is masked only where all values are invalid
+    result, result_valid = _get_valid_data(arrays[0])
+    for a in arrays[1:]:
+        data, valid = _get_valid_data(a)
+        result = np.where(result_valid & valid, ufunc(result, data), np.where(valid, data, result))
+        result_valid = result_valid | valid
+    return np.ma.array(result, mask=~result_valid)
+
+
 def downsample_ndarray(a, aggregator=aggregate_ndarray_mean):
     if aggregator is aggregate_ndarray_first:
         # Optimization
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+# Compares the LUT-based ColorMapper with the former matplotlib-based color mapping of ColorMappedRgbaImage
+# for different data types and tile sizes.
+#
+# Usage: python benchmark_cmap.py [<num_repeats>]
+
+import sys
+import timeit
+
+import matplotlib.cm as cm
+import numpy as np
+
+from ccitbxws.cmaps import get_color_mapper
+
+VALUE_RANGE = (0.1, 0.9)
+
+
+def map_with_cmap(source_tile, cmap, value_range):
+    # the former implementation of ColorMappedRgbaImage.compute_tile_from_source_tile()
+    value_min, value_max = value_range
+    if np.issubdtype(source_tile.dtype, np.floating):
+        array = np.ma.masked_invalid(source_tile)
+        array = array.clip(value_min, value_max, out=array)
+    else:
+        array = source_tile.clip(value_min, value_max).astype(np.float64)
+    array -= value_min
+    array *= 1.0 / (value_max - value_min)
+    return cmap(array, bytes=True)
+
+
+def create_tile(dtype, tile_size):
+    random = np.random.RandomState(0)
+    tile = random.uniform(0.0, 1.0, (tile_size, tile_size))
+    if np.issubdtype(dtype, np.integer):
+        return (tile * 100).astype(dtype)
+    tile = tile.astype(dtype)
+    # a land mask
+    tile[:tile_size // 3, :tile_size // 2] = np.nan
+    return tile
+
+
+def main(args):
+    num_repeats = int(args[1]) if len(args) > 1 else 20
+    cmap = cm.get_cmap('jet', 256)
+    cmap.set_bad('k', 0)
+    color_mapper = get_color_mapper('jet')
+
+    print('%-8s %6s %12s %12s %8s' % ('dtype', 'size', 'cmap [ms]', 'lut [ms]', 'speedup'))
+    for dtype in (np.float32, np.float64, np.int16, np.uint8):
+        for tile_size in (256, 270, 512, 1024):
+            tile = create_tile(dtype, tile_size)
+            value_range = VALUE_RANGE if np.issubdtype(dtype, np.floating) else (10, 90)
+            t_cmap = min(timeit.repeat(lambda: map_with_cmap(tile, cmap, value_range),
+                                       number=1, repeat=num_repeats))
+            t_lut = min(timeit.repeat(lambda: color_mapper.map(tile, value_range),
+                                      number=1, repeat=num_repeats))
+            print('%-8s %6d %12.3f %12.3f %8.1f' % (np.dtype(dtype).name, tile_size,
+                                                   1000 * t_cmap, 1000 * t_lut, t_cmap / t_lut))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# Compares the time to read all cold tiles of the lower pyramid levels of a variable with strided reads
+# and from a pyramid sidecar file, which is built first if there is none, see ccitbxws-build-pyramid.
+#
+# Usage: python benchmark_pyramid_sidecar.py <file> <var> [<aggregation> [<max_level>]]
+#
+#   python benchmark_pyramid_sidecar.py ESACCI-OC-L3S-CHLOR_A-MERGED-1M_MONTHLY_4km_GEO_PML_OC4v6-201312-fv2.0.nc \
+#          chlor_a nanmean 4
+
+import os
+import sys
+import time
+
+import h5py
+
+from ccitbxws.image import ImagePyramid, FastNdarrayDownsamplingImage
+from ccitbxws.pyramid_sidecar import build_pyramid_sidecar, close_pyramid_sidecars, get_sidecar_path
+
+
+def read_levels(pyramid, max_level):
+    times = []
+    for z_index in range(min(max_level, pyramid.num_levels - 2) + 1):
+        level_image = pyramid.get_level_image(z_index)
+        num_tiles_x, num_tiles_y = level_image.num_tiles
+        tile_width, tile_height = level_image.tile_size
+        t0 = time.perf_counter()
+        for tile_y in range(num_tiles_y):
+            for tile_x in range(num_tiles_x):
+                # Bypass the tile cache, all tiles are cold
+                level_image.compute_tile(tile_x, tile_y,
+                                         (tile_width * tile_x, tile_height * tile_y, tile_width, tile_height))
+        times.append((z_index, num_tiles_x * num_tiles_y, time.perf_counter() - t0))
+    return times
+
+
+def main(args):
+    if len(args) < 3:
+        print('Usage: python benchmark_pyramid_sidecar.py <file> <var> [<aggregation> [<max_level>]]')
+        sys.exit(1)
+    file_path, var_name = args[1], args[2]
+    aggregation = args[3] if len(args) > 3 else 'nanmean'
+    max_level = int(args[4]) if len(args) > 4 else 4
+
+    sidecar_path = get_sidecar_path(file_path, var_name)
+    if not os.path.exists(sidecar_path):
+        t0 = time.perf_counter()
+        build_pyramid_sidecar(file_path, var_name, aggregation=aggregation)
+        print('built %s in %.2f s' % (sidecar_path, time.perf_counter() - t0))
+    with h5py.File(file_path, 'r') as dataset:
+        variable = dataset[var_name]
+        pyramid = ImagePyramid.create_from_array(variable)
+        # The same layout without the sidecar
+        num_levels = pyramid.num_levels
+        strided_pyramid = ImagePyramid(pyramid.num_level_zero_tiles, pyramid.tile_size,
+                                       [FastNdarrayDownsamplingImage(variable, pyramid.tile_size, z_index, num_levels)
+                                        for z_index in range(num_levels)])
+        strided_times = read_levels(strided_pyramid, max_level)
+        sidecar_times = read_levels(pyramid, max_level)
+        close_pyramid_sidecars(file_path)
+
+    print('%-6s %8s %14s %14s %8s' % ('level', 'tiles', 'strided [ms]', 'sidecar [ms]', 'speedup'))
+    for (z_index, num_tiles, strided_time), (_, _, sidecar_time) in zip(strided_times, sidecar_times):
+        print('%-6d %8d %14.1f %14.1f %8.1f' % (z_index, num_tiles, 1000 * strided_time, 1000 * sidecar_time,
+                                                strided_time / sidecar_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
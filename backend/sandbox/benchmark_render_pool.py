@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Measures the throughput of color-mapping and encoding 256 x 256 tiles by server threads,
+# with and without a TileRenderPool of increasing numbers of worker processes.
+#
+# Usage: python benchmark_render_pool.py [<format> [<num_threads> [<num_tiles>]]]
+#
+#   python benchmark_render_pool.py PNG 16 512
+
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ccitbxws.cmaps import get_color_mapper
+from ccitbxws.image import render_color_mapped_tile
+from ccitbxws.render_pool import TileRenderPool
+
+
+def create_tiles(num_tiles):
+    y, x = np.mgrid[0:256, 0:256]
+    tiles = []
+    for i in range(num_tiles):
+        data = (np.sin(0.05 * x + 0.1 * i) * np.cos(0.03 * y) + 1.0) / 2.0
+        tiles.append(np.ma.masked_less(data.astype(np.float32), 0.05))
+    return tiles
+
+
+def render_tiles(tiles, num_threads, render):
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        num_bytes = sum(len(tile) for tile in executor.map(render, tiles))
+    return time.perf_counter() - t0, num_bytes
+
+
+def main(args):
+    tile_format = args[1] if len(args) > 1 else 'PNG'
+    num_threads = int(args[2]) if len(args) > 2 else 16
+    num_tiles = int(args[3]) if len(args) > 3 else 512
+
+    color_mapper = get_color_mapper('jet')
+    render_options = dict(value_range=(0.0, 1.0), format=tile_format, palette=tile_format == 'PNG')
+    tiles = create_tiles(num_tiles)
+
+    print('%-24s %12s %12s %8s' % ('rendering', 'time [ms]', 'tiles/s', 'speedup'))
+    threads_time, _ = render_tiles(tiles, num_threads,
+                                   lambda tile: render_color_mapped_tile(tile, color_mapper, **render_options))
+    print('%-24s %12.1f %12.1f %8.1f' % ('%d threads' % num_threads, 1000 * threads_time,
+                                         num_tiles / threads_time, 1.0))
+
+    num_workers = 1
+    while num_workers <= multiprocessing.cpu_count():
+        pool = TileRenderPool(num_workers=num_workers, max_tile_size=(256, 256))
+        try:
+            pool_time, _ = render_tiles(tiles, num_threads,
+                                        lambda tile: pool.render(tile, color_mapper, render_options))
+        finally:
+            pool.close()
+        print('%-24s %12.1f %12.1f %8.1f' % ('%d processes' % num_workers, 1000 * pool_time,
+                                             num_tiles / pool_time, threads_time / pool_time))
+        num_workers *= 2
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Compares the time to fetch all cold tiles of a pyramid level by one FileVarTile request per tile
+# with a single FileVarTiles batch request, for increasing numbers of batch workers.
+#
+# Usage: python benchmark_tile_batch.py <file> <var> [<z> [<format>]]
+#
+#   python benchmark_tile_batch.py ESACCI-OC-L3S-CHLOR_A-MERGED-1M_MONTHLY_4km_GEO_PML_OC4v6-201312-fv2.0.nc \
+#          chlor_a 2 png
+
+import sys
+import time
+
+import falcon
+import falcon.testing
+
+import ccitbxws.main as main
+from ccitbxws.cache import Cache
+from ccitbxws.image import MemoryTileCacheStore, set_default_tile_cache
+
+
+def reset_caches():
+    set_default_tile_cache(Cache(MemoryTileCacheStore(), capacity=1024 * 1024 * 1024))
+    for file_path in list(main._DATASETS.keys()):
+        main._close_dataset(file_path)
+
+
+def fetch_single_tiles(client, params, tile_indexes, ext):
+    num_bytes = 0
+    for z, y, x in tile_indexes:
+        response = client.simulate_get('/ccitbx/FileVarTile/%d/%d/%d.%s' % (z, y, x, ext), params=params)
+        num_bytes += len(response.content)
+    return num_bytes
+
+
+def fetch_batch(client, params, tile_indexes, ext):
+    params = dict(params, format=ext, tiles=','.join('%d/%d/%d' % tile_index for tile_index in tile_indexes))
+    response = client.simulate_get('/ccitbx/FileVarTiles', params=params)
+    return len(response.content)
+
+
+def main_(args):
+    if len(args) < 3:
+        print('Usage: python benchmark_tile_batch.py <file> <var> [<z> [<format>]]')
+        sys.exit(1)
+    file_path, var_name = args[1], args[2]
+    z = int(args[3]) if len(args) > 3 else 2
+    ext = args[4] if len(args) > 4 else 'png'
+
+    api = falcon.API()
+    api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}', main.FileVarTile())
+    api.add_route('/ccitbx/FileVarTiles', main.FileVarTiles())
+    client = falcon.testing.TestClient(api)
+    params = {'file': file_path, 'var': var_name, 'cmap': 'jet', 'min': 0.0, 'max': 1.0}
+
+    reset_caches()
+    pyramid = main._get_color_mapped_pyramid(file_path, var_name, 'jet', 0.0, 1.0)
+    num_tiles_x, num_tiles_y = pyramid.get_level_image(z).num_tiles
+    tile_indexes = [(z, y, x) for y in range(num_tiles_y) for x in range(num_tiles_x)]
+    main.CONFIG['TILE_BATCH_MAX_TILES'] = len(tile_indexes)
+
+    reset_caches()
+    t0 = time.perf_counter()
+    num_bytes = fetch_single_tiles(client, params, tile_indexes, ext)
+    single_time = time.perf_counter() - t0
+    print('%-24s %8s %12s %10s %8s' % ('requests', 'tiles', 'time [ms]', 'bytes', 'speedup'))
+    print('%-24s %8d %12.1f %10d %8.1f' % ('per tile', len(tile_indexes), 1000 * single_time, num_bytes, 1.0))
+
+    for num_workers in (1, 2, 4, 8):
+        main.CONFIG['TILE_BATCH_WORKERS'] = num_workers
+        if main._TILE_BATCH_EXECUTOR is not None:
+            main._TILE_BATCH_EXECUTOR.shutdown()
+            main._TILE_BATCH_EXECUTOR = None
+        reset_caches()
+        t0 = time.perf_counter()
+        num_bytes = fetch_batch(client, params, tile_indexes, ext)
+        batch_time = time.perf_counter() - t0
+        print('%-24s %8d %12.1f %10d %8.1f' % ('batch, %d workers' % num_workers, len(tile_indexes),
+                                               1000 * batch_time, num_bytes, single_time / batch_time))
+
+
+if __name__ == '__main__':
+    main_(sys.argv)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Compares encode time and byte size of the tile formats served by FileVarTile for the tiles of a variable,
+# e.g. of an ESA CCI file:
+#
+# Usage: python benchmark_tile_formats.py <file> <var> [<cmap> <min> <max> [<level>]]
+#
+#   python benchmark_tile_formats.py ESACCI-OC-L3S-CHLOR_A-MERGED-1M_MONTHLY_4km_GEO_PML_OC4v6-201312-fv2.0.nc \
+#          chlor_a jet 0 2
+
+import sys
+import time
+
+from ccitbxws.image import ColorMappedRgbaImage
+from ccitbxws.main import _get_data_pyramid
+
+# (name, format, encoder options)
+ENCODINGS = [('PNG RGBA', 'PNG', dict()),
+             ('PNG palette', 'PNG', dict(palette=True)),
+             ('PNG palette rle', 'PNG', dict(palette=True, compress_level=6, compress_type='rle')),
+             ('WebP lossless', 'WEBP', dict(lossless=True)),
+             ('WebP q=90', 'WEBP', dict(quality=90)),
+             ('WebP q=75', 'WEBP', dict(quality=75)),
+             ('JPEG q=90', 'JPEG', dict(quality=90)),
+             ('JPEG q=75', 'JPEG', dict(quality=75))]
+
+
+def main(args):
+    if len(args) < 3:
+        print('Usage: python benchmark_tile_formats.py <file> <var> [<cmap> <min> <max> [<level>]]')
+        sys.exit(1)
+    file_path, var_name = args[1], args[2]
+    cmap_name = args[3] if len(args) > 3 else 'jet'
+    value_range = (float(args[4]), float(args[5])) if len(args) > 5 else (0.0, 1.0)
+
+    data_pyramid = _get_data_pyramid(file_path, var_name)
+    level = int(args[6]) if len(args) > 6 else data_pyramid.num_levels - 1
+    data_image = data_pyramid.get_level_image(level)
+    num_tiles_x, num_tiles_y = data_image.num_tiles
+    source_tiles = [(tile_x, tile_y, data_image.get_tile(tile_x, tile_y))
+                    for tile_y in range(num_tiles_y) for tile_x in range(num_tiles_x)]
+    print('%s, %s, level %d: %d tiles of size %s' % (file_path, var_name, level,
+                                                      len(source_tiles), data_image.tile_size))
+
+    print('%-18s %12s %14s %10s' % ('encoding', 'time [ms]', 'size [bytes]', 'ratio'))
+    png_size = None
+    for name, tile_format, options in ENCODINGS:
+        image = ColorMappedRgbaImage(data_image, value_range=value_range, cmap_name=cmap_name,
+                                     encode=True, format=tile_format, **options)
+        total_time = 0.0
+        total_size = 0
+        for tile_x, tile_y, source_tile in source_tiles:
+            t0 = time.perf_counter()
+            tile = image.compute_tile_from_source_tile(tile_x, tile_y, None, source_tile)
+            total_time += time.perf_counter() - t0
+            total_size += len(tile)
+        if png_size is None:
+            png_size = total_size
+        num_tiles = len(source_tiles)
+        print('%-18s %12.2f %14d %10.2f' % (name, 1000 * total_time / num_tiles, total_size // num_tiles,
+                                            total_size / png_size))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
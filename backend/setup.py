@@ -10,6 +10,7 @@ setup(
     entry_points={
         'console_scripts': [
             'ccitbxws = ccitbxws.main:main',
+            'ccitbxws-build-pyramid = ccitbxws.pyramid_sidecar:main',
         ]
     },
     install_requires=['h5py >= 2.5',
@@ -1,6 +1,10 @@
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 
-from ccitbxws.cache import CacheStore, Cache
+from ccitbxws.cache import CacheStore, Cache, ShardedCache, TinyLfuAdmission, CacheSnapshot, GreedyDualSizeCacheIndex, \
+    POLICY_LRU, POLICY_MRU, POLICY_LFU, POLICY_RR, POLICY_GDS
 
 
 class TestCacheStore(CacheStore):
@@ -79,3 +83,401 @@ class CacheTest(TestCase):
         cache_store.trace = ''
         cache.clear()
         self.assertEqual(cache.size, 0)
+
+
+class CachePolicyTest(TestCase):
+    @staticmethod
+    def _new_cache(policy):
+        # capacity 500, max_size 400, every value has size 100
+        return Cache(store=TestCacheStore(), capacity=500, threshold=0.8, policy=policy)
+
+    @staticmethod
+    def _fill(cache, keys):
+        for key in keys:
+            cache.put_value(key, 'x')
+
+    def _assert_keys(self, cache, expected_keys):
+        for key in ('k1', 'k2', 'k3', 'k4', 'k5'):
+            self.assertEqual(cache.get_value(key) is not None, key in expected_keys, msg=key)
+
+    def test_lru(self):
+        cache = self._new_cache(POLICY_LRU)
+        self._fill(cache, ('k1', 'k2', 'k3', 'k4'))
+        cache.get_value('k1')
+        cache.put_value('k5', 'x')
+        self.assertEqual(cache.num_items, 4)
+        self.assertEqual(cache.size, 400)
+        self._assert_keys(cache, ('k1', 'k3', 'k4', 'k5'))
+
+    def test_mru(self):
+        cache = self._new_cache(POLICY_MRU)
+        self._fill(cache, ('k1', 'k2', 'k3', 'k4'))
+        cache.get_value('k2')
+        cache.put_value('k5', 'x')
+        self.assertEqual(cache.num_items, 4)
+        self._assert_keys(cache, ('k1', 'k3', 'k4', 'k5'))
+
+    def test_lfu(self):
+        cache = self._new_cache(POLICY_LFU)
+        self._fill(cache, ('k1', 'k2', 'k3', 'k4'))
+        for key in ('k1', 'k1', 'k2', 'k3', 'k3', 'k4', 'k4', 'k4'):
+            cache.get_value(key)
+        cache.put_value('k5', 'x')
+        self.assertEqual(cache.num_items, 4)
+        self._assert_keys(cache, ('k1', 'k3', 'k4', 'k5'))
+        # k5 is now least frequently used
+        cache.put_value('k2', 'x')
+        self.assertEqual(cache.num_items, 4)
+        self.assertIsNone(cache.get_value('k5'))
+        self.assertEqual(cache.get_value('k2'), 'x')
+
+    def test_rr(self):
+        cache = self._new_cache(POLICY_RR)
+        self._fill(cache, ['k%d' % i for i in range(100)])
+        self.assertEqual(cache.num_items, 4)
+        self.assertEqual(cache.size, 400)
+        self.assertEqual(cache.get_value('k99'), 'x')
+        for i in range(100):
+            cache.remove_value('k%d' % i)
+        self.assertEqual(cache.num_items, 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_gds(self):
+        cache = self._new_cache(POLICY_GDS)
+        cache.put_value('k1', 'x', cost=10.)
+        cache.put_value('k2', 'x', cost=1.5)
+        cache.put_value('k3', 'x', cost=5.)
+        # no cost is a cost of one
+        cache.put_value('k4', 'x')
+        cache.put_value('k5', 'x', cost=2.)
+        # k4 has the lowest cost
+        self._assert_keys(cache, ('k1', 'k2', 'k3', 'k5'))
+        cache.put_value('k4', 'x', cost=3.)
+        self._assert_keys(cache, ('k1', 'k3', 'k4', 'k5'))
+        # k1 is expensive, so it survives although cheaper items are added and accessed
+        for i in range(20):
+            cache.put_value('k4', 'x', cost=3.)
+            cache.get_value('k3')
+            cache.get_value('k5')
+        self.assertEqual(cache.get_value('k1'), 'x')
+        # ...but not forever
+        for i in range(20):
+            cache.put_value('k%d' % (10 + i), 'x', cost=3.)
+        self.assertIsNone(cache.get_value('k1'))
+        self.assertEqual(cache.num_items, 4)
+
+    def test_gds_size(self):
+        cache = Cache(store=TestCacheStore(), capacity=1000, threshold=0.5, policy=POLICY_GDS)
+        cache.put_value('k1', 'xx', cost=1.)
+        cache.put_value('k2', 'x', cost=1.)
+        cache.put_value('k3', 'xxx', cost=1.)
+        # k1 is larger than k2 at the same cost
+        self.assertIsNone(cache.get_value('k1'))
+        self.assertEqual(cache.get_value('k2'), 'x')
+
+    def test_gds_heap_is_compacted(self):
+        index = GreedyDualSizeCacheIndex()
+        items = []
+        # Items are put and removed but never accessed, as by prefetching and disposing images
+        for i in range(1000):
+            item = Cache.Item()
+            item.key = 'k%d' % i
+            item.stored_size = 100 + i
+            index.add(item)
+            items.append(item)
+            if len(items) > 10:
+                index.remove(items.pop(0))
+        self.assertLessEqual(index.heap_size, 2 * 10 + 64 + 1)
+        # The largest item has the lowest priority
+        self.assertIs(index.next_victim(), items[-1])
+
+    def test_key_function(self):
+        # policies may still be given as plain sort key functions
+        cache = self._new_cache(lambda item: item.key)
+        self._fill(cache, ('k3', 'k1', 'k4', 'k2'))
+        cache.put_value('k5', 'x')
+        self._assert_keys(cache, ('k2', 'k3', 'k4', 'k5'))
+
+    def test_parent_cache(self):
+        parent_cache = Cache(store=TestCacheStore(), capacity=1000)
+        cache = Cache(store=TestCacheStore(), capacity=500, threshold=0.8, parent_cache=parent_cache)
+        self._fill(cache, ('k1', 'k2', 'k3', 'k4', 'k5'))
+        self.assertEqual(cache.num_items, 4)
+        self.assertEqual(parent_cache.num_items, 1)
+        self.assertEqual(cache.get_value('k1'), 'x')
+        cache.clear(clear_parent=False)
+        self.assertEqual(cache.num_items, 0)
+        self.assertEqual(parent_cache.num_items, 5)
+
+    def test_contains(self):
+        cache = self._new_cache(POLICY_LRU)
+        self._fill(cache, ('k1', 'k2', 'k3', 'k4'))
+        stats = cache.get_stats()
+        trace = cache.store.trace
+        self.assertTrue(cache.contains('k1'))
+        self.assertFalse(cache.contains('k5'))
+        # Neither statistics, nor the store, nor the replacement order are touched
+        self.assertEqual(cache.get_stats(), stats)
+        self.assertEqual(cache.store.trace, trace)
+        cache.put_value('k5', 'x')
+        self.assertFalse(cache.contains('k1'))
+
+        # Values evicted to the parent cache are contained, but not taken over from it
+        parent_cache = Cache(store=TestCacheStore(), capacity=1000)
+        cache = Cache(store=TestCacheStore(), capacity=500, threshold=0.8, parent_cache=parent_cache)
+        self._fill(cache, ('k1', 'k2', 'k3', 'k4', 'k5'))
+        self.assertTrue(cache.contains('k1'))
+        self.assertEqual((cache.num_items, parent_cache.num_items), (4, 1))
+        self.assertEqual(parent_cache.get_stats()['hits'], 0)
+
+class ShardedCacheTest(TestCase):
+    def test_it(self):
+        cache_store = TestCacheStore()
+        cache = ShardedCache(store=cache_store, capacity=4000, threshold=0.75, num_shards=4)
+
+        self.assertIs(cache.store, cache_store)
+        self.assertEqual(len(cache.shards), 4)
+        self.assertEqual(cache.max_size, 3000)
+        for shard in cache.shards:
+            self.assertEqual(shard.max_size, 750)
+
+        for i in range(100):
+            cache.put_value('k%d' % i, 'x')
+        self.assertLessEqual(cache.size, 3000)
+        self.assertEqual(cache.size, 100 * cache.num_items)
+        for shard in cache.shards:
+            self.assertLessEqual(shard.size, 750)
+
+        self.assertEqual(cache.get_value('k99'), 'x')
+        cache.remove_value('k99')
+        self.assertIsNone(cache.get_value('k99'))
+
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(cache.num_items, 0)
+
+    def test_contains(self):
+        cache = ShardedCache(capacity=1000, threshold=1.0, num_shards=4)
+        cache.put_value('k1', 'v1')
+        self.assertTrue(cache.contains('k1'))
+        self.assertFalse(cache.contains('k2'))
+        self.assertEqual(cache.get_stats()['hits'] + cache.get_stats()['misses'], 0)
+
+    def test_threads(self):
+        from threading import Thread
+        cache = ShardedCache(capacity=1000, threshold=1.0, num_shards=8)
+
+        def run(offset):
+            for i in range(1000):
+                key = (offset + i) % 500
+                if cache.get_value(key) is None:
+                    cache.put_value(key, key)
+
+        threads = [Thread(target=run, args=(100 * i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.num_items, 500)
+        self.assertEqual(cache.size, 500)
+        self.assertEqual(cache.get_value(123), 123)
+
+
+class CacheStatsTest(TestCase):
+    def test_cache_stats(self):
+        parent_cache = Cache(store=TestCacheStore(), capacity=1000, threshold=1.0)
+        cache = Cache(store=TestCacheStore(), capacity=300, threshold=1.0, parent_cache=parent_cache,
+                      stats_group_func=lambda key: (('prefix', key[0]),))
+
+        cache.put_value('a1', 'x')
+        cache.put_value('a2', 'x')
+        cache.put_value('b1', 'xx')
+        self.assertEqual(cache.get_value('b1'), 'xx')
+        self.assertEqual(cache.get_value('a1'), 'x')
+        self.assertEqual(cache.get_value('a2'), 'x')
+        self.assertIsNone(cache.get_value('c1'))
+        self.assertIsNone(cache.get_value('c1', record=False))
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['parent_hits'], 1)
+        self.assertEqual(stats['puts'], 3)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['evicted_size'], 100)
+        self.assertEqual(stats['size'], 300)
+        self.assertEqual(stats['num_items'], 2)
+        self.assertEqual(stats['capacity'], 300)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+        self.assertEqual(stats['groups']['prefix']['a'], dict(hits=1, misses=1, parent_hits=1, snapshot_hits=0,
+                                                             puts=2, rejections=0, evictions=1, evicted_size=100))
+        self.assertEqual(stats['groups']['prefix']['c']['misses'], 1)
+
+        parent_stats = stats['parent']
+        self.assertEqual(parent_stats['hits'], 1)
+        self.assertEqual(parent_stats['misses'], 1)
+        self.assertEqual(parent_stats['puts'], 1)
+        self.assertEqual(parent_stats['groups'], {})
+
+        cache.stats.reset()
+        self.assertEqual(cache.get_stats()['hits'], 0)
+
+    def test_sharded_cache_stats(self):
+        cache = ShardedCache(capacity=1000, threshold=1.0, num_shards=4,
+                             stats_group_func=lambda key: (('parity', key % 2),))
+        for i in range(100):
+            if cache.get_value(i) is None:
+                cache.put_value(i, i)
+            cache.get_value(i)
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 100)
+        self.assertEqual(stats['misses'], 100)
+        self.assertEqual(stats['puts'], 100)
+        self.assertEqual(stats['num_items'], 100)
+        self.assertEqual(stats['groups']['parity'][1]['hits'], 50)
+
+
+class TinyLfuAdmissionTest(TestCase):
+    def test_sketch(self):
+        admission = TinyLfuAdmission(num_counters=1024, sample_size=100)
+        self.assertEqual(admission.estimate('a'), 0)
+        for i in range(10):
+            admission.record('a')
+        admission.record('b')
+        self.assertEqual(admission.estimate('a'), 10)
+        self.assertEqual(admission.estimate('b'), 1)
+        self.assertTrue(admission.admit('a', 'b'))
+        self.assertFalse(admission.admit('b', 'a'))
+        self.assertFalse(admission.admit('b', 'b'))
+
+        # counters saturate
+        for i in range(20):
+            admission.record('a')
+        self.assertEqual(admission.estimate('a'), 15)
+
+        # counters are halved after sample_size recorded accesses
+        for i in range(100):
+            admission.record('c%d' % i)
+        self.assertEqual(admission.estimate('a'), 7)
+
+    def test_split(self):
+        admission = TinyLfuAdmission(num_counters=1024, depth=3, sample_size=100)
+        admission.record('a')
+        parts = admission.split(4)
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(len(set(id(part) for part in parts)), 4)
+        for part in parts:
+            self.assertEqual((part.num_counters, part.depth, part.sample_size), (256, 3, 25))
+            self.assertEqual(part.estimate('a'), 0)
+        parts[0].record('a')
+        self.assertEqual([part.estimate('a') for part in parts], [1, 0, 0, 0])
+        with self.assertRaises(ValueError):
+            admission.split(0)
+
+    def test_sharded_cache_has_filter_per_shard(self):
+        admission = TinyLfuAdmission(num_counters=1024)
+        cache = ShardedCache(store=TestCacheStore(), capacity=1000, admission=admission, num_shards=4)
+        self.assertIs(cache.admission, admission)
+        shard_admissions = [shard.admission for shard in cache.shards]
+        self.assertEqual(len(set(id(shard_admission) for shard_admission in shard_admissions)), 4)
+        self.assertNotIn(admission, shard_admissions)
+        cache.get_value('k1')
+        self.assertEqual(cache.get_shard('k1').admission.estimate('k1'), 1)
+        self.assertEqual(admission.estimate('k1'), 0)
+
+    def test_scan_resistance(self):
+        cache = Cache(store=TestCacheStore(), capacity=500, threshold=0.8, admission=TinyLfuAdmission(1024))
+        hot_keys = ['h1', 'h2', 'h3', 'h4']
+        for i in range(3):
+            for key in hot_keys:
+                if cache.get_value(key) is None:
+                    cache.put_value(key, 'x')
+        for i in range(100):
+            key = 's%d' % i
+            if cache.get_value(key) is None:
+                cache.put_value(key, 'x')
+        for key in hot_keys:
+            self.assertEqual(cache.get_value(key), 'x')
+        self.assertEqual(cache.num_items, 4)
+
+    def test_rejected_value_goes_to_parent(self):
+        parent_cache = Cache(store=TestCacheStore(), capacity=1000)
+        cache = Cache(store=TestCacheStore(), capacity=200, threshold=1.0, parent_cache=parent_cache,
+                      admission=TinyLfuAdmission(1024))
+        for key in ('k1', 'k1', 'k2', 'k2'):
+            if cache.get_value(key) is None:
+                cache.put_value(key, 'x')
+        cache.put_value('k3', 'x')
+        self.assertEqual(cache.num_items, 2)
+        self.assertEqual(parent_cache.num_items, 1)
+        self.assertEqual(cache.get_value('k3'), 'x')
+
+
+class CacheSnapshotTest(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.dir_path, 'tiles.snapshot')
+        self.source_file = os.path.join(self.dir_path, 'data.nc')
+        with open(self.source_file, 'wb') as fp:
+            fp.write(b'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def _get_source_path(self, key):
+        return self.source_file if key.startswith('src') else None
+
+    def test_save_and_load(self):
+        cache = Cache(capacity=100, threshold=1.0)
+        cache.put_value('k1', b'v1', cost=0.5)
+        cache.put_value('src1', b'v2')
+        cache.put_value('src2', b'v3')
+        cache.put_value('k4', [1, 2, 3])
+        cache.get_value('k1')
+        num_values = cache.save_snapshot(self.snapshot_file, max_size=4, get_source_path=self._get_source_path)
+        self.assertEqual(num_values, 2)
+
+        snapshot = CacheSnapshot(self.snapshot_file)
+        self.assertEqual(snapshot.num_entries, 2)
+        self.assertEqual(snapshot.num_invalid, 0)
+        snapshot.close()
+
+        cache = Cache(capacity=100, threshold=1.0)
+        cache.load_snapshot(self.snapshot_file)
+        self.assertEqual(cache.num_items, 0)
+        self.assertEqual(cache.get_value('k1'), b'v1')
+        self.assertEqual(cache.num_items, 1)
+        self.assertEqual(cache.snapshot.num_entries, 1)
+        self.assertTrue(cache.contains('src2'))
+        self.assertEqual(cache.snapshot.num_entries, 1)
+        self.assertEqual(cache.num_items, 1)
+        self.assertEqual(cache.get_value('src2'), b'v3')
+        self.assertIsNone(cache.get_value('src1'))
+        self.assertEqual(cache.snapshot.num_entries, 0)
+        cache.snapshot.close()
+
+    def test_source_changed(self):
+        cache = ShardedCache(capacity=100, threshold=1.0, num_shards=2)
+        cache.put_value('k1', b'v1')
+        cache.put_value('src1', b'v2')
+        self.assertEqual(cache.save_snapshot(self.snapshot_file, get_source_path=self._get_source_path), 2)
+        cache.snapshot.close()
+
+        with open(self.source_file, 'ab') as fp:
+            fp.write(b'more data')
+
+        cache = ShardedCache(capacity=100, threshold=1.0, num_shards=2)
+        snapshot = cache.load_snapshot(self.snapshot_file)
+        self.assertEqual(snapshot.num_entries, 1)
+        self.assertEqual(snapshot.num_invalid, 1)
+        self.assertEqual(cache.get_value('k1'), b'v1')
+        self.assertIsNone(cache.get_value('src1'))
+
+        # unrequested values of the loaded snapshot are kept
+        cache = Cache(capacity=100, threshold=1.0)
+        cache.load_snapshot(self.snapshot_file)
+        cache.put_value('k2', b'v2')
+        self.assertEqual(cache.save_snapshot(self.snapshot_file), 2)
+        self.assertEqual(cache.get_value('k1'), b'v1')
+        cache.snapshot.close()
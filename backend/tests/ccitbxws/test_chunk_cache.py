@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from ccitbxws.cache import Cache
+from ccitbxws.chunk_cache import ChunkCachedArray, get_chunk_read_stats, _plan_axis_chunks
+from ccitbxws.image import FastNdarrayDownsamplingImage
+from ccitbxws.tile_stores import MemoryTileCacheStore
+
+
+class ChunkCachedArrayTest(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.dir_path, 'test.nc')
+        self.data = np.arange(2 * 60 * 100, dtype=np.float32).reshape((2, 60, 100))
+        self.dataset = h5py.File(self.file_path, 'w')
+        self.dataset.create_dataset('chl', data=self.data, chunks=(1, 20, 20), compression='gzip')
+        self.chunk_cache = Cache(MemoryTileCacheStore(), capacity=1024 * 1024)
+
+    def tearDown(self):
+        self.dataset.close()
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def test_plan_axis_chunks(self):
+        self.assertEqual(_plan_axis_chunks(15, 45, 1, 20), [(0, slice(0, 5), slice(15, 20, 1)),
+                                                            (1, slice(5, 25), slice(0, 20, 1)),
+                                                            (2, slice(25, 30), slice(0, 5, 1))])
+        # Chunks without any position are skipped
+        self.assertEqual(_plan_axis_chunks(5, 100, 50, 20), [(0, slice(0, 1), slice(5, 6, 50)),
+                                                             (2, slice(1, 2), slice(15, 16, 50))])
+        self.assertEqual(_plan_axis_chunks(3, 3, 1, 20), [])
+
+    def test_tiles_are_assembled_from_cached_chunks(self):
+        array = ChunkCachedArray(self.dataset['chl'], chunk_cache=self.chunk_cache)
+        self.assertEqual(array.shape, (2, 60, 100))
+        self.assertEqual(array.fillvalue, self.dataset['chl'].fillvalue)
+        stats = get_chunk_read_stats()
+
+        # Tiles of 25 x 15 pixels don't line up with the 20 x 20 chunks
+        for y in range(0, 60, 15):
+            for x in range(0, 100, 25):
+                np.testing.assert_equal(array[..., y:y + 15, x:x + 25], self.data[..., y:y + 15, x:x + 25])
+        new_stats = get_chunk_read_stats()
+        self.assertEqual(new_stats['num_reads'] - stats['num_reads'], 16)
+        # Each chunk has been decoded once
+        self.assertEqual(new_stats['num_chunk_decodes'] - stats['num_chunk_decodes'], 2 * 3 * 5)
+        self.assertEqual(self.chunk_cache.num_items, 2 * 3 * 5)
+
+        # Strided reads of lower levels take the decoded chunks
+        np.testing.assert_equal(array[:, 0:60:2, 10:100:4], self.data[:, 0:60:2, 10:100:4])
+        image = FastNdarrayDownsamplingImage(array, (25, 15), 0, 2, tile_cache=Cache(MemoryTileCacheStore()))
+        np.testing.assert_equal(image.get_tile(1, 1), self.data[..., 30:60:2, 50:100:2])
+        self.assertEqual(get_chunk_read_stats()['num_chunk_decodes'], new_stats['num_chunk_decodes'])
+
+        # Only the chunks of a selected time step are read
+        np.testing.assert_equal(array[1, 30:50, 30:50], self.data[1, 30:50, 30:50])
+        np.testing.assert_equal(array[-1:, 30:50, 30:50], self.data[-1:, 30:50, 30:50])
+        self.assertEqual(get_chunk_read_stats()['num_chunk_decodes'], new_stats['num_chunk_decodes'])
+        self.dataset.create_dataset('chl2', data=self.data, chunks=(1, 20, 20))
+        array2 = ChunkCachedArray(self.dataset['chl2'], chunk_cache=self.chunk_cache)
+        np.testing.assert_equal(array2[1, 30:50, 30:50], self.data[1, 30:50, 30:50])
+        self.assertEqual(get_chunk_read_stats()['num_chunk_decodes'] - new_stats['num_chunk_decodes'], 4)
+
+        # Chunks can't be modified through a result
+        tile = array[..., 0:20, 0:20]
+        tile[...] = -1
+        np.testing.assert_equal(array[..., 0:20, 0:20], self.data[..., 0:20, 0:20])
+
+    def test_direct_reads(self):
+        array = ChunkCachedArray(self.dataset['chl'], chunk_cache=self.chunk_cache)
+        stats = get_chunk_read_stats()
+        np.testing.assert_equal(array[:, 5, 7], self.data[:, 5, 7])
+        np.testing.assert_equal(array[0, 10, 10:20], self.data[0, 10, 10:20])
+        self.assertEqual(get_chunk_read_stats()['num_reads'], stats['num_reads'])
+        self.assertEqual(self.chunk_cache.num_items, 0)
+
+        # Reads larger than a quarter of the cache don't flush it
+        small_cache = Cache(MemoryTileCacheStore(), capacity=4 * 20 * 20 * 4 * 4)
+        array = ChunkCachedArray(self.dataset['chl'], chunk_cache=small_cache)
+        np.testing.assert_equal(array[..., 0:40, 0:20], self.data[..., 0:40, 0:20])
+        self.assertEqual(get_chunk_read_stats()['num_direct_reads'] - stats['num_direct_reads'], 0)
+        np.testing.assert_equal(array[..., 0:40, 0:40], self.data[..., 0:40, 0:40])
+        self.assertEqual(get_chunk_read_stats()['num_direct_reads'] - stats['num_direct_reads'], 1)
+        self.assertEqual(small_cache.num_items, 4)
+
+        with self.assertRaises(ValueError):
+            self.dataset.create_dataset('contiguous', data=self.data[0])
+            ChunkCachedArray(self.dataset['contiguous'])
@@ -1,6 +1,10 @@
+import copy
 from unittest import TestCase
 
-from ccitbxws.cmaps import get_cmaps
+import matplotlib.cm as cm
+import numpy as np
+
+from ccitbxws.cmaps import get_cmaps, get_color_mapper
 
 
 class CmapsTest(TestCase):
@@ -59,3 +63,70 @@ class CmapsTest(TestCase):
 
         with open('test_cmaps.html', 'w') as fp:
             fp.write(html_page)
+
+
+class ColorMapperTest(TestCase):
+    @staticmethod
+    def _map_with_cmap(array, cmap_name, value_range):
+        # The way ColorMappedRgbaImage used to call matplotlib
+        value_min, value_max = value_range
+        array = np.ma.masked_invalid(array).clip(value_min, value_max)
+        array -= value_min
+        array *= 1.0 / (value_max - value_min)
+        cmap = copy.copy(cm.get_cmap(cmap_name, 256))
+        cmap.set_bad('k', 0)
+        return cmap(array, bytes=True)
+
+    def test_equals_matplotlib(self):
+        color_mapper = get_color_mapper('jet')
+        self.assertIs(get_color_mapper('jet'), color_mapper)
+        self.assertEqual(color_mapper.lut.shape, (257, 4))
+        self.assertEqual(color_mapper.lut[256].tolist(), [0, 0, 0, 0])
+        self.assertTrue(color_mapper.is_opaque)
+
+        random = np.random.RandomState(1)
+        for dtype in (np.float32, np.float64):
+            array = random.uniform(-0.5, 1.5, (64, 80)).astype(dtype)
+            array[3:10, 4:20] = np.nan
+            for value_range in ((0.0, 1.0), (0.25, 0.5), (-1.0, 2.0)):
+                expected = self._map_with_cmap(array, 'jet', value_range)
+                actual = color_mapper.map(array, value_range)
+                self.assertEqual(actual.dtype, np.uint8)
+                np.testing.assert_equal(actual, expected)
+
+    def test_masked_and_no_data(self):
+        color_mapper = get_color_mapper('gray', num_colors=4)
+        array = np.ma.array([[0.0, 0.3, 0.6], [1.0, -9.0, 2.0]], mask=[[0, 1, 0], [0, 0, 0]])
+        indices = color_mapper.get_indices(array, (0.0, 1.0), no_data_value=-9.0)
+        self.assertEqual(indices.tolist(), [[0, 4, 2], [3, 4, 3]])
+
+        out = np.empty((2, 3, 4), dtype=np.uint8)
+        self.assertIs(color_mapper.map(array, (0.0, 1.0), no_data_value=-9.0, out=out), out)
+        self.assertEqual(out[0, 1].tolist(), [0, 0, 0, 0])
+        self.assertEqual(out[1, 0].tolist(), color_mapper.lut[3].tolist())
+
+    def test_integers(self):
+        color_mapper = get_color_mapper('gray', num_colors=10)
+        array = np.arange(-5, 15, dtype=np.int16).reshape((4, 5))
+        indices = color_mapper.get_indices(array, (0, 10))
+        self.assertEqual(indices.ravel().tolist(), [0] * 6 + list(range(1, 10)) + [9] * 5)
+
+        masked_array = np.ma.masked_equal(array, 3)
+        expected = color_mapper.lut[color_mapper.get_indices(masked_array, (0, 10), no_data_value=12)]
+        np.testing.assert_equal(color_mapper.map(masked_array, (0, 10), no_data_value=12), expected)
+        self.assertEqual(expected[1, 3].tolist(), [0, 0, 0, 0])
+        self.assertEqual(expected[3, 2].tolist(), [0, 0, 0, 0])
+
+    def test_palette_image(self):
+        array = np.linspace(0.0, 1.0, 32 * 32).reshape((32, 32))
+        array[0, :5] = np.nan
+        for cmap_name in ('jet', 'RdBu'):
+            color_mapper = get_color_mapper(cmap_name)
+            image = color_mapper.map_to_palette_image(array, (0.0, 1.0))
+            self.assertEqual(image.mode, 'P')
+            np.testing.assert_equal(np.array(image.convert('RGBA')), color_mapper.map(array, (0.0, 1.0)))
+
+        # RdBu has 256 distinct colors, together with the transparent one they don't fit into a palette
+        array = np.append((np.arange(256) + 0.5) / 256, np.nan).reshape((1, 257))
+        self.assertIsNone(get_color_mapper('RdBu').map_to_palette_image(array, (0.0, 1.0)))
+        self.assertIsNotNone(get_color_mapper('jet').map_to_palette_image(array, (0.0, 1.0)))
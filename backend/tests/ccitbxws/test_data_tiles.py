@@ -0,0 +1,60 @@
+import json
+import struct
+from unittest import TestCase
+
+import numpy as np
+
+from ccitbxws.cache import Cache
+from ccitbxws.data_tiles import DATA_TILE_MAGIC, QuantizedDataImage, decode_data_tile, encode_data_tile
+from ccitbxws.image import ImagePyramid
+from ccitbxws.tile_stores import MemoryTileCacheStore
+
+
+class DataTilesTest(TestCase):
+    def setUp(self):
+        self.data = np.linspace(-2.0, 30.0, 20 * 30).reshape((20, 30))
+        self.data[0, :5] = np.nan
+        self.mask = np.zeros(self.data.shape, dtype=np.bool_)
+        self.mask[5:10, 5:10] = True
+        self.tile = np.ma.array(self.data, mask=self.mask)
+        self.no_data = self.mask | np.isnan(self.data)
+
+    def test_format(self):
+        data_tile = encode_data_tile(self.tile, dtype='uint8')
+        self.assertEqual(data_tile[:4], DATA_TILE_MAGIC)
+        header_length, = struct.unpack('<I', data_tile[4:8])
+        header = json.loads(data_tile[8:8 + header_length].decode('utf-8'))
+        # The first five values are NaN
+        valid_min = float(self.data[0, 5])
+        self.assertEqual(header, dict(version=1, dtype='uint8', shape=[20, 30], scale=(30.0 - valid_min) / 254,
+                                      offset=valid_min, noData=255, compression='zlib', min=valid_min, max=30.0))
+
+    def test_round_trip(self):
+        for dtype, max_error in (('uint8', 32.0 / 254 / 2), ('uint16', 32.0 / 65534 / 2), ('float16', 0.02)):
+            header, values = decode_data_tile(encode_data_tile(self.tile, dtype=dtype))
+            self.assertEqual(header['dtype'], dtype)
+            np.testing.assert_equal(np.ma.getmaskarray(values), self.no_data)
+            self.assertLessEqual(np.abs(values - self.data).max(), max_error + 1e-12)
+
+        # Values outside a given range are clipped
+        header, values = decode_data_tile(encode_data_tile(self.tile, dtype='uint16', value_range=(0.0, 10.0)))
+        self.assertEqual((header['offset'], header['scale']), (0.0, 10.0 / 65534))
+        np.testing.assert_allclose(values, np.clip(self.data, 0.0, 10.0), atol=10.0 / 65534)
+
+        # Fully masked and constant tiles
+        header, values = decode_data_tile(encode_data_tile(np.full((4, 4), np.nan), dtype='uint8'))
+        self.assertEqual((header['min'], header['max']), (None, None))
+        self.assertTrue(values.mask.all())
+        header, values = decode_data_tile(encode_data_tile(np.full((4, 4), 3, dtype=np.int16), dtype='uint8'))
+        np.testing.assert_equal(values, np.full((4, 4), 3.0))
+
+        with self.assertRaises(ValueError):
+            encode_data_tile(self.tile, dtype='int8')
+
+    def test_quantized_data_image(self):
+        pyramid = ImagePyramid.create_from_array(self.data.reshape((1, 20, 30)), tile_size=(15, 10))
+        image = QuantizedDataImage(pyramid.get_level_image(1), dtype='float16',
+                                   tile_cache=Cache(MemoryTileCacheStore()))
+        header, values = decode_data_tile(image.get_tile(1, 1))
+        self.assertEqual(header['shape'], [10, 15])
+        np.testing.assert_allclose(values, self.data[10:20, 15:30], rtol=1e-3)
@@ -1,10 +1,19 @@
+import io
+import time
+from threading import Event, Thread, Lock
 from unittest import TestCase
 
 import numpy as np
+from PIL import Image
 
+import ccitbxws.image
+from ccitbxws.cache import Cache
 from ccitbxws.image import ImagePyramid, OpImage, create_ndarray_downsampling_image, \
-    TransformArrayImage, FastNdarrayDownsamplingImage
-from ccitbxws.utils import aggregate_ndarray_mean
+    TransformArrayImage, FastNdarrayDownsamplingImage, ColorMappedRgbaImage, MemoryTileCacheStore, \
+    get_tile_computation_stats, get_tile_id_groups, is_empty_tile
+from ccitbxws.cmaps import get_color_mapper
+from ccitbxws.tile_stores import is_shared_tile
+from ccitbxws.utils import aggregate_ndarray_mean, aggregate_ndarray_first
 
 
 class MyTiledImage(OpImage):
@@ -18,6 +27,88 @@ class MyTiledImage(OpImage):
         return np.full((th, tw), fill_value, np.float32)
 
 
+class SlowTiledImage(OpImage):
+    """
+    Tiles are computed only once the release event is set.
+    """
+
+    def __init__(self, error=None):
+        super().__init__((4, 4), tile_size=(2, 2), mode='int32', format='ndarray',
+                         tile_cache=Cache(MemoryTileCacheStore(), capacity=1024 * 1024))
+        self.error = error
+        self.num_computed = 0
+        self.lock = Lock()
+        self.release = Event()
+
+    def compute_tile(self, tile_x, tile_y, rectangle):
+        with self.lock:
+            self.num_computed += 1
+        if not self.release.wait(timeout=10.0):
+            raise RuntimeError('tile computation has not been released')
+        if self.error:
+            raise self.error
+        return np.full((2, 2), tile_x + 10 * tile_y, np.int32)
+
+
+class OpImageTest(TestCase):
+    @staticmethod
+    def _get_tiles_concurrently(image, slow_image, num_threads=8):
+        """
+        Get the same tile of image in several threads, and release the computation of slow_image, the source of
+        image, only once all threads but the computing one are waiting for the computation's result.
+        """
+        results = [None] * num_threads
+        num_coalesced = get_tile_computation_stats()['num_coalesced']
+
+        def get_tile(index):
+            try:
+                results[index] = image.get_tile(1, 0).tolist()
+            except ValueError as error:
+                results[index] = error
+
+        threads = [Thread(target=get_tile, args=(i,)) for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        t0 = time.perf_counter()
+        while get_tile_computation_stats()['num_coalesced'] - num_coalesced < num_threads - 1:
+            if time.perf_counter() - t0 > 10.0:
+                break
+            time.sleep(0.001)
+        slow_image.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_distinct_image_ids(self):
+        source_image = SlowTiledImage()
+        self.assertNotEqual(TransformArrayImage(source_image).id, TransformArrayImage(source_image).id)
+
+    def test_concurrent_get_tile(self):
+        image = TransformArrayImage(SlowTiledImage())
+        stats_before = get_tile_computation_stats()
+        results = self._get_tiles_concurrently(TransformArrayImage(image), image.source_image)
+        stats_after = get_tile_computation_stats()
+        self.assertEqual(results, [[[1, 1], [1, 1]]] * 8)
+        self.assertEqual(image.source_image.num_computed, 1)
+        self.assertEqual(stats_after['num_in_progress'], 0)
+        self.assertEqual(stats_after['num_computed'] - stats_before['num_computed'], 3)
+        self.assertEqual(stats_after['num_coalesced'] - stats_before['num_coalesced'], 7)
+
+    def test_concurrent_get_tile_error(self):
+        error = ValueError('no data')
+        image = SlowTiledImage(error=error)
+        results = self._get_tiles_concurrently(image, image)
+        self.assertEqual(results, [error] * 8)
+        self.assertEqual(image.num_computed, 1)
+        self.assertEqual(get_tile_computation_stats()['num_in_progress'], 0)
+
+    def test_get_tile_id_groups(self):
+        self.assertEqual(get_tile_id_groups('f.nc|chl-L3|masked|jet/2/5'),
+                         (('image', 'f.nc|chl|masked|jet'), ('level', '3')))
+        self.assertEqual(get_tile_id_groups('my-image/0/0'), (('image', 'my-image'),))
+        self.assertEqual(get_tile_id_groups(('not', 'a', 'tile', 'ID')), ())
+
+
 class NdarrayImageTest(TestCase):
     def test_default(self):
         a = np.arange(0, 24, dtype=np.int32)
@@ -116,6 +207,110 @@ class NdarrayImageTest(TestCase):
         self.assertEqual(target_image.get_tile(2, 1).tolist(), [[16, None],
                                                                 [22, 23]])
 
+    def test_fully_masked_tiles_are_shared(self):
+        a = np.arange(0, 24, dtype=np.float32).reshape((4, 6))
+        a[:, :4] = np.nan
+        source_image = FastNdarrayDownsamplingImage(a, tile_size=(2, 2), num_levels=1, z_index=0)
+        target_image = TransformArrayImage(source_image, force_masked=True)
+
+        tile = target_image.get_tile(0, 0)
+        self.assertEqual(tile.tolist(), [[None, None], [None, None]])
+        self.assertIs(target_image.get_tile(1, 1), tile)
+        self.assertTrue(is_shared_tile(tile))
+        self.assertFalse(tile.data.flags.writeable)
+        self.assertFalse(is_shared_tile(target_image.get_tile(2, 0)))
+
+
+class ColorMappedRgbaImageTest(TestCase):
+    @staticmethod
+    def _decode(png_bytes):
+        image = Image.open(io.BytesIO(png_bytes))
+        return image.mode, np.array(image.convert('RGBA'))
+
+    def test_palette_png(self):
+        a = np.linspace(-0.2, 1.2, 64 * 64, dtype=np.float32).reshape((64, 64))
+        a[10:20, 5:50] = np.nan
+        source_image = FastNdarrayDownsamplingImage(a, tile_size=(32, 32), num_levels=1, z_index=0)
+
+        rgba_image = ColorMappedRgbaImage(source_image, encode=True, format='PNG', cmap_name='jet')
+        palette_image = ColorMappedRgbaImage(source_image, encode=True, format='PNG', cmap_name='jet',
+                                             palette=True, compress_level=9, compress_type='rle')
+        for tile_x, tile_y in ((0, 0), (1, 1)):
+            rgba_mode, rgba_pixels = self._decode(rgba_image.get_tile(tile_x, tile_y))
+            palette_tile = palette_image.get_tile(tile_x, tile_y)
+            palette_mode, palette_pixels = self._decode(palette_tile)
+            self.assertEqual(rgba_mode, 'RGBA')
+            self.assertEqual(palette_mode, 'P')
+            np.testing.assert_equal(palette_pixels, rgba_pixels)
+
+        self.assertEqual(self._decode(palette_image.get_tile(0, 0))[1][15, 10].tolist(), [0, 0, 0, 0])
+
+    def test_uniform_tiles_are_shared(self):
+        a = np.linspace(0.0, 1.0, 64 * 96, dtype=np.float32).reshape((64, 96))
+        a[:, :32] = np.nan
+        a[:32, 64:] = 0.5
+        source_image = TransformArrayImage(FastNdarrayDownsamplingImage(a, tile_size=(32, 32),
+                                                                        num_levels=1, z_index=0))
+        image = ColorMappedRgbaImage(source_image, encode=True, format='PNG', cmap_name='jet', palette=True)
+
+        empty_tile = image.get_tile(0, 0)
+        self.assertIs(image.get_tile(0, 1), empty_tile)
+        self.assertTrue(is_empty_tile(empty_tile))
+        self.assertEqual(self._decode(empty_tile)[1].tolist(), np.zeros((32, 32, 4)).tolist())
+
+        # Other images of the same encoding and tile size share the tiles
+        other_image = ColorMappedRgbaImage(source_image, encode=True, format='PNG', cmap_name='jet', palette=True,
+                                           image_id='other')
+        self.assertIs(other_image.get_tile(0, 0), empty_tile)
+
+        constant_tile = image.get_tile(2, 0)
+        self.assertIs(image.get_tile(2, 0), constant_tile)
+        self.assertFalse(is_empty_tile(constant_tile))
+        expected_pixels = get_color_mapper('jet').map(np.full((32, 32), 0.5, dtype=np.float32), (0.0, 1.0))
+        np.testing.assert_equal(self._decode(constant_tile)[1], expected_pixels)
+
+        tile = image.get_tile(1, 0)
+        self.assertFalse(is_empty_tile(tile))
+        self.assertFalse(is_shared_tile(tile))
+
+    def test_empty_tiles_are_limited(self):
+        def get_empty_tile(size):
+            source_image = TransformArrayImage(FastNdarrayDownsamplingImage(np.full((size, size), np.nan), num_levels=1,
+                                                                            tile_size=(size, size), z_index=0))
+            return ColorMappedRgbaImage(source_image, encode=True, format='PNG', cmap_name='jet').get_tile(0, 0)
+
+        # Copies of empty tiles are recognized
+        self.assertTrue(is_empty_tile(bytes(bytearray(get_empty_tile(17)))))
+        max_num_empty_tiles = ccitbxws.image.MAX_NUM_EMPTY_TILES
+        ccitbxws.image.MAX_NUM_EMPTY_TILES = len(ccitbxws.image._EMPTY_TILES)
+        try:
+            self.assertFalse(is_empty_tile(get_empty_tile(19)))
+            self.assertEqual(len(ccitbxws.image._EMPTY_TILES), ccitbxws.image.MAX_NUM_EMPTY_TILES)
+        finally:
+            ccitbxws.image.MAX_NUM_EMPTY_TILES = max_num_empty_tiles
+
+    def test_webp_and_jpeg(self):
+        a = np.linspace(-0.2, 1.2, 64 * 64, dtype=np.float32).reshape((64, 64))
+        a[10:20, 5:50] = np.nan
+        source_image = FastNdarrayDownsamplingImage(a, tile_size=(32, 32), num_levels=1, z_index=0)
+
+        rgba_image = ColorMappedRgbaImage(source_image, encode=True, format='PNG', cmap_name='jet')
+        rgba_pixels = self._decode(rgba_image.get_tile(0, 0))[1]
+        webp_image = ColorMappedRgbaImage(source_image, encode=True, format='WEBP', cmap_name='jet', lossless=True)
+        webp_mode, webp_pixels = self._decode(webp_image.get_tile(0, 0))
+        self.assertEqual(webp_mode, 'RGBA')
+        # the color of transparent pixels is not preserved by lossless WebP
+        np.testing.assert_equal(webp_pixels[..., 3], rgba_pixels[..., 3])
+        visible = rgba_pixels[..., 3] > 0
+        np.testing.assert_equal(webp_pixels[visible], rgba_pixels[visible])
+
+        jpeg_image = ColorMappedRgbaImage(source_image, encode=True, format='JPEG', cmap_name='jet', quality=95)
+        jpeg_mode, jpeg_pixels = self._decode(jpeg_image.get_tile(0, 0))
+        self.assertEqual(jpeg_mode, 'RGB')
+        # no-data pixels become black
+        self.assertLess(np.abs(jpeg_pixels[15, 20, :3].astype(np.int32)).max(), 16)
+        self.assertLess(np.abs(jpeg_pixels[25:, :, :3].astype(np.int32) - rgba_pixels[25:, :, :3]).mean(), 8)
+
 
 class ImagePyramidTest(TestCase):
     def test_create_from_image(self):
@@ -253,6 +448,55 @@ class ImagePyramidTest(TestCase):
         self.assertAlmostEqual(0, tile_0_1_0[..., 0, 0])
         self.assertAlmostEqual(0, tile_0_1_0[..., 269, 269])
 
+    def test_create_overviews_from_array(self):
+        array = np.linspace(0.0, 1.0, 40 * 80, dtype=np.float32).reshape((1, 40, 80))
+        array[..., :10, :20] = np.nan
+        num_reads = [0]
+
+        class CountingArray:
+            shape = array.shape
+            dtype = array.dtype
+
+            def __getitem__(self, index):
+                num_reads[0] += 1
+                return array[index]
+
+        tile_cache = Cache(MemoryTileCacheStore(), capacity=16 * 1024 * 1024)
+        # Odd tile sizes are stitched before they are aggregated
+        for tile_size in ((10, 10), (5, 5)):
+            num_reads[0] = 0
+            pyramid = ImagePyramid.create_overviews_from_array(CountingArray(), tile_size=tile_size,
+                                                               tile_cache=tile_cache)
+            self.assertEqual((2, 1), pyramid.num_level_zero_tiles)
+            strided_pyramid = ImagePyramid.create_from_array(array, tile_size=tile_size)
+            self.assertEqual(strided_pyramid.num_levels, pyramid.num_levels)
+            max_num_tiles = pyramid.get_level_image(pyramid.num_levels - 1).num_tiles
+            for z_index in range(pyramid.num_levels - 1, -1, -1):
+                level_image = pyramid.get_level_image(z_index)
+                self.assertEqual(strided_pyramid.get_level_image(z_index).size, level_image.size)
+                num_tiles_x, num_tiles_y = level_image.num_tiles
+                for tile_y in range(num_tiles_y):
+                    for tile_x in range(num_tiles_x):
+                        self.assertEqual((1,) + tile_size[::-1], level_image.get_tile(tile_x, tile_y).shape)
+            # Each tile of the highest level has been read once, lower levels didn't read the array
+            self.assertEqual(max_num_tiles[0] * max_num_tiles[1], num_reads[0])
+
+        # The NaN mean of the array
+        tile = pyramid.get_tile(0, 0, 0)
+        self.assertTrue(np.isnan(tile[0, 0, 0]))
+        self.assertAlmostEqual(np.mean(array[0, 32:40, 32:40]), tile[0, 4, 4], places=5)
+
+        pyramid = ImagePyramid.create_overviews_from_array(array, tile_size=(10, 10),
+                                                           aggregator=aggregate_ndarray_first,
+                                                           level_transform=lambda image, z_index:
+                                                           TransformArrayImage(image, force_masked=True))
+        # The 'first' aggregation yields the same tiles as strided reads
+        tile = pyramid.get_tile(0, 0, 0)
+        strided_tile = ImagePyramid.create_from_array(array, tile_size=(10, 10)).get_tile(0, 0, 0)
+        self.assertIsInstance(tile, np.ma.MaskedArray)
+        np.testing.assert_equal(np.ma.getmaskarray(tile), np.isnan(strided_tile))
+        np.testing.assert_equal(tile.compressed(), strided_tile[~np.isnan(strided_tile)])
+
     def test_compute_tile_size_b2(self):
         self.assertEqual(compute_tile_size_b2(7200), (225, 5))
         self.assertEqual(compute_tile_size_b2(3600), (225, 4))
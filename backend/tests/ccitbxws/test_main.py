@@ -1,6 +1,24 @@
+import io
+import os
+import shutil
+import tempfile
+from threading import Event, Thread
 from unittest import TestCase
 
+import falcon
+import falcon.testing
+import h5py
+import numpy as np
+from PIL import Image
+
+import ccitbxws.main as main
+from ccitbxws.cache import Cache
+from ccitbxws.data_tiles import decode_data_tile
+from ccitbxws.image import MemoryTileCacheStore, get_default_tile_cache, set_default_tile_cache, get_tile_id_groups, \
+    is_empty_tile
 from ccitbxws.main import _get_time_string_from_file_name
+from ccitbxws.prefetch import TilePrefetcher
+from ccitbxws.tile_stores import is_shared_tile
 
 
 class MainTest(TestCase):
@@ -25,3 +43,445 @@ class MainTest(TestCase):
                 None,
                 _get_time_string_from_file_name(
                         '20120101120000-ESUPPI-L4_GHRSST-SSTfnd-OSTIA-GLOB_DM-v02.0-fv01.0.nc'))
+
+
+class PyramidsTest(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.dir_path, 'test.nc')
+        with h5py.File(self.file_path, 'w') as dataset:
+            data = np.linspace(0., 1., 540 * 1080, dtype=np.float32).reshape((1, 540, 1080))
+            dataset.create_dataset('chl', data=data, fillvalue=np.nan)
+            data[:, :, :540] = np.nan
+            dataset.create_dataset('sst', data=data, fillvalue=np.nan)
+        self.tile_cache = get_default_tile_cache()
+        set_default_tile_cache(Cache(MemoryTileCacheStore(), capacity=256 * 1024 * 1024,
+                                     stats_group_func=get_tile_id_groups))
+
+    def tearDown(self):
+        main._close_dataset(self.file_path)
+        set_default_tile_cache(self.tile_cache, no_cache=self.tile_cache is None)
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def test_color_mapped_pyramids_share_data_pyramid(self):
+        pyramid1 = main._get_color_mapped_pyramid(self.file_path, 'chl', 'jet', 0.0, 1.0)
+        pyramid2 = main._get_color_mapped_pyramid(self.file_path, 'chl', 'jet', 0.2, 0.8)
+        self.assertIs(main._get_color_mapped_pyramid(self.file_path, 'chl', 'jet', 0.0, 1.0), pyramid1)
+        self.assertIsNot(pyramid2, pyramid1)
+        data_pyramid = main._get_data_pyramid(self.file_path, 'chl')
+        self.assertIs(pyramid1.get_level_image(0).source_image, data_pyramid.get_level_image(0))
+        self.assertIs(pyramid2.get_level_image(0).source_image, data_pyramid.get_level_image(0))
+
+        tile1 = pyramid1.get_tile(0, 0, 0)
+        tile2 = pyramid2.get_tile(0, 0, 0)
+        self.assertIsInstance(tile1, bytes)
+        self.assertNotEqual(tile1, tile2)
+
+        # The data tile has been read only once
+        data_image_group = '%s|chl' % self.file_path
+        stats = get_default_tile_cache().get_stats()
+        self.assertEqual(stats['groups']['image'][data_image_group]['puts'], 1)
+        self.assertEqual(stats['groups']['image'][data_image_group + '|masked']['hits'], 1)
+
+        main._close_dataset(self.file_path)
+        self.assertNotIn((self.file_path, 'chl', None), main.DATA_PYRAMIDS)
+        self.assertFalse([key for key in main.PYRAMIDS if key[0] == self.file_path])
+
+    def test_empty_tiles(self):
+        api = falcon.API()
+        api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}', main.FileVarTile())
+        client = falcon.testing.TestClient(api)
+        params = {'file': self.file_path, 'var': 'sst'}
+
+        empty_response = client.simulate_get('/ccitbx/FileVarTile/0/0/0.png', params=params)
+        self.assertEqual(empty_response.status, falcon.HTTP_OK)
+        self.assertTrue(is_empty_tile(empty_response.content))
+        response = client.simulate_get('/ccitbx/FileVarTile/0/0/1.png', params=params)
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        self.assertFalse(is_empty_tile(response.content))
+
+        # Empty tiles are cached by reference only
+        pyramid = main._get_color_mapped_pyramid(self.file_path, 'sst', 'jet', 0.0, 1.0,
+                                                 encoding=('PNG', (('palette', True),)))
+        self.assertIs(pyramid.get_tile(0, 0, 0), pyramid.get_tile(0, 0, 0))
+        self.assertTrue(is_shared_tile(pyramid.get_tile(0, 0, 0)))
+        self.assertTrue(is_shared_tile(main._get_data_pyramid(self.file_path, 'sst').get_tile(0, 0, 0)))
+
+        response = client.simulate_get('/ccitbx/FileVarTile/0/0/0.png', params=dict(params, no_content='true'))
+        self.assertEqual(response.status, falcon.HTTP_NO_CONTENT)
+        self.assertEqual(response.content, b'')
+        response = client.simulate_get('/ccitbx/FileVarTile/0/0/1.png', params=dict(params, no_content='true'))
+        self.assertEqual(response.status, falcon.HTTP_OK)
+
+    def test_tile_stats(self):
+        api = falcon.API()
+        api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}', main.FileVarTile())
+        api.add_route('/ccitbx/FileVarStats', main.FileVarStats())
+        client = falcon.testing.TestClient(api)
+        params = {'file': self.file_path, 'var': 'sst'}
+
+        num_levels = main._get_data_pyramid(self.file_path, 'sst').num_levels
+        z = num_levels - 1
+        for x in range(4):
+            client.simulate_get('/ccitbx/FileVarTile/%d/0/%d.png' % (z, x), params=params)
+        result = client.simulate_get('/ccitbx/FileVarStats', params=params).json
+        self.assertEqual(result['num_levels'], num_levels)
+        self.assertEqual(result['levels'][z]['num_known_tiles'], 4)
+        self.assertEqual(result['levels'][z]['num_empty_tiles'], 2)
+
+        result = client.simulate_get('/ccitbx/FileVarStats', params=dict(params, z=str(z))).json
+        self.assertEqual([(tile['x'], tile['y'], tile['empty']) for tile in result['tiles']],
+                         [(0, 0, True), (1, 0, True), (2, 0, False), (3, 0, False)])
+        result = client.simulate_get('/ccitbx/FileVarStats',
+                                     params=dict(params, z=str(z), x0='1', y0='0', x1='4', y1='1')).json
+        self.assertEqual(result['num_tiles'], 3)
+        self.assertEqual(result['non_empty_tiles'], [[2, 0], [3, 0]])
+        self.assertAlmostEqual(result['min'], 540 / (540 * 1080 - 1), places=6)
+        self.assertTrue(result['exact'])
+
+        # Statistics are saved next to the data file when it is closed, and loaded when it is opened again
+        main._close_dataset(self.file_path)
+        self.assertTrue(os.path.exists(main._get_tile_stats_path(self.file_path, 'sst')))
+        tile_stats = main._get_data_pyramid(self.file_path, 'sst').tile_stats
+        self.assertTrue(tile_stats.is_empty(z, 1, 0))
+        self.assertEqual(tile_stats.num_changes, 0)
+
+    def test_data_pyramids_are_built_concurrently(self):
+        create_strided_pyramid = main._create_strided_pyramid
+        building = Event()
+        release = Event()
+        results = {}
+
+        def create_slow_pyramid(file_path, var_name, variable, index):
+            if var_name == 'chl':
+                building.set()
+                release.wait(10.0)
+            return create_strided_pyramid(file_path, var_name, variable, index)
+
+        def get_pyramid():
+            results['chl'] = main._get_data_pyramid(self.file_path, 'chl')
+
+        main._create_strided_pyramid = create_slow_pyramid
+        try:
+            thread = Thread(target=get_pyramid)
+            thread.start()
+            self.assertTrue(building.wait(10.0))
+            # The pyramid of another variable is not blocked by the one being built
+            self.assertIsNotNone(main._get_data_pyramid(self.file_path, 'sst'))
+            self.assertNotIn((self.file_path, 'chl', None), main.DATA_PYRAMIDS)
+            release.set()
+            thread.join()
+        finally:
+            release.set()
+            main._create_strided_pyramid = create_strided_pyramid
+        self.assertIs(main._get_data_pyramid(self.file_path, 'chl'), results['chl'])
+
+    def test_overview_pyramid(self):
+        strided_pyramid = main._get_data_pyramid(self.file_path, 'sst')
+        z = strided_pyramid.num_levels - 1
+        strided_tiles = {key: strided_pyramid.get_tile(*key) for key in ((2, 1, z), (1, 0, 0))}
+        main._close_dataset(self.file_path)
+        main.CONFIG['TILE_PYRAMID_AGGREGATION'] = 'nanmean'
+        try:
+            pyramid = main._get_data_pyramid(self.file_path, 'sst')
+            self.assertEqual(pyramid.num_levels, strided_pyramid.num_levels)
+            self.assertIn('|sst|nanmean-L0|masked', pyramid.get_level_image(0).id)
+            self.assertTrue(main._get_tile_stats_path(self.file_path, 'sst').endswith('.sst.nanmean.tilestats.npz'))
+
+            # The highest level is equal, lower levels are aggregated from it
+            np.testing.assert_equal(pyramid.get_tile(2, 1, z), strided_tiles[(2, 1, z)])
+            tile = pyramid.get_tile(1, 0, 0)
+            self.assertEqual(tile.shape, strided_tiles[(1, 0, 0)].shape)
+            self.assertEqual(tile.count(), tile.size)
+            self.assertTrue(is_shared_tile(pyramid.get_tile(0, 0, 0)))
+            self.assertTrue(pyramid.tile_stats.is_empty(z, 0, 0))
+
+            main._close_dataset(self.file_path)
+            main.CONFIG['TILE_PYRAMID_AGGREGATION'] = 'median'
+            with self.assertRaises(ValueError):
+                main._get_data_pyramid(self.file_path, 'sst')
+        finally:
+            del main.CONFIG['TILE_PYRAMID_AGGREGATION']
+
+    def test_tile_formats(self):
+        api = falcon.API()
+        api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}', main.FileVarTile())
+        client = falcon.testing.TestClient(api)
+        params = {'file': self.file_path, 'var': 'chl'}
+
+        def get_tile(name, accept=None, **kwargs):
+            return client.simulate_get('/ccitbx/FileVarTile/0/0/' + name, params=dict(params, **kwargs),
+                                       headers={'Accept': accept} if accept else None)
+
+        for name, accept, media_type, image_format in (('0.png', None, 'image/png', 'PNG'),
+                                                       ('0.webp', None, 'image/webp', 'WEBP'),
+                                                       ('0.jpg', None, 'image/jpeg', 'JPEG'),
+                                                       ('0', None, 'image/png', 'PNG'),
+                                                       ('0', 'image/webp,*/*;q=0.8', 'image/webp', 'WEBP'),
+                                                       ('0', 'image/jpeg', 'image/jpeg', 'JPEG')):
+            response = get_tile(name, accept)
+            self.assertEqual(response.status, falcon.HTTP_OK)
+            self.assertEqual(response.headers['content-type'], media_type)
+            self.assertEqual(response.headers.get('vary'), 'Accept' if name == '0' else None)
+            self.assertEqual(Image.open(io.BytesIO(response.content)).format, image_format)
+
+        self.assertEqual(get_tile('0', 'text/html').status, falcon.HTTP_NOT_ACCEPTABLE)
+        self.assertEqual(get_tile('0.gif').status, falcon.HTTP_NOT_FOUND)
+        self.assertEqual(get_tile('0.webp', quality='101').status, falcon.HTTP_BAD_REQUEST)
+
+        # Tiles are cached per format and encoding
+        lossless_tile = get_tile('0.webp', lossless='true').content
+        self.assertNotEqual(lossless_tile, get_tile('0.webp').content)
+        encodings = set(key[5] for key in main.PYRAMIDS if key[0] == self.file_path)
+        self.assertEqual(encodings, {('PNG', (('palette', True),)),
+                                     ('WEBP', (('lossless', False),)),
+                                     ('WEBP', (('lossless', True),)),
+                                     ('JPEG', ())})
+
+    def test_illegal_tiles(self):
+        api = falcon.API()
+        api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}', main.FileVarTile())
+        client = falcon.testing.TestClient(api)
+        params = {'file': self.file_path, 'var': 'chl'}
+        prefetcher = main._TILE_PREFETCHER
+        main._TILE_PREFETCHER = TilePrefetcher(num_workers=1)
+        try:
+            for path in ('-1/0/0', '1/0/-1', '1/-1/0', '1/0/a', '1/0/a.png', 'a/0/0'):
+                response = client.simulate_get('/ccitbx/FileVarTile/' + path, params=params)
+                self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST, msg=path)
+            for path in ('9/0/0', '1/0/4', '1/2/0.png'):
+                response = client.simulate_get('/ccitbx/FileVarTile/' + path, params=params)
+                self.assertEqual(response.status, falcon.HTTP_NOT_FOUND, msg=path)
+            stats = main._TILE_PREFETCHER.get_stats()
+            self.assertEqual((stats['num_requests'], stats['num_scheduled']), (0, 0))
+            response = client.simulate_get('/ccitbx/FileVarTile/1/1/3.png', params=params)
+            self.assertEqual(response.status, falcon.HTTP_OK)
+            self.assertEqual(main._TILE_PREFETCHER.get_stats()['num_requests'], 1)
+        finally:
+            main._TILE_PREFETCHER.shutdown()
+            main._TILE_PREFETCHER = prefetcher
+
+    def test_leading_dimension_index(self):
+        file_path = os.path.join(self.dir_path, 'test-time.nc')
+        data = np.linspace(0., 1., 3 * 540 * 1080, dtype=np.float32).reshape((3, 540, 1080))
+        with h5py.File(file_path, 'w') as dataset:
+            dataset.create_dataset('chl', data=data, chunks=(1, 270, 270), fillvalue=np.nan)
+        api = falcon.API()
+        api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}', main.FileVarTile())
+        client = falcon.testing.TestClient(api)
+        params = {'file': file_path, 'var': 'chl', 'cmap': 'gray'}
+        try:
+            contents = [client.simulate_get('/ccitbx/FileVarTile/0/0/1.png',
+                                            params=dict(params, index=str(i))).content for i in range(3)]
+            self.assertEqual(len(set(contents)), 3)
+            # The time step defaults to 0
+            self.assertEqual(client.simulate_get('/ccitbx/FileVarTile/0/0/1.png', params=params).content,
+                             contents[0])
+
+            # Only the 2D slice of the time step is read, and each time step has its own tiles
+            data_pyramid = main._get_data_pyramid(file_path, 'chl', index=(2,))
+            self.assertTrue(data_pyramid.get_level_image(0).id.startswith('%s|chl[2]' % file_path))
+            tile_width, tile_height = data_pyramid.tile_size
+            tile = data_pyramid.get_tile(1, 0, data_pyramid.num_levels - 1)
+            self.assertEqual(tile.shape, (tile_height, tile_width))
+            np.testing.assert_equal(tile, data[2, :tile_height, tile_width:2 * tile_width])
+            self.assertTrue(main._get_tile_stats_path(file_path, 'chl', (2,)).endswith('.chl[2].tilestats.npz'))
+
+            response = client.simulate_get('/ccitbx/FileVarTile/0/0/1.png', params=dict(params, index='3'))
+            self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+            response = client.simulate_get('/ccitbx/FileVarTile/0/0/1.png', params=dict(params, index='0,0'))
+            self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+        finally:
+            main._close_dataset(file_path)
+
+    def test_tile_stack(self):
+        file_path = os.path.join(self.dir_path, 'test-time.nc')
+        data = np.linspace(0., 1., 12 * 540 * 1080, dtype=np.float32).reshape((12, 540, 1080))
+        data[:, :10, :10] = np.nan
+        with h5py.File(file_path, 'w') as dataset:
+            dataset.create_dataset('chl', data=data, chunks=(1, 270, 270), fillvalue=np.nan)
+        api = falcon.API()
+        api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}', main.FileVarTile())
+        api.add_route('/ccitbx/FileVarTileStack/{z}/{y}/{x}', main.FileVarTileStack())
+        client = falcon.testing.TestClient(api)
+        params = {'file': file_path, 'var': 'chl', 'cmap': 'jet'}
+        try:
+            response = client.simulate_get('/ccitbx/FileVarTileStack/1/0/0.png', params=dict(params, start=2, stop=6))
+            self.assertEqual(response.status, falcon.HTTP_OK)
+            self.assertEqual(response.headers['content-type'], 'image/png')
+            self.assertEqual(response.headers['x-tile-stack'], '2:6')
+            # The data pyramids of the time steps don't take the places of others in DATA_PYRAMIDS
+            self.assertEqual([key for key in main.DATA_PYRAMIDS if key[0] == file_path], [])
+            self.assertEqual(list(main.STACK_STEP_PYRAMIDS), [(file_path, 'chl', (i,)) for i in range(2, 6)])
+            step_pyramid = main.STACK_STEP_PYRAMIDS[(file_path, 'chl', (2,))]
+            sprite = np.array(Image.open(io.BytesIO(response.content)).convert('RGBA'))
+            tile_width, tile_height = main._get_data_pyramid(file_path, 'chl', index=(0,)).tile_size
+            self.assertEqual(sprite.shape, (4 * tile_height, tile_width, 4))
+            for i in range(4):
+                tile_response = client.simulate_get('/ccitbx/FileVarTile/1/0/0.png', params=dict(params, index=2 + i))
+                tile = np.array(Image.open(io.BytesIO(tile_response.content)).convert('RGBA'))
+                np.testing.assert_equal(sprite[i * tile_height:(i + 1) * tile_height], tile)
+
+            # The stack is assembled from the data pyramids of the time steps and has no data pyramid
+            # and no tile statistics of its own. Time steps requested by themselves reuse the stack's data pyramids.
+            data_pyramid_keys = [key for key in main.DATA_PYRAMIDS if key[0] == file_path]
+            self.assertEqual(sorted(data_pyramid_keys), [(file_path, 'chl', (i,)) for i in (0, 2, 3, 4, 5)])
+            self.assertEqual(list(main.STACK_STEP_PYRAMIDS), [])
+            self.assertIs(main.DATA_PYRAMIDS[(file_path, 'chl', (2,))], step_pyramid)
+            stack_pyramid = main._create_stack_pyramid(file_path, 'chl', ((2, 6),))
+            self.assertTrue(stack_pyramid.get_level_image(1).id.startswith('%s|chl[2:6]' % file_path))
+            self.assertIsNone(stack_pyramid.tile_stats)
+            stack_tile = stack_pyramid.get_tile(0, 0, 1)
+            self.assertEqual(stack_tile.shape, (4, tile_height, tile_width))
+            np.testing.assert_equal(stack_tile[3],
+                                    main._get_data_pyramid(file_path, 'chl', index=(5,)).get_tile(0, 0, 1))
+            main._save_tile_stats(file_path)
+            self.assertEqual(sorted(name for name in os.listdir(self.dir_path) if name.startswith('test-time.nc.')),
+                             ['test-time.nc.chl[%d].tilestats.npz' % i for i in range(2, 6)])
+
+            # All time steps by default, only the most recently used data pyramids of time steps are kept
+            main.MAX_NUM_STACK_STEP_PYRAMIDS = 4
+            response = client.simulate_get('/ccitbx/FileVarTileStack/0/0/0', params=params)
+            self.assertEqual(response.headers['x-tile-stack'], '0:12')
+            self.assertEqual(Image.open(io.BytesIO(response.content)).size, (tile_width, 12 * tile_height))
+            self.assertEqual(len([key for key in main.DATA_PYRAMIDS if key[0] == file_path]), 5)
+            self.assertEqual(list(main.STACK_STEP_PYRAMIDS), [(file_path, 'chl', (i,)) for i in range(8, 12)])
+
+            response = client.simulate_get('/ccitbx/FileVarTileStack/0/0/0.png', params=dict(params, stop=13))
+            self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+            response = client.simulate_get('/ccitbx/FileVarTileStack/0/0/0.png', params=dict(params, start=3, stop=3))
+            self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+            response = client.simulate_get('/ccitbx/FileVarTileStack/0/0/0.jpg', params=params)
+            self.assertEqual(response.status, falcon.HTTP_NOT_FOUND)
+            for path in ('-1/0/0.png', '0/0/-1.png', '0/a/0.png', '0/0/1x.png'):
+                response = client.simulate_get('/ccitbx/FileVarTileStack/' + path, params=params)
+                self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST, msg=path)
+            num_levels = main._get_data_pyramid(file_path, 'chl', index=(0,)).num_levels
+            for path in ('%d/0/0.png' % num_levels, '0/0/2.png', '0/1/0.png'):
+                response = client.simulate_get('/ccitbx/FileVarTileStack/' + path, params=params)
+                self.assertEqual(response.status, falcon.HTTP_NOT_FOUND, msg=path)
+            response = client.simulate_get('/ccitbx/FileVarTileStack/0/0/0.png', params={'file': self.file_path,
+                                                                                         'var': 'chl', 'stop': 2})
+            self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+        finally:
+            main.MAX_NUM_STACK_STEP_PYRAMIDS = 2 * main.MAX_NUM_STACK_STEPS
+            main._close_dataset(file_path)
+
+    def test_data_pyramids_are_evicted(self):
+        file_path = os.path.join(self.dir_path, 'test-time.nc')
+        data = np.linspace(0., 1., 4 * 540 * 1080, dtype=np.float32).reshape((4, 540, 1080))
+        with h5py.File(file_path, 'w') as dataset:
+            dataset.create_dataset('chl', data=data, chunks=(1, 270, 270), fillvalue=np.nan)
+        max_num_data_pyramids = main.MAX_NUM_DATA_PYRAMIDS
+        main.MAX_NUM_DATA_PYRAMIDS = 2
+        try:
+            pyramid = main._get_data_pyramid(file_path, 'chl', index=(0,))
+            pyramid.get_tile(0, 0, 0)
+            main._get_data_pyramid(file_path, 'chl', index=(1,))
+            self.assertIs(main._get_data_pyramid(file_path, 'chl', index=(0,)), pyramid)
+            main._get_data_pyramid(file_path, 'chl', index=(2,))
+            self.assertEqual(list(main.DATA_PYRAMIDS.keys())[-2:], [(file_path, 'chl', (0,)), (file_path, 'chl', (2,))])
+            # The least recently used pyramid is evicted, the statistics of evicted pyramids are saved
+            main._get_data_pyramid(file_path, 'chl', index=(3,))
+            self.assertNotIn((file_path, 'chl', (0,)), main.DATA_PYRAMIDS)
+            self.assertTrue(os.path.exists(main._get_tile_stats_path(file_path, 'chl', (0,))))
+        finally:
+            main.MAX_NUM_DATA_PYRAMIDS = max_num_data_pyramids
+            main._close_dataset(file_path)
+
+    def test_data_tiles(self):
+        api = falcon.API()
+        api.add_route('/ccitbx/FileVarDataTile/{z}/{y}/{x}', main.FileVarDataTile())
+        client = falcon.testing.TestClient(api)
+        params = {'file': self.file_path, 'var': 'sst'}
+        data_pyramid = main._get_data_pyramid(self.file_path, 'sst')
+
+        response = client.simulate_get('/ccitbx/FileVarDataTile/1/0/1', params=params)
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        self.assertEqual(response.headers['content-type'], 'application/octet-stream')
+        header, values = decode_data_tile(response.content)
+        self.assertEqual(header['dtype'], 'uint16')
+        data_tile = data_pyramid.get_tile(1, 0, 1)
+        np.testing.assert_equal(values.mask, np.ma.getmaskarray(data_tile)[0])
+        np.testing.assert_allclose(values, data_tile[0], atol=header['scale'])
+
+        response = client.simulate_get('/ccitbx/FileVarDataTile/1/0/1',
+                                       params=dict(params, dtype='uint8', min='0.25', max='0.75'))
+        header, values = decode_data_tile(response.content)
+        self.assertEqual((header['dtype'], header['offset']), ('uint8', 0.25))
+        np.testing.assert_allclose(values, np.clip(data_tile[0], 0.25, 0.75), atol=header['scale'])
+        self.assertIn((self.file_path, 'sst', 'data', (0.25, 0.75), None, 'uint8', None), main.PYRAMIDS)
+
+        # The left half of sst is no-data
+        _, values = decode_data_tile(client.simulate_get('/ccitbx/FileVarDataTile/1/0/0',
+                                                         params=dict(params, dtype='float16')).content)
+        self.assertTrue(values.mask.all())
+
+        response = client.simulate_get('/ccitbx/FileVarDataTile/1/0/1', params=dict(params, dtype='int8'))
+        self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+        response = client.simulate_get('/ccitbx/FileVarDataTile/1/0/1', params=dict(params, min='1'))
+        self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+        response = client.simulate_get('/ccitbx/FileVarDataTile/1/0/1', params=dict(params, min='1', max='0'))
+        self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+        for path in ('-1/0/0', '1/0/-1', '1/-1/0', '1/0/a'):
+            response = client.simulate_get('/ccitbx/FileVarDataTile/' + path, params=params)
+            self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST, msg=path)
+        for path in ('9/0/0', '1/0/4', '1/2/0'):
+            response = client.simulate_get('/ccitbx/FileVarDataTile/' + path, params=params)
+            self.assertEqual(response.status, falcon.HTTP_NOT_FOUND, msg=path)
+
+    def test_tile_batch(self):
+        api = falcon.API()
+        api.add_route('/ccitbx/FileVarTile/{z}/{y}/{x}', main.FileVarTile())
+        api.add_route('/ccitbx/FileVarTiles', main.FileVarTiles())
+        client = falcon.testing.TestClient(api)
+        params = {'file': self.file_path, 'var': 'chl,sst', 'tiles': '0/0/0,0/0/1,1/1/3', 'no_content': 'true'}
+
+        response = client.simulate_get('/ccitbx/FileVarTiles', params=params)
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        content_type, _, boundary = response.headers['content-type'].partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/mixed')
+        parts = _parse_multipart(response.content, boundary)
+        self.assertEqual(sorted(parts.keys()), ['chl/0/0/0', 'chl/0/0/1', 'chl/1/1/3',
+                                                'sst/0/0/0', 'sst/0/0/1', 'sst/1/1/3'])
+        for tile, (headers, data) in parts.items():
+            var_name, z, y, x = tile.split('/')
+            tile_response = client.simulate_get('/ccitbx/FileVarTile/%s/%s/%s.png' % (z, y, x),
+                                                params=dict(params, var=var_name))
+            self.assertEqual(headers['X-Tile-Status'], '204' if tile == 'sst/0/0/0' else '200')
+            self.assertEqual(headers['Content-Type'], 'image/png')
+            self.assertEqual(data, tile_response.content)
+
+        response = client.simulate_get('/ccitbx/FileVarTiles', params=dict(params, tiles='0/0/2'))
+        self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+        response = client.simulate_get('/ccitbx/FileVarTiles', params=dict(params, tiles='0/0'))
+        self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+        response = client.simulate_get('/ccitbx/FileVarTiles', params=dict(params, tiles='0/-1/0'))
+        self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+        response = client.simulate_get('/ccitbx/FileVarTiles', params=dict(params, format='gif'))
+        self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+        response = client.simulate_get('/ccitbx/FileVarTiles', params=dict(params, format='webp'))
+        self.assertEqual(set(headers['Content-Type'] for headers, _ in
+                             _parse_multipart(response.content, boundary=response.headers['content-type']
+                                              .partition('; boundary=')[2]).values()), {'image/webp'})
+
+
+def _parse_multipart(content, boundary):
+    # Parts are read by their Content-Length header
+    parts = {}
+    stream = io.BytesIO(content)
+    while True:
+        delimiter = stream.readline()
+        if delimiter == ('--%s--\r\n' % boundary).encode('ascii'):
+            return parts
+        assert delimiter == ('--%s\r\n' % boundary).encode('ascii'), delimiter
+        headers = {}
+        while True:
+            line = stream.readline().decode('utf-8').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(': ')
+            headers[name] = value
+        data = stream.read(int(headers['Content-Length']))
+        assert stream.read(2) == b'\r\n'
+        parts[headers['X-Tile']] = (headers, data)
@@ -0,0 +1,109 @@
+import time
+from unittest import TestCase
+
+import numpy as np
+
+from ccitbxws.cache import Cache
+from ccitbxws.image import ImagePyramid
+from ccitbxws.prefetch import TilePrefetcher
+from ccitbxws.tile_stores import MemoryTileCacheStore
+
+
+def _wait_for(condition, timeout=5.0):
+    t0 = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - t0 > timeout:
+            raise AssertionError('timeout')
+        time.sleep(0.005)
+
+
+class TilePrefetcherTest(TestCase):
+    def setUp(self):
+        self.tile_cache = Cache(MemoryTileCacheStore(), capacity=16 * 1024 * 1024)
+        array = np.linspace(0., 1., 40 * 80, dtype=np.float32).reshape((40, 80))
+        # 3 levels of 2 x 1, 4 x 2 and 8 x 4 tiles
+        self.pyramid = ImagePyramid.create_from_array(array, tile_size=(10, 10), tile_cache=self.tile_cache)
+
+    def test_prefetch_neighbours_parent_and_children(self):
+        prefetcher = TilePrefetcher(num_workers=2)
+        try:
+            self.assertEqual(TilePrefetcher._get_neighbours(self.pyramid, 0, 1, 1),
+                             [(0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 0, 0),
+                              (0, 2, 2), (1, 2, 2), (0, 3, 2), (1, 3, 2)])
+            level_image = self.pyramid.get_level_image(1)
+            level_image.get_tile(1, 0)
+            prefetcher.prefetch(self.pyramid, 0, 1, 1, client_key='client')
+            _wait_for(lambda: prefetcher.get_stats()['num_prefetched'] == 7)
+            self.assertEqual(prefetcher.get_stats()['num_scheduled'], 7)
+            self.assertIsNotNone(self.tile_cache.get_value(self.pyramid.get_level_image(0).get_tile_id(0, 0)))
+            self.assertIsNotNone(self.tile_cache.get_value(self.pyramid.get_level_image(2).get_tile_id(1, 3)))
+
+            prefetcher.record_request(level_image.get_tile_id(0, 0))
+            prefetcher.record_request(level_image.get_tile_id(0, 0))
+            prefetcher.record_request(level_image.get_tile_id(1, 0))
+            stats = prefetcher.get_stats()
+            self.assertEqual((stats['num_requests'], stats['num_hits']), (3, 1))
+            self.assertAlmostEqual(stats['hit_ratio'], 1 / 7)
+            self.assertAlmostEqual(stats['request_hit_ratio'], 1 / 3)
+        finally:
+            prefetcher.shutdown()
+
+    def test_limits(self):
+        prefetcher = TilePrefetcher(num_workers=1, max_pending_per_client=3, max_pending_per_pyramid=5)
+        try:
+            # Nothing is prefetched while tiles are served
+            with prefetcher.serving():
+                prefetcher.prefetch(self.pyramid, 3, 2, 2, client_key='client1')
+                time.sleep(0.05)
+                stats = prefetcher.get_stats()
+                self.assertEqual((stats['num_scheduled'], stats['num_dropped'], stats['num_pending']), (9, 6, 3))
+                prefetcher.prefetch(self.pyramid, 1, 0, 0, client_key='client2')
+                stats = prefetcher.get_stats()
+                self.assertEqual((stats['num_dropped'], stats['num_pending']), (9, 5))
+                self.assertEqual(stats['num_prefetched'], 0)
+            _wait_for(lambda: prefetcher.get_stats()['num_prefetched'] == 5)
+        finally:
+            prefetcher.shutdown()
+
+    def test_cache_pressure(self):
+        prefetcher = TilePrefetcher(num_workers=1, max_cache_load=0.5)
+        try:
+            small_cache = Cache(MemoryTileCacheStore(), capacity=10 * 10 * 4 * 4)
+            pyramid = ImagePyramid.create_from_array(np.zeros((40, 80), dtype=np.float32), tile_size=(10, 10),
+                                                     tile_cache=small_cache)
+            # A nearly full cache whose tiles are not being replaced is not under pressure
+            for x in range(3):
+                pyramid.get_tile(x, 0, 2)
+            self.assertGreater(small_cache.size, 0.5 * small_cache.max_size)
+            self.assertEqual(small_cache.evicted_size, 0)
+            self.assertFalse(prefetcher._is_under_pressure(small_cache))
+            # One that keeps evicting is
+            for y in range(4):
+                for x in range(8):
+                    pyramid.get_tile(x, y, 2)
+            self.assertGreater(small_cache.evicted_size, small_cache.max_size)
+            prefetcher.prefetch(pyramid, 1, 1, 1)
+            stats = prefetcher.get_stats()
+            self.assertEqual((stats['num_scheduled'], stats['num_skipped']), (0, 1))
+        finally:
+            prefetcher.shutdown()
+
+    def test_prefetch_into_full_cache(self):
+        prefetcher = TilePrefetcher(num_workers=1, max_cache_load=0.5, pressure_window=0.05)
+        try:
+            small_cache = Cache(MemoryTileCacheStore(), capacity=10 * 10 * 4 * 8)
+            pyramid = ImagePyramid.create_from_array(np.zeros((40, 80), dtype=np.float32), tile_size=(10, 10),
+                                                     tile_cache=small_cache)
+            for y in range(4):
+                for x in range(8):
+                    pyramid.get_tile(x, y, 2)
+            self.assertGreater(small_cache.size, 0.5 * small_cache.max_size)
+            self.assertTrue(prefetcher._is_under_pressure(small_cache))
+            # Once the evictions are older than two pressure windows, the cache stays full but prefetches run
+            time.sleep(0.2)
+            self.assertFalse(prefetcher._is_under_pressure(small_cache))
+            self.assertGreater(small_cache.size, 0.5 * small_cache.max_size)
+            prefetcher.prefetch(pyramid, 0, 0, 1)
+            _wait_for(lambda: prefetcher.get_stats()['num_prefetched'] > 0)
+        finally:
+            prefetcher.shutdown()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from ccitbxws.image import ImagePyramid
+from ccitbxws.pyramid_sidecar import build_pyramid_sidecar, close_pyramid_sidecars, get_sidecar_path, main
+
+
+class PyramidSidecarTest(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.dir_path, 'test.nc')
+        with h5py.File(self.file_path, 'w') as dataset:
+            data = np.linspace(0., 1., 80 * 160, dtype=np.float32).reshape((1, 80, 160))
+            data[:, :20, :40] = np.nan
+            data[:, 41, 81] = -1.
+            dataset.create_dataset('chl', data=data, chunks=(1, 20, 20), fillvalue=-1.)
+
+    def tearDown(self):
+        close_pyramid_sidecars(self.file_path)
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def test_first(self):
+        build_pyramid_sidecar(self.file_path, 'chl', aggregation='first', tile_size=(10, 10), num_workers=0,
+                              block_size=8)
+        sidecar_path = get_sidecar_path(self.file_path, 'chl')
+        self.assertEqual(sorted(os.listdir(self.dir_path)), ['test.nc', os.path.basename(sidecar_path)])
+
+        with h5py.File(self.file_path, 'r') as dataset:
+            variable = dataset['chl']
+            pyramid = ImagePyramid.create_from_array(variable, tile_size=(10, 10), image_id='test|chl')
+            self.assertEqual(pyramid.num_levels, 4)
+            for z_index in range(pyramid.num_levels - 1):
+                level_image = pyramid.get_level_image(z_index)
+                self.assertEqual(level_image.id, 'test|chl-L%d' % z_index)
+                zoom = 1 << (pyramid.num_levels - 1 - z_index)
+                num_tiles_x, num_tiles_y = level_image.num_tiles
+                for tile_y in range(num_tiles_y):
+                    for tile_x in range(num_tiles_x):
+                        x, y = 10 * tile_x * zoom, 10 * tile_y * zoom
+                        expected_tile = variable[..., y:y + 10 * zoom:zoom, x:x + 10 * zoom:zoom]
+                        np.testing.assert_equal(level_image.get_tile(tile_x, tile_y), expected_tile)
+            # The highest level is read from the variable
+            self.assertIs(pyramid.get_level_image(3)._array, variable)
+            self.assertIsNot(pyramid.get_level_image(2)._array, variable)
+
+            # A sidecar of another layout is ignored
+            pyramid = ImagePyramid.create_from_array(variable, tile_size=(20, 20))
+            self.assertIs(pyramid.get_level_image(0)._array, variable)
+
+    def test_nanmean_with_workers(self):
+        self.assertEqual(main([self.file_path, 'chl', '-t', '10', '10', '-w', '2', '-b', '40']), 0)
+
+        with h5py.File(self.file_path, 'r') as dataset:
+            variable = dataset['chl']
+            data = np.ma.masked_invalid(variable[0])
+            data = np.ma.masked_equal(data, -1.)
+            pyramid = ImagePyramid.create_from_array(variable, tile_size=(10, 10), image_id='test|chl')
+            self.assertEqual(pyramid.get_level_image(2).id, 'test|chl|nanmean-L2')
+            self.assertEqual(pyramid.get_level_image(3).id, 'test|chl-L3')
+            tile = pyramid.get_tile(4, 2, 2)
+            self.assertAlmostEqual(tile[0, 0, 0], data[40:42, 80:82].mean(), places=6)
+            self.assertAlmostEqual(tile[0, 1, 1], data[42:44, 82:84].mean(), places=6)
+            # No-data values are ignored and only remain, as fill value, where all values are no-data
+            np.testing.assert_equal(pyramid.get_tile(0, 0, 0)[0, :2, :5], -1.)
+            self.assertAlmostEqual(pyramid.get_tile(0, 0, 0)[0, 5, 5], data[40:48, 40:48].mean(), places=6)
+
+        # Sidecars older than their data file are ignored
+        os.utime(self.file_path, (os.path.getatime(self.file_path), os.path.getmtime(self.file_path) + 10))
+        close_pyramid_sidecars(self.file_path)
+        with h5py.File(self.file_path, 'r') as dataset:
+            variable = dataset['chl']
+            pyramid = ImagePyramid.create_from_array(variable, tile_size=(10, 10), image_id='test|chl')
+            self.assertEqual(pyramid.get_level_image(2).id, 'test|chl-L2')
+            self.assertIs(pyramid.get_level_image(0)._array, variable)
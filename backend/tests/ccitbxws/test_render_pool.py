@@ -0,0 +1,89 @@
+import time
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from ccitbxws.cache import Cache
+from ccitbxws.cmaps import get_color_mapper
+from ccitbxws.image import ColorMappedRgbaImage, ImagePyramid, render_color_mapped_tile
+import ccitbxws.render_pool
+from ccitbxws.render_pool import TileRenderPool
+from ccitbxws.tile_stores import MemoryTileCacheStore
+
+
+class TileRenderPoolTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = TileRenderPool(num_workers=2, max_tile_size=(64, 64))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_render(self):
+        color_mapper = get_color_mapper('jet')
+        data = np.linspace(-0.5, 1.5, 40 * 50, dtype=np.float32).reshape((40, 50))
+        data[0, :10] = np.nan
+        mask = np.zeros(data.shape, dtype=np.bool_)
+        mask[10:20, 10:20] = True
+        stats = self.pool.get_stats()
+        for array in (data, np.ma.array(data, mask=mask), data.astype(np.int16), data[::2, ::3]):
+            for render_options in (dict(format='PNG', palette=False, encoder_options=dict(compress_level=1)),
+                                   dict(format='PNG', palette=True),
+                                   dict(format='JPEG', encoder_options=dict(quality=90)),
+                                   dict(format='WEBP', no_data_value=0, encoder_options=dict(lossless=True))):
+                render_options = dict(render_options, value_range=(0.0, 1.0))
+                self.assertEqual(self.pool.render(array, color_mapper, render_options),
+                                 render_color_mapped_tile(array, color_mapper, **render_options))
+        new_stats = self.pool.get_stats()
+        self.assertEqual(new_stats['num_rendered'] - stats['num_rendered'], 16)
+        self.assertEqual(new_stats['num_local'], stats['num_local'])
+
+        # Tiles larger than the shared memory slots are rendered by the calling thread
+        large_array = np.zeros((100, 100), dtype=np.float32)
+        render_options = dict(format='PNG', value_range=(0.0, 1.0))
+        self.assertEqual(self.pool.render(large_array, color_mapper, render_options),
+                         render_color_mapped_tile(large_array, color_mapper, **render_options))
+        self.assertEqual(self.pool.get_stats()['num_local'] - stats['num_local'], 1)
+
+    def test_color_mapped_image(self):
+        array = np.linspace(0., 1., 40 * 80, dtype=np.float64).reshape((40, 80))
+        pyramid = ImagePyramid.create_from_array(np.ma.masked_greater(array, 0.5), tile_size=(20, 20))
+        images = [ColorMappedRgbaImage(pyramid.get_level_image(1), cmap_name='viridis', encode=True, format='WEBP',
+                                       tile_cache=Cache(MemoryTileCacheStore()), render_pool=render_pool)
+                  for render_pool in (None, self.pool)]
+        stats = self.pool.get_stats()
+        for tile_y in range(2):
+            for tile_x in range(4):
+                self.assertEqual(images[1].get_tile(tile_x, tile_y), images[0].get_tile(tile_x, tile_y))
+        # The fully masked tiles of the lower row are encoded once and shared
+        self.assertEqual(self.pool.get_stats()['num_rendered'] - stats['num_rendered'], 5)
+
+    def test_worker_terminated(self):
+        def render_slowly(*args, **kwargs):
+            time.sleep(60)
+
+        # The workers are forked with the slow renderer, the calling thread keeps the real one
+        with patch.object(ccitbxws.render_pool, 'render_color_mapped_tile', render_slowly):
+            pool = TileRenderPool(num_workers=1, max_tile_size=(64, 64), num_slots=1, timeout=1.0)
+        try:
+            color_mapper = get_color_mapper('jet')
+            array = np.linspace(0., 1., 40 * 50, dtype=np.float32).reshape((40, 50))
+            render_options = dict(format='PNG', value_range=(0.0, 1.0))
+            tiles = []
+            thread = Thread(target=lambda: tiles.append(pool.render(array, color_mapper, render_options)))
+            thread.start()
+            time.sleep(0.2)
+            for process in pool._pool._pool:
+                process.terminate()
+            thread.join(5.0)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(tiles, [render_color_mapped_tile(array, color_mapper, **render_options)])
+            stats = pool.get_stats()
+            self.assertEqual((stats['num_rendered'], stats['num_local'], stats['num_failed']), (0, 0, 1))
+            # The slot is free again
+            self.assertEqual(pool._free_slots.qsize(), 1)
+        finally:
+            pool.close()
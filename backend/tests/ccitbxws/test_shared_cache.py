@@ -0,0 +1,143 @@
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from ccitbxws.shared_cache import SharedMemoryCache
+
+
+def _get_test_value(key):
+    # a value of 100 to 3000 bytes that can be verified by the key
+    size = 100 + int(hashlib.md5(key.encode('utf-8')).hexdigest()[:4], 16) % 2900
+    return (key.encode('utf-8') * (size // len(key) + 1))[:size]
+
+
+def _run_worker(file_path, worker_index, num_keys, num_rounds):
+    cache = SharedMemoryCache(file_path)
+    num_errors = 0
+    for i in range(num_rounds):
+        key = 'img/%d/%d' % ((i * 7 + worker_index) % num_keys, i % 3)
+        value = cache.get_value(key)
+        if value is None:
+            cache.put_value(key, _get_test_value(key))
+        elif value != _get_test_value(key):
+            num_errors += 1
+    cache.close()
+    os._exit(min(num_errors, 100))
+
+
+class SharedMemoryCacheTest(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.dir_path, 'tiles.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def test_put_get_remove(self):
+        cache = SharedMemoryCache(self.file_path, capacity=64 * 1024, page_size=16 * 1024, min_chunk_size=256)
+        self.assertEqual(cache.capacity, 64 * 1024)
+
+        cache.put_value('img/0/0', b'PNG-0')
+        cache.put_value('img/0/1', bytes(1000))
+        self.assertEqual(cache.get_value('img/0/0'), b'PNG-0')
+        self.assertEqual(cache.get_value('img/0/1'), bytes(1000))
+        self.assertIsNone(cache.get_value('img/1/1'))
+        self.assertEqual(cache.num_items, 2)
+        self.assertEqual(cache.size, 256 + 1024)
+        self.assertTrue(cache.contains('img/0/0'))
+        self.assertFalse(cache.contains('img/1/1'))
+
+        cache.put_value('img/0/0', b'PNG-00')
+        self.assertEqual(cache.get_value('img/0/0'), b'PNG-00')
+        self.assertEqual(cache.num_items, 2)
+
+        # values larger than a page are not cached
+        cache.put_value('img/0/0', bytes(16 * 1024))
+        self.assertIsNone(cache.get_value('img/0/0'))
+
+        # neither are values other than bytes, e.g. of OpImage tile caches
+        cache.put_value('img/0/0', b'PNG-0')
+        for value in ('not bytes', None, np.zeros((2, 2))):
+            cache.put_value('img/0/0', value)
+            self.assertFalse(cache.contains('img/0/0'))
+
+        cache.remove_value('img/0/1')
+        self.assertIsNone(cache.get_value('img/0/1'))
+        self.assertEqual(cache.num_items, 0)
+        self.assertEqual(cache.size, 0)
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['puts'], 4)
+
+        cache.put_value('img/0/1', b'PNG-1')
+        cache.close()
+
+        # the cache survives in the file, creation arguments are ignored
+        cache = SharedMemoryCache(self.file_path, capacity=1024 * 1024)
+        self.assertEqual(cache.capacity, 64 * 1024)
+        self.assertEqual(cache.get_value('img/0/1'), b'PNG-1')
+        cache.clear()
+        self.assertIsNone(cache.get_value('img/0/1'))
+        self.assertEqual(cache.num_items, 0)
+        cache.close()
+
+    def test_eviction(self):
+        cache = SharedMemoryCache(self.file_path, capacity=16 * 1024, page_size=4 * 1024, min_chunk_size=256)
+
+        for i in range(200):
+            cache.put_value('small/%d' % i, _get_test_value('small/%d' % i)[:200])
+        self.assertEqual(cache.num_items, 64)
+        self.assertEqual(cache.get_stats()['evictions'], 200 - 64)
+        self.assertEqual(cache.get_value('small/199'), _get_test_value('small/199')[:200])
+
+        # all pages are assigned to the smallest size class, so larger values must take over pages
+        for i in range(20):
+            cache.put_value('large/%d' % i, _get_test_value('large/%d' % i)[:3000])
+            self.assertEqual(cache.get_value('large/%d' % i), _get_test_value('large/%d' % i)[:3000])
+
+        num_items = 0
+        for prefix, size, count in (('small', 200, 200), ('large', 3000, 20)):
+            for i in range(count):
+                key = '%s/%d' % (prefix, i)
+                value = cache.get_value(key)
+                if value is not None:
+                    self.assertEqual(value, _get_test_value(key)[:size])
+                    num_items += 1
+        self.assertEqual(cache.num_items, num_items)
+        self.assertLessEqual(cache.size, cache.capacity)
+        cache.close()
+
+    def test_multiple_processes(self):
+        num_keys = 300
+        cache = SharedMemoryCache(self.file_path, capacity=256 * 1024, page_size=16 * 1024, min_chunk_size=128)
+
+        processes = [multiprocessing.Process(target=_run_worker, args=(self.file_path, i, num_keys, 2000))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual([process.exitcode for process in processes], [0] * 4)
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 4 * 2000)
+        self.assertGreater(stats['hits'], 0)
+        self.assertGreater(stats['evictions'], 0)
+
+        num_items = 0
+        for i in range(num_keys):
+            for j in range(3):
+                key = 'img/%d/%d' % (i, j)
+                value = cache.get_value(key, record=False)
+                if value is not None:
+                    self.assertEqual(value, _get_test_value(key))
+                    num_items += 1
+        self.assertEqual(cache.num_items, num_items)
+        cache.close()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from ccitbxws.image import FastNdarrayDownsamplingImage, TransformArrayImage
+from ccitbxws.tile_stats import TileStatsTree, compute_tile_stats
+from ccitbxws.tile_stores import is_shared_tile
+
+
+def _create_tree():
+    # Level 2 has 8 x 4 tiles, whose left half (x < 4) is empty
+    tree = TileStatsTree((2, 1), 3)
+    for tile_y in range(4):
+        for tile_x in range(8):
+            if tile_x < 4:
+                tile = np.full((2, 2), np.nan)
+            else:
+                tile = np.array([[tile_x, tile_y], [tile_x + 0.5, np.nan]])
+            tree.record(2, tile_x, tile_y, tile)
+    return tree
+
+
+class TileStatsTreeTest(TestCase):
+    def test_compute_tile_stats(self):
+        self.assertEqual(compute_tile_stats(np.array([[1, 5], [3, 2]], dtype=np.int16)), (1.0, 5.0, 4, 4))
+        self.assertEqual(compute_tile_stats(np.ma.masked_equal([[1., 5.], [np.inf, 2.]], 5.)), (1.0, 2.0, 4, 2))
+        tile_min, tile_max, count, valid_count = compute_tile_stats(np.full((3, 3), np.nan, dtype=np.float32))
+        self.assertTrue(np.isnan(tile_min) and np.isnan(tile_max))
+        self.assertEqual((count, valid_count), (9, 0))
+
+    def test_record_and_propagate(self):
+        tree = _create_tree()
+        self.assertEqual(tree.get_num_tiles(0), (2, 1))
+        self.assertEqual(tree.get_num_tiles(2), (8, 4))
+        self.assertEqual(tree.tile_layout, ((), np.dtype(np.float64)))
+
+        self.assertEqual(tree.get_tile_stats(2, 5, 3), dict(min=3.0, max=5.5, count=4, valid_count=3,
+                                                             empty=False, exact=True))
+        # Level 0 and 1 tiles are known from their children only
+        self.assertEqual(tree.get_tile_stats(0, 0, 0), dict(min=None, max=None, count=None, valid_count=None,
+                                                             empty=True, exact=True))
+        self.assertEqual(tree.get_tile_stats(0, 1, 0), dict(min=0.0, max=7.5, count=None, valid_count=None,
+                                                             empty=False, exact=True))
+        self.assertTrue(tree.is_empty(1, 1, 1))
+        self.assertFalse(tree.is_empty(1, 2, 1))
+
+        # A level 1 tile's own statistics don't change the exact range of its region
+        tree.record(1, 2, 0, np.array([[4.0, 6.0]]))
+        self.assertEqual(tree.get_tile_stats(1, 2, 0), dict(min=0.0, max=5.5, count=2, valid_count=2,
+                                                             empty=False, exact=True))
+
+        self.assertEqual(tree.get_value_range(2), dict(min=0.0, max=7.5, num_tiles=32, num_known_tiles=32,
+                                                       exact=True))
+        self.assertEqual(tree.get_value_range(2, 3, 1, 6, 3), dict(min=1.0, max=5.5, num_tiles=6,
+                                                                   num_known_tiles=6, exact=True))
+        self.assertEqual(tree.get_non_empty_tiles(2, 3, 1, 6, 3), [(4, 1), (5, 1), (4, 2), (5, 2)])
+        self.assertEqual(tree.get_non_empty_tiles(1, 0, 0, 2, 2), [])
+
+    def test_value_range_of_unknown_tiles(self):
+        tree = TileStatsTree((1, 1), 3)
+        tree.record(0, 0, 0, np.array([[1.0, 2.0]]))
+        tree.record(2, 1, 1, np.array([[0.5, 4.0]]))
+        self.assertFalse(tree.is_empty(2, 0, 0))
+        # Unknown tiles are estimated from level 0
+        self.assertEqual(tree.get_value_range(2, 0, 0, 2, 2), dict(min=0.5, max=4.0, num_tiles=4,
+                                                                   num_known_tiles=1, exact=False))
+        self.assertEqual(tree.get_value_range(2, 2, 2, 4, 4), dict(min=1.0, max=2.0, num_tiles=4,
+                                                                   num_known_tiles=0, exact=False))
+        self.assertEqual(tree.get_non_empty_tiles(1), [(0, 0), (1, 0), (0, 1), (1, 1)])
+
+    def test_save_and_load(self):
+        dir_path = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(dir_path, 'test.nc.chl' + TileStatsTree.FILE_EXT)
+            tree = _create_tree()
+            self.assertEqual(tree.num_changes, 32)
+            tree.save(file_path)
+            self.assertEqual(tree.num_changes, 0)
+
+            loaded_tree = TileStatsTree.load(file_path, num_level_zero_tiles=(2, 1), num_levels=3)
+            self.assertEqual(loaded_tree.tile_layout, tree.tile_layout)
+            self.assertEqual(loaded_tree.to_dict(), tree.to_dict())
+            self.assertEqual(loaded_tree.to_dict(2), tree.to_dict(2))
+            self.assertTrue(loaded_tree.is_empty(2, 0, 0))
+
+            with self.assertRaises(ValueError):
+                TileStatsTree.load(file_path, num_levels=4)
+            with self.assertRaises(ValueError):
+                TileStatsTree.load(file_path, source_mtime=1234.0)
+            self.assertEqual(os.listdir(dir_path), [os.path.basename(file_path)])
+        finally:
+            shutil.rmtree(dir_path, ignore_errors=True)
+
+    def test_transform_array_image_skips_empty_tiles(self):
+        a = np.linspace(0.0, 1.0, 4 * 8, dtype=np.float32).reshape((4, 8))
+        a[:, :4] = np.nan
+        source_image = FastNdarrayDownsamplingImage(a, tile_size=(2, 2), num_levels=1, z_index=0)
+        num_reads = [0]
+        get_source_tile = source_image.get_tile
+
+        def get_tile(tile_x, tile_y):
+            num_reads[0] += 1
+            return get_source_tile(tile_x, tile_y)
+
+        source_image.get_tile = get_tile
+        tree = TileStatsTree((4, 2), 1)
+        image = TransformArrayImage(source_image, tile_stats=tree.get_level(0))
+
+        for tile_y in range(2):
+            for tile_x in range(4):
+                image.get_tile(tile_x, tile_y)
+        self.assertEqual(num_reads[0], 8)
+        self.assertEqual(tree.get_non_empty_tiles(0), [(2, 0), (3, 0), (2, 1), (3, 1)])
+
+        # Known empty tiles are not read again
+        image = TransformArrayImage(source_image, tile_stats=tree.get_level(0))
+        tile = image.get_tile(1, 1)
+        self.assertEqual(num_reads[0], 8)
+        self.assertTrue(is_shared_tile(tile))
+        self.assertEqual(tile.shape, (2, 2))
+        self.assertEqual(tile.count(), 0)
+        image.get_tile(2, 1)
+        self.assertEqual(num_reads[0], 9)
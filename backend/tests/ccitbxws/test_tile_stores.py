@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from ccitbxws.cache import Cache
+from ccitbxws.tile_stores import MemoryTileCacheStore, CompressedTileCacheStore, FileTileCacheStore, \
+    get_shared_tile, is_shared_tile, SHARED_TILE_SIZE
+
+
+class SharedTileTest(TestCase):
+    def test_shared_tiles_are_stored_by_reference(self):
+        tile = get_shared_tile(('test', 'zeros', (270, 270)), lambda: np.zeros((270, 270), dtype=np.float32))
+        self.assertIs(get_shared_tile(('test', 'zeros', (270, 270)), lambda: None), tile)
+        self.assertTrue(is_shared_tile(tile))
+        self.assertFalse(is_shared_tile(np.zeros((270, 270), dtype=np.float32)))
+
+        for store in (MemoryTileCacheStore(), CompressedTileCacheStore()):
+            stored_value, size = store.store_value('img/0/0', tile)
+            self.assertEqual(size, SHARED_TILE_SIZE)
+            self.assertIs(store.restore_value('img/0/0', stored_value), tile)
+
+        cache = Cache(MemoryTileCacheStore(), capacity=1000)
+        for i in range(10):
+            cache.put_value('img/0/%d' % i, tile)
+        self.assertEqual(cache.num_items, 10)
+        self.assertEqual(cache.size, 10 * SHARED_TILE_SIZE)
+
+
+class CompressedTileCacheStoreTest(TestCase):
+    def test_ndarray(self):
+        store = CompressedTileCacheStore()
+        array = np.full((1, 270, 270), np.nan, dtype=np.float32)
+        array[0, 100:110, 50:60] = np.linspace(0., 1., 100, dtype=np.float32).reshape((10, 10))
+
+        stored_value, size = store.store_value('img/0/0', array)
+        self.assertLess(size, array.nbytes // 20)
+        restored_array = store.restore_value('img/0/0', stored_value)
+        self.assertEqual(restored_array.dtype, np.float32)
+        self.assertEqual(restored_array.shape, (1, 270, 270))
+        np.testing.assert_equal(restored_array, array)
+
+    def test_strided_ndarray(self):
+        store = CompressedTileCacheStore(compress_level=6, shuffle=False)
+        array = np.arange(64, dtype=np.int16).reshape((8, 8))[::2, ::2]
+        stored_value, size = store.store_value('img/0/0', array)
+        np.testing.assert_equal(store.restore_value('img/0/0', stored_value), array)
+
+    def test_masked_ndarray(self):
+        store = CompressedTileCacheStore()
+        array = np.ma.masked_equal(np.arange(35, dtype=np.float64).reshape((5, 7)) % 3, 0)
+        array.fill_value = -1.
+        stored_value, size = store.store_value('img/0/0', array)
+        restored_array = store.restore_value('img/0/0', stored_value)
+        self.assertIsInstance(restored_array, np.ma.MaskedArray)
+        self.assertEqual(restored_array.tolist(), array.tolist())
+        self.assertEqual(restored_array.fill_value, -1.)
+
+    def test_other_tiles(self):
+        store = CompressedTileCacheStore()
+        stored_value, size = store.store_value('img/0/0', b'PNG-BYTES')
+        self.assertEqual(store.restore_value('img/0/0', stored_value), b'PNG-BYTES')
+
+
+class FileTileCacheStoreTest(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def test_store_and_restore(self):
+        store = FileTileCacheStore(self.dir_path)
+
+        stored_value, size = store.store_value('img/0/0', b'PNG-BYTES')
+        self.assertEqual(size, 9)
+        self.assertEqual(store.restore_value('img/0/0', stored_value), b'PNG-BYTES')
+
+        array = np.arange(12, dtype=np.float32).reshape((3, 4))
+        stored_value, size = store.store_value('img/0/1', array)
+        self.assertGreaterEqual(size, array.nbytes)
+        restored_array = store.restore_value('img/0/1', stored_value)
+        self.assertIsInstance(restored_array, np.memmap)
+        np.testing.assert_equal(restored_array, array)
+
+        masked_array = np.ma.masked_equal(array, 5.0)
+        stored_value, size = store.store_value('img/1/1', masked_array)
+        restored_array = store.restore_value('img/1/1', stored_value)
+        self.assertEqual(restored_array.tolist(), masked_array.tolist())
+        self.assertEqual(restored_array.fill_value, 5.0)
+
+        store.discard_value('img/1/1', stored_value)
+        self.assertEqual([item[0] for item in store.get_stored_items()], ['img/0/0', 'img/0/1'])
+
+    def test_get_stored_items_removes_orphans(self):
+        store = FileTileCacheStore(self.dir_path)
+        (base_path, _, _), _ = store.store_value('img/0/0', np.zeros((2, 2)))
+        store.store_value('img/0/1', b'PNG-BYTES')
+        # simulate a crash after the data file but before the entry file has been written
+        os.remove(base_path + FileTileCacheStore.ENTRY_EXT)
+        with open(os.path.join(os.path.dirname(base_path), 'tmp123.tmp'), 'wb') as fp:
+            fp.write(b'garbage')
+
+        store = FileTileCacheStore(self.dir_path)
+        stored_items = store.get_stored_items()
+        self.assertEqual([item[0] for item in stored_items], ['img/0/1'])
+        self.assertFalse(os.path.exists(base_path + '.npy'))
+        self.assertEqual(os.listdir(os.path.dirname(base_path)), [])
+
+    def test_as_parent_cache(self):
+        parent_cache = Cache(FileTileCacheStore(self.dir_path), capacity=1000, threshold=1.0)
+        # bytes tiles have a size of 73 in memory
+        cache = Cache(MemoryTileCacheStore(), capacity=150, threshold=1.0, parent_cache=parent_cache)
+
+        for i in range(4):
+            cache.put_value('img/0/%d' % i, bytes(40))
+        self.assertEqual(cache.num_items, 2)
+        self.assertEqual(parent_cache.num_items, 2)
+        self.assertEqual(cache.get_value('img/0/0'), bytes(40))
+
+        # a new process finds the evicted tiles on disk
+        parent_cache = Cache(FileTileCacheStore(self.dir_path), capacity=1000, threshold=1.0)
+        self.assertEqual(parent_cache.restore_stored_items(), 2)
+        self.assertEqual(parent_cache.size, 80)
+        self.assertEqual(parent_cache.get_value('img/0/1'), bytes(40))
@@ -40,6 +40,29 @@ class ArrayTest(TestCase):
                                              [1.1, 1.1, nan]]))
 
 
+    def test_nan_and_mask_aware_aggregators(self):
+        nan = np.nan
+        a = np.array([[1.0, nan, 4.0, 5.0],
+                      [3.0, nan, 6.0, 9.0]], dtype=np.float32)
+
+        b = utils.downsample_ndarray(a, aggregator=utils.aggregate_ndarray_nanmean)
+        self.assertEqual(b.dtype, np.float32)
+        np.testing.assert_equal(b, np.array([[2.0, 6.0]], dtype=np.float32))
+        np.testing.assert_equal(utils.downsample_ndarray(np.full((2, 2), nan), aggregator=utils.AGGREGATORS['nanmean']),
+                                np.array([[nan]]))
+
+        m = np.ma.masked_equal(np.array([[1, 7, 4, 5],
+                                         [3, 7, 6, 9]], dtype=np.int16), 7)
+        m[:, 2:] = np.ma.masked
+        b = utils.downsample_ndarray(m, aggregator=utils.aggregate_ndarray_nanmean)
+        self.assertEqual(b.dtype, np.int16)
+        self.assertEqual(b.tolist(), [[2, None]])
+        b = utils.downsample_ndarray(m, aggregator=utils.aggregate_ndarray_min)
+        self.assertEqual(b.tolist(), [[1, None]])
+        b = utils.downsample_ndarray(m, aggregator=utils.aggregate_ndarray_max)
+        self.assertEqual(b.tolist(), [[3, None]])
+
+
 class CardinalDivRoundTest(TestCase):
     def test_num_0(self):
         self.assertEqual(2, utils.cardinal_div_round(0, -1))
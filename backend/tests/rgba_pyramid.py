@@ -20,12 +20,12 @@ dirname = 'chlor_a'
 if not os.path.exists(dir):
     os.mkdir(dirname)
 
-t1 = time.clock()
+t1 = time.perf_counter()
 for tile_y in range(num_tiles_y):
     for tile_x in range(num_tiles_x):
         tile = image.get_tile(tile_x, tile_y)
         tile.save(dirname + '/%d_%d.png' % (tile_y, tile_x), format='PNG')
-t2 = time.clock()
+t2 = time.perf_counter()
 
 print("saving RGBA tiles took: ", t2 - t1)
 